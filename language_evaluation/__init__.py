@@ -5,6 +5,10 @@ import contextlib
 import os
 from subprocess import call
 import abc
+from array import array
+import collections
+import itertools
+import numbers
 import shutil
 from tempfile import mkdtemp
 import json
@@ -12,10 +16,20 @@ import json
 import numpy as np
 import more_itertools
 
-from language_evaluation.coco_caption_py3.pycocoevalcap.eval import COCOEvalCap
+from language_evaluation.coco_caption_py3.pycocoevalcap.eval import COCOEvalCap, merge_stats, _COCO_TYPE_TO_METRIC, \
+    _bucket_by_cost, _lcs_cost
+from language_evaluation.coco_caption_py3.pycocoevalcap import stats
+from language_evaluation.coco_caption_py3.pycocoevalcap.stats import make_stats, check_stats
+from language_evaluation.coco_caption_py3.pycocoevalcap.vocabulary import Vocabulary
+from language_evaluation.coco_caption_py3.pycocoevalcap.reference_store import ReferenceStore
 from language_evaluation.coco_caption_py3.pycocotools.coco import COCO
 from language_evaluation.rouge import rouge_scorer, scoring
 from language_evaluation.pyrouge.Rouge155 import Rouge155
+from language_evaluation.pyrouge.utils.sentence_splitter import CachedSentenceSplitter
+from language_evaluation.rouge155 import Rouge155Scorer
+from language_evaluation.monitor import WindowedMetricMonitor
+from language_evaluation.compiled_references import CompiledReferences, CompiledAnswer, open_references, \
+    write_compiled
 
 
 __PATH__ = os.path.abspath(os.path.dirname(__file__))
@@ -65,8 +79,83 @@ def _period_sentence_splitter(text: str) -> List[str]:
     return text.split(".")
 
 
-def _split_list(in_list, num_splits):
-    return [list(c) for c in more_itertools.divide(num_splits, in_list)]
+# For num_parallel_calls="auto": the number of samples scored in-process to
+# estimate the cost of the others, the estimated time below which all of them
+# are scored in-process, and the least time worth starting a process for
+_AUTO_PROBE_SIZE = 32
+_AUTO_MIN_PARALLEL_SECONDS = 1.0
+_AUTO_MIN_SECONDS_PER_PROCESS = 0.5
+
+
+def _available_cpus():
+    # Honors taskset/cgroup CPU affinity, unlike os.cpu_count()
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _auto_num_processes(num_items, probe_size, probe_seconds):
+    """Number of processes for num_items, given that the first probe_size
+    of them took probe_seconds in this process (1 means in-process)."""
+    if probe_size >= num_items:
+        return 1
+    seconds = probe_seconds * num_items / probe_size
+    if seconds < _AUTO_MIN_PARALLEL_SECONDS:
+        return 1
+    return max(1, min(_available_cpus(), int(seconds / _AUTO_MIN_SECONDS_PER_PROCESS)))
+
+
+def _check_num_parallel_calls(num_parallel_calls):
+    if num_parallel_calls != "auto" and not (isinstance(num_parallel_calls, int) and num_parallel_calls >= 1):
+        raise ValueError(f"num_parallel_calls must be a positive int or \"auto\", not {num_parallel_calls!r}")
+
+
+def _is_single_reference(answer, token_ids=False):
+    # An answer is one reference (a string, or a sequence of token ids) or a list of them
+    if token_ids:
+        return len(answer) == 0 or isinstance(answer[0], numbers.Integral)
+    return type(answer) == str
+
+
+def _zip_strict(*iterables):
+    sentinel = object()
+    for values in itertools.zip_longest(*iterables, fillvalue=sentinel):
+        if any(value is sentinel for value in values):
+            raise ValueError("predicts and answers have different lengths")
+        yield values
+
+
+def _check_not_compiled(answers):
+    if isinstance(answers, CompiledReferences):
+        raise ValueError("Compiled references hold the whole corpus: use run_evaluation")
+
+
+class _SharedArray(object):
+    """A numpy array in a `multiprocessing.shared_memory` block. Other
+    processes attach to it with `_SharedArray.attach(shared.spec)`."""
+    def __init__(self, shm, shape, dtype):
+        self.shm = shm
+        self.array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        self.spec = (shm.name, shape, np.dtype(dtype).str)
+
+    @classmethod
+    def create(cls, values):
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        shared = cls(shm, values.shape, values.dtype)
+        shared.array[...] = values
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        from multiprocessing import shared_memory
+        name, shape, dtype = spec
+        return cls(shared_memory.SharedMemory(name=name), shape, dtype)
+
+    def close(self):
+        # The block cannot be closed while a numpy view exports its buffer
+        self.array = None
+        self.shm.close()
 
 
 class Evaluator(object, metaclass=abc.ABCMeta):
@@ -81,34 +170,150 @@ class CocoEvaluator(Evaluator):
                  coco_types=["BLEU", "METEOR", "ROUGE_L", "CIDEr", "SPICE"],
                  tokenization_fn=None,
                  verbose=True,
-                 unk_token='_UNK'):
+                 unk_token='_UNK',
+                 num_workers: int = 1,
+                 rouge_max_band=None,
+                 vocab=None):
         self.coco_types = coco_types
         self._tokenization_fn = tokenization_fn
         self.verbose = verbose
         self._unk_token = unk_token
+        self._num_workers = num_workers
+        self._rouge_max_band = rouge_max_band
+        # With a vocab, predicts and answers are sequences of token ids
+        # (see COCOEvalCap)
+        self._vocab = vocab
 
     def run_evaluation(self, predicts, answers):
+        with contextlib.redirect_stdout(None):
+            coco_eval = self._make_coco_eval(predicts, answers)
+            coco_eval.evaluate()
+
+        return coco_eval.eval
+
+    def partial_doc_freq(self, answers):
+        """First phase of a sharded evaluation with CIDEr.
+
+        Returns the CIDEr document frequency of this shard's answers. Merge
+        the results of all shards with `merge_doc_freq` and pass it to
+        `partial` on every shard.
+        """
+        _check_not_compiled(answers)
+        with contextlib.redirect_stdout(None):
+            coco_eval = self._make_coco_eval(None, answers)
+            return coco_eval.partial_doc_freq()
+
+    def merge_doc_freq(self, *partials):
+        return _COCO_TYPE_TO_METRIC["CIDEr"][0].merge_doc_freq(*partials)
+
+    def partial(self, predicts, answers, doc_freq=None):
+        """Sufficient statistics of one shard, to be combined with `merge`.
+
+        Sample usage (each shard may run on a different node):
+            doc_freq = evaluator.merge_doc_freq(
+                *[evaluator.partial_doc_freq(a) for p, a in shards])
+            partials = [evaluator.partial(p, a, doc_freq) for p, a in shards]
+            results = evaluator.merge(*partials)
+
+        Stats are plain dicts; use `language_evaluation.stats.dumps/loads`
+        to send them between nodes.
+        """
+        _check_not_compiled(answers)
+        with contextlib.redirect_stdout(None):
+            coco_eval = self._make_coco_eval(predicts, answers)
+            return coco_eval.partial(doc_freq)
+
+    def merge(self, *partials):
+        """Same result as `run_evaluation` on the concatenation of all shards."""
+        return merge_stats(self.coco_types, partials)
+
+    def _make_coco_eval(self, predicts, answers):
+        if isinstance(answers, CompiledReferences):
+            return self._make_compiled_coco_eval(predicts, answers)
+        return self._make_coco_eval_for(self._make_coco(answers), predicts)
 
-        coco_res = []
+    def _make_compiled_coco_eval(self, predicts, compiled):
+        # The references are the compiled ReferenceStore, so coco only
+        # needs the image ids
+        if compiled.coco is None:
+            raise ValueError("{} was compiled with coco=False".format(compiled.path))
+        if self._vocab is not None or self._tokenization_fn is not None:
+            raise ValueError("Compiled references are PTB tokenized strings, so vocab and "
+                             "tokenization_fn cannot be used with them")
+        coco = COCO({'images': [{'id': i} for i in range(len(compiled))], 'info': '',
+                     'type': 'captions', 'annotations': [], 'licenses': ''})
+        return self._make_coco_eval_for(coco, predicts, references=compiled.coco)
+
+    def _make_coco(self, answers):
         ann = {'images': [], 'info': '', 'type': 'captions', 'annotations': [], 'licenses': ''}
 
-        for i, (predict, _answers) in enumerate(zip(predicts, answers)):
-            if type(_answers) == str:
+        for i, _answers in enumerate(answers):
+            if _is_single_reference(_answers, token_ids=self._vocab is not None):
                 _answers = [_answers]
             answer_caps = []
             for _answer in _answers:
-                answer_cap = _answer.replace(self._unk_token, '_UNKNOWN')
+                if self._vocab is None:
+                    answer_cap = _answer.replace(self._unk_token, '_UNKNOWN')
+                else:
+                    answer_cap = _answer
                 answer_caps.append(answer_cap)
 
             ann['images'].append({'id': i})
             for answer_cap in answer_caps:
                 ann['annotations'].append({'caption': answer_cap, 'id': i, 'image_id': i})
-            coco_res.append({'caption': predict, 'id': i, 'image_id': i})
 
+        return COCO(ann)
+
+    def _make_coco_eval_for(self, coco, predicts, references=None):
+        coco_res = None
+        if predicts is not None:
+            coco_res = coco.loadRes([{'caption': predicts[i], 'id': i, 'image_id': i}
+                                     for i in coco.getImgIds()])
+        return COCOEvalCap(coco, coco_res, self.coco_types, self._tokenization_fn,
+                           verbose=self.verbose, num_workers=self._num_workers,
+                           rouge_max_band=self._rouge_max_band, vocab=self._vocab,
+                           references=references)
+
+
+class EvaluationSession(object):
+    """CocoEvaluator for many sets of predicts against the same answers,
+    such as the outputs of several checkpoints or decoding configs.
+
+    The answers are indexed and tokenized once, and the work BLEU and CIDEr
+    do on references alone (max counts, n-gram counts, document frequency
+    and tf-idf vectors) is done once too (see COCOEvalCap.prepareReferences).
+    `evaluate` then only processes the predicts, and returns the same
+    results as CocoEvaluator(...).run_evaluation(predicts, answers).
+    Arguments other than `answers` are those of CocoEvaluator.
+
+    Sample usage:
+        session = language_evaluation.EvaluationSession(answers, coco_types=["BLEU", "CIDEr"])
+        for predicts in predicts_of_checkpoints:
+            pprint(session.evaluate(predicts))
+    """
+    def __init__(self,
+                 answers,
+                 coco_types=["BLEU", "METEOR", "ROUGE_L", "CIDEr", "SPICE"],
+                 tokenization_fn=None,
+                 verbose=True,
+                 unk_token='_UNK',
+                 num_workers: int = 1,
+                 rouge_max_band=None,
+                 vocab=None):
+        self._evaluator = CocoEvaluator(coco_types, tokenization_fn, verbose, unk_token,
+                                        num_workers, rouge_max_band, vocab)
+        with contextlib.redirect_stdout(None):
+            self._coco = self._evaluator._make_coco(answers)
+            self._references = self._evaluator._make_coco_eval_for(self._coco, None).prepareReferences()
+
+    def __len__(self):
+        return len(self._references)
+
+    def evaluate(self, predicts):
+        if len(predicts) != len(self):
+            raise ValueError("predicts and answers have different lengths")
         with contextlib.redirect_stdout(None):
-            coco = COCO(ann)
-            coco_res = coco.loadRes(coco_res)
-            coco_eval = COCOEvalCap(coco, coco_res, self.coco_types, self._tokenization_fn, verbose=self.verbose)
+            coco_eval = self._evaluator._make_coco_eval_for(self._coco, predicts, self._references)
             coco_eval.evaluate()
 
         return coco_eval.eval
@@ -118,6 +323,46 @@ class RougeEvaluator(Evaluator):
     """Calculate rouges scores two blobs of single-sentence text by using
     google's python rouge scripts.
     (If you wnat to get sentence-level ROUGE-L, use Rouge155Evaluator)
+    Besides rougeN and rougeL, `rouge_types` may include rougeW (with
+    weight `weight`) and skip-bigram types such as rougeS4 and rougeSU4.
+    Each answer may also be a list of references; scores against them are
+    combined by `reference_aggregation` ("max", "mean" or "jackknife", see
+    RougeScorer.score_multi).
+
+    With `use_shared_memory=True`, the texts are tokenized once in this
+    process and interned into flat int32 token id arrays in shared memory,
+    and the processes score slices of them into a shared output array,
+    instead of receiving pickled strings and returning pickled results.
+    Averages are then taken over all samples at once.
+
+    `run_streaming_evaluation` scores iterables that need not fit in memory,
+    such as the lines of two files.
+
+    With `num_parallel_calls="auto"`, a few samples are scored in-process
+    first to estimate the cost of the others. Cheap batches are then scored
+    in-process. Otherwise up to one process per available CPU is used.
+
+    Since ROUGE-L costs about len(predict) * len(answer), processes are not
+    given contiguous chunks of samples: samples are sorted by that cost and
+    cut into a few buckets of similar total cost per process, which are
+    scored most expensive first and put back in the original order.
+
+    With `lcs_max_band`, rougeL of texts longer than that many tokens only
+    looks at LCS table cells within lcs_max_band of the diagonal (see
+    rouge_scorer.lcs_length), so degenerate outputs cannot blow up its cost.
+    Results then include 'num_inexact_lcs', the number of samples whose
+    rougeL is only a lower bound because their LCS did not fit in the band.
+
+    With a `vocab` (a sequence of tokens indexed by id, such as a model's
+    vocabulary list or Vocabulary.tokens), predictions and references are
+    sequences of token ids instead of strings. The token of every id is
+    tokenized once (see RougeScorer.tokenize_ids), so scores are those of
+    the texts " ".join(vocab[i] for i in ids), but no text is built.
+
+    `answers` may also be CompiledReferences (see compile_references),
+    whose references were tokenized when they were compiled, with the same
+    use_stemmer and the default tokenizer. Processes then map the compiled
+    file rather than receive the references.
 
     Sample usage:
         evaluator = language_evaluation.RougeEvaluator(
@@ -126,71 +371,460 @@ class RougeEvaluator(Evaluator):
             ['i am a boy', 'she is a girl'],
             ['am i a boy ?', 'is she a girl ?'])
     """
+    CHUNKS_PER_PROCESS = 4
+
     def __init__(self,
-                 num_parallel_calls: int = 1,
+                 num_parallel_calls: Union[int, str] = 1,
                  rouge_types=["rouge1", "rouge2", "rougeL"],
                  use_stemmer=True,
                  tokenization_fn=None,
-                 average=True):
+                 average=True,
+                 weight=1.2,
+                 reference_aggregation="max",
+                 use_shared_memory=False,
+                 lcs_max_band=None,
+                 vocab=None):
+        _check_num_parallel_calls(num_parallel_calls)
         self._num_parallel_calls = num_parallel_calls
         self.rouge_types = rouge_types
         self.use_stemmer = use_stemmer
         self._tokenization_fn = tokenization_fn
         self.average = average
+        self.weight = weight
+        self.reference_aggregation = reference_aggregation
+        self.use_shared_memory = use_shared_memory
+        self.lcs_max_band = lcs_max_band
+        self.vocab = vocab
 
     def run_evaluation(self, predicts, answers):
-        n_predicts = _split_list(predicts, self._num_parallel_calls)
-        n_answers = _split_list(answers, self._num_parallel_calls)
-        from multiprocessing import Pool
-        p = Pool(self._num_parallel_calls)
+        if self.use_shared_memory:
+            return self._run_shared_memory_evaluation(predicts, answers)
+
+        import time
+        start = time.time()
+        num_processes, num_chunks, (probe_fmeasures, num_inexact_lcs) = \
+            self._plan_parallelism(predicts, answers)
+        # Samples the "auto" probe scored are not scored again
+        skip = len(probe_fmeasures)
+        if num_processes == 1:
+            fmeasures, rest_num_inexact_lcs = self._score_fmeasures(
+                list(zip(predicts[skip:], answers[skip:])))
+        else:
+            fmeasures, rest_num_inexact_lcs = self._score_buckets(predicts[skip:], answers[skip:],
+                                                                  num_processes, num_chunks)
+        all_fmeasures = np.concatenate([probe_fmeasures, fmeasures])
+        num_inexact_lcs += rest_num_inexact_lcs
+        end = time.time()
+        print(f"Takes {end-start} seconds for rouge evaluation with \
+              {num_processes} processes")
+
+        result = {}
+        for k, rouge_type in enumerate(self.rouge_types):
+            fmeasure = all_fmeasures[:, k].copy()
+            if self.average:
+                result[rouge_type] = np.mean(fmeasure)
+            else:
+                # Per-sample f-measures, in one array per process
+                result[rouge_type] = np.array_split(fmeasure, num_processes)
+        return self._add_num_inexact_lcs(result, num_inexact_lcs)
+
+    def partial(self, predicts, answers):
+        """Per-sample precision, recall and f-measure of one shard, to be
+        combined with `merge`."""
+        scorer = self._make_scorer()
+        all_scores = np.zeros((len(predicts), len(self.rouge_types), 3))
+        for i, (predict, answer) in enumerate(zip(predicts, answers)):
+            self._score(scorer, predict, answer, all_scores[i])
+        scores = {rouge_type: {measure: all_scores[:, k, m].copy()
+                               for m, measure in enumerate(scoring.Score._fields)}
+                  for k, rouge_type in enumerate(self.rouge_types)}
+        return make_stats("rouge", rouge_types=list(self.rouge_types),
+                          use_stemmer=self.use_stemmer, scores=scores,
+                          num_inexact_lcs=scorer.num_inexact_lcs)
+
+    def merge(self, *partials):
+        """Same result as `run_evaluation` with one process on the
+        concatenation of all shards (with `average=False`, a list of one
+        array of per-sample f-measures)."""
+        result = {}
+        for rouge_type in self.rouge_types:
+            fmeasure = np.concatenate(
+                [check_stats(partial, "rouge")['scores'][rouge_type]['fmeasure'] for partial in partials])
+            result[rouge_type] = np.mean(fmeasure) if self.average else [fmeasure]
+        return self._add_num_inexact_lcs(
+            result, sum(partial.get('num_inexact_lcs', 0) for partial in partials))
+
+    def run_streaming_evaluation(self, predicts, answers, chunk_size=10000, scores_path=None):
+        """Evaluate iterables of predicts and answers with bounded memory.
+
+        Chunks of `chunk_size` samples are scored by the processes, with at
+        most two chunks per process in flight, so the iterables are consumed
+        only as fast as they are scored. Only running sums of the f-measures
+        are kept, and the result is their mean over all samples.
+
+        If `scores_path` is given, the f-measures of every sample are also
+        written there as rows of len(rouge_types) raw float64 values. With
+        `average=False`, each rouge type is then returned as a column of a
+        read-only np.memmap of that file.
+
+        Sample usage:
+            with open('predicts.txt') as predicts, open('answers.txt') as answers:
+                results = evaluator.run_streaming_evaluation(predicts, answers)
+        """
+        if not self.average and scores_path is None:
+            raise ValueError("average=False needs a scores_path to write per-sample scores to")
+
         import time
         start = time.time()
-        results = p.map(self._run_evaluation, zip(n_predicts, n_answers))
+        sums = np.zeros(len(self.rouge_types))
+        num_samples = 0
+        num_inexact_lcs = 0
+        scores_file = open(scores_path, 'wb') if scores_path is not None else None
+
+        def consume(fmeasures_and_num_inexact_lcs):
+            nonlocal num_samples, num_inexact_lcs
+            fmeasures, chunk_num_inexact_lcs = fmeasures_and_num_inexact_lcs
+            sums[:] += fmeasures.sum(axis=0)
+            num_samples += len(fmeasures)
+            num_inexact_lcs += chunk_num_inexact_lcs
+            if scores_file is not None:
+                scores_file.write(fmeasures.tobytes())
+
+        chunks = more_itertools.chunked(_zip_strict(predicts, answers), chunk_size)
+        num_processes = 1 if self._num_parallel_calls == "auto" else self._num_parallel_calls
+        p = None
+        pending = collections.deque()
+        try:
+            for i, chunk in enumerate(chunks):
+                # "auto" scores the first chunk in-process, in case it is the
+                # only one, and starts processes for the rest
+                if i == 1 and self._num_parallel_calls == "auto":
+                    num_processes = _available_cpus()
+                if p is None and num_processes > 1:
+                    from multiprocessing import Pool
+                    p = Pool(num_processes)
+                if p is None:
+                    consume(self._score_fmeasures(chunk))
+                    continue
+                if len(pending) >= 2 * num_processes:
+                    consume(pending.popleft().get())
+                pending.append(p.apply_async(self._score_fmeasures, (chunk,)))
+            while pending:
+                consume(pending.popleft().get())
+        finally:
+            if p is not None:
+                # Do not wait for the remaining chunks after an error
+                if pending:
+                    p.terminate()
+                else:
+                    p.close()
+                p.join()
+            if scores_file is not None:
+                scores_file.close()
+        end = time.time()
+        print(f"Takes {end-start} seconds for rouge evaluation of {num_samples} samples with \
+              {num_processes} processes (streaming)")
+
+        if self.average:
+            result = {rouge_type: sums[k] / max(num_samples, 1)
+                      for k, rouge_type in enumerate(self.rouge_types)}
+        else:
+            if num_samples == 0:
+                fmeasures = np.zeros((0, len(self.rouge_types)))
+            else:
+                fmeasures = np.memmap(scores_path, dtype=np.float64, mode='r',
+                                      shape=(num_samples, len(self.rouge_types)))
+            result = {rouge_type: fmeasures[:, k] for k, rouge_type in enumerate(self.rouge_types)}
+        return self._add_num_inexact_lcs(result, num_inexact_lcs)
+
+    def _add_num_inexact_lcs(self, result, num_inexact_lcs):
+        # Number of rougeL scores that are lower bounds (see lcs_max_band)
+        if self.lcs_max_band is not None:
+            result['num_inexact_lcs'] = num_inexact_lcs
+        return result
+
+    def _score_fmeasures(self, predicts_and_answers):
+        """F-measures of the samples, and how many rougeL of them are inexact."""
+        scorer = self._make_scorer()
+        all_scores = np.zeros((len(predicts_and_answers), len(self.rouge_types), 3))
+        for i, (predict, answer) in enumerate(predicts_and_answers):
+            self._score(scorer, predict, answer, all_scores[i])
+        return all_scores[:, :, 2].copy(), scorer.num_inexact_lcs
+
+    def _score_buckets(self, predicts, answers, num_processes, num_chunks):
+        costs = [_lcs_cost(self._num_tokens(predict), self._reference_lengths(answer))
+                 for predict, answer in zip(predicts, answers)]
+        buckets = _bucket_by_cost(costs, num_chunks)
+        all_fmeasures = np.zeros((len(predicts), len(self.rouge_types)))
+
+        from multiprocessing import Pool
+        p = Pool(num_processes)
+        tasks = [[(predicts[i], answers[i]) for i in bucket] for bucket in buckets]
+        num_inexact_lcs = 0
+        for bucket, (fmeasures, bucket_num_inexact_lcs) in zip(buckets, p.imap(self._score_fmeasures, tasks)):
+            all_fmeasures[bucket] = fmeasures
+            num_inexact_lcs += bucket_num_inexact_lcs
         p.close()
         p.join()
+        return all_fmeasures, num_inexact_lcs
+
+    def _run_shared_memory_evaluation(self, predicts, answers):
+        if isinstance(answers, CompiledReferences):
+            raise ValueError("Compiled references are shared through their file; "
+                             "use_shared_memory does not apply to them")
+        import time
+        start = time.time()
+        num_processes, num_chunks, (probe_fmeasures, probe_num_inexact_lcs) = \
+            self._plan_parallelism(predicts, answers)
+        arrays = self._intern_tokens(predicts, answers)
+        arrays['scores'] = np.zeros((len(predicts), len(self.rouge_types), 3))
+        # Samples the "auto" probe scored are not scored again
+        skip = len(probe_fmeasures)
+        arrays['scores'][:skip, :, 2] = probe_fmeasures
+        if num_processes == 1:
+            num_inexact_lcs = self._score_token_arrays(**arrays, indices=range(skip, len(predicts)))
+            all_scores = arrays['scores']
+        else:
+            all_scores, num_inexact_lcs = self._score_shared(arrays, num_processes, num_chunks, skip)
+        num_inexact_lcs += probe_num_inexact_lcs
         end = time.time()
         print(f"Takes {end-start} seconds for rouge evaluation with \
-              {self._num_parallel_calls} processes")
+              {num_processes} processes (shared memory)")
 
-        # Average results form processes
-        averaged_result = {'rouge1': [], 'rouge2': [], 'rougeL': []}
-        for result in results:
-            for key, value in result.items():
-                averaged_result[key].append(value)
-        if self.average:
-            for key, value in averaged_result.items():
-                # TODO : Currently, we assume each process has same numver of
-                # predict-answer pairs
-                averaged_result[key] = sum(value) / len(value)
+        result = {}
+        for k, rouge_type in enumerate(self.rouge_types):
+            fmeasure = all_scores[:, k, 2].copy()
+            result[rouge_type] = np.mean(fmeasure) if self.average else fmeasure
+        return self._add_num_inexact_lcs(result, num_inexact_lcs)
 
-        return averaged_result
+    def _score_shared(self, arrays, num_processes, num_chunks, skip=0):
+        # Cost of every sample, as in _lcs_cost, from the token counts
+        # (the first skip samples are already scored)
+        num_samples = len(arrays['scores'])
+        lengths = np.diff(arrays['offsets'])
+        ref_sample = np.repeat(np.arange(num_samples), np.diff(arrays['ref_offsets']))
+        ref_costs = (lengths[ref_sample] + 1) * (lengths[num_samples:] + 1)
+        costs = np.bincount(ref_sample, weights=ref_costs, minlength=num_samples).tolist()
+        buckets = [[skip + i for i in bucket] for bucket in _bucket_by_cost(costs[skip:], num_chunks)]
 
-    def _run_evaluation(self, predicts_and_answers):
-        predicts, answers = predicts_and_answers
-        scorer = rouge_scorer.RougeScorer(self.rouge_types, self.use_stemmer, self._tokenization_fn)
-        scores = {rouge_type: [] for rouge_type in self.rouge_types}
-        for predict, answer in zip(predicts, answers):
-            # TODO : support multi-reference
-            score = scorer.score(answer, predict)
-            for key, value in score.items():
-                scores[key].append(value.fmeasure)
-
-        # Averaging
-        for key in scores.keys():
-            if self.average:
-                scores[key] = np.mean(np.array(scores[key]))
+        shared = {}
+        try:
+            for key in list(arrays):
+                shared[key] = _SharedArray.create(arrays.pop(key))
+            specs = {key: shared_array.spec for key, shared_array in shared.items()}
+
+            from multiprocessing import Pool
+            p = Pool(num_processes)
+            num_inexact_lcs = sum(p.map(self._score_shared_bucket, [(specs, bucket) for bucket in buckets],
+                                        chunksize=1))
+            p.close()
+            p.join()
+            return shared['scores'].array.copy(), num_inexact_lcs
+        finally:
+            for shared_array in shared.values():
+                shared_array.close()
+                shared_array.shm.unlink()
+
+    def _plan_parallelism(self, predicts, answers):
+        """Number of processes, of chunks to split samples into, and the
+        f-measures and number of inexact rougeL of the first samples, which
+        "auto" scores to decide (none otherwise)."""
+        probe = np.zeros((0, len(self.rouge_types))), 0
+        if self._num_parallel_calls != "auto":
+            num_processes = self._num_parallel_calls
+        elif len(predicts) <= _AUTO_PROBE_SIZE:
+            num_processes = 1
+        else:
+            import time
+            start = time.time()
+            probe = self._score_fmeasures(list(zip(predicts[:_AUTO_PROBE_SIZE], answers[:_AUTO_PROBE_SIZE])))
+            num_processes = _auto_num_processes(len(predicts), _AUTO_PROBE_SIZE, time.time() - start)
+        if num_processes == 1:
+            return 1, 1, probe
+        # A few chunks per process, so that processes which are done with
+        # theirs pick up more
+        return num_processes, self.CHUNKS_PER_PROCESS * num_processes, probe
+
+    def _intern_tokens(self, predicts, answers, vocab=None):
+        """Tokenize all texts and intern their tokens into int32 ids.
+
+        Texts are the predictions, then the references of every sample; the
+        tokens of text t are tokens[offsets[t]:offsets[t + 1]], and the
+        references of sample i are texts ref_offsets[i] to ref_offsets[i + 1].
+        Tokens are interned with `vocab` if given.
+        """
+        scorer = self._make_scorer()
+        vocab = Vocabulary() if vocab is None else vocab
+        tokens = array('i')
+        offsets = array('q', [0])
+
+        def add(text):
+            tokens.extend(vocab.encode(self._tokenize(scorer, text)))
+            offsets.append(len(tokens))
+
+        for predict in predicts:
+            add(predict)
+        ref_offsets = array('q', [len(predicts)])
+        for answer in answers:
+            for reference in self._references(answer):
+                add(reference)
+            ref_offsets.append(len(offsets) - 1)
+        return {'tokens': np.frombuffer(tokens, dtype=np.int32),
+                'offsets': np.frombuffer(offsets, dtype=np.int64),
+                'ref_offsets': np.frombuffer(ref_offsets, dtype=np.int64)}
+
+    def _score_shared_bucket(self, args):
+        specs, indices = args
+        shared = {key: _SharedArray.attach(spec) for key, spec in specs.items()}
+        try:
+            return self._score_token_arrays(*[shared[key].array for key in
+                                              ['tokens', 'offsets', 'ref_offsets', 'scores']],
+                                            indices=indices)
+        finally:
+            for shared_array in shared.values():
+                shared_array.close()
+
+    def _score_token_arrays(self, tokens, offsets, ref_offsets, scores, indices):
+        scorer = self._make_scorer()
+
+        def text(t):
+            # The slice is a view of the shared array; tolist copies its ids
+            # into python ints, which the scorer's dicts hash much faster
+            return tokens[offsets[t]:offsets[t + 1]].tolist()
+
+        for i in indices:
+            references = range(ref_offsets[i], ref_offsets[i + 1])
+            if len(references) == 1:
+                scorer.score_tokens(text(references[0]), text(i), out=scores[i])
+            else:
+                scorer.score_multi_tokens([text(t) for t in references], text(i),
+                                          self.reference_aggregation, out=scores[i])
+        return scorer.num_inexact_lcs
+
+    def _make_scorer(self):
+        return rouge_scorer.RougeScorer(self.rouge_types, self.use_stemmer, self._tokenization_fn,
+                                        self.weight, self.lcs_max_band)
+
+    def _score(self, scorer, predict, answer, out):
+        if isinstance(answer, CompiledAnswer):
+            self._score_compiled(scorer, predict, answer, out)
+        elif self.vocab is not None:
+            prediction = scorer.tokenize_ids(predict, self.vocab)
+            if _is_single_reference(answer, token_ids=True):
+                scorer.score_tokens(scorer.tokenize_ids(answer, self.vocab), prediction, out=out)
             else:
-                scores[key] = np.array(scores[key])
+                scorer.score_multi_tokens([scorer.tokenize_ids(reference, self.vocab) for reference in answer],
+                                          prediction, self.reference_aggregation, out=out)
+        elif type(answer) == str:
+            scorer.score_array(answer, predict, out=out)
+        else:
+            # The prediction is preprocessed once for all references
+            scorer.score_multi(answer, predict, self.reference_aggregation, out=out)
+
+    def _score_compiled(self, scorer, predict, answer, out):
+        compiled = answer.references
+        if self.vocab is not None or self._tokenization_fn is not None or \
+                self.use_stemmer != compiled.use_stemmer:
+            raise ValueError("{} was compiled with use_stemmer={} and the default tokenizer".format(
+                compiled.path, compiled.use_stemmer))
+        prediction = compiled.rouge_ids(scorer.tokenize(predict))
+        references = compiled.rouge_references(answer.index)
+        if len(references) == 1:
+            scorer.score_tokens(references[0], prediction, out=out)
+        else:
+            scorer.score_multi_tokens(references, prediction, self.reference_aggregation, out=out)
+
+    def _tokenize(self, scorer, text):
+        if self.vocab is not None:
+            return scorer.tokenize_ids(text, self.vocab)
+        return scorer.tokenize(text)
+
+    def _references(self, answer):
+        if _is_single_reference(answer, token_ids=self.vocab is not None):
+            return [answer]
+        return answer
+
+    def _num_tokens(self, text):
+        return len(text) if self.vocab is not None else len(text.split())
 
-        return scores
+    def _reference_lengths(self, answer):
+        if isinstance(answer, CompiledAnswer):
+            return answer.references.rouge_lengths(answer.index)
+        return [self._num_tokens(reference) for reference in self._references(answer)]
+
+
+def compile_references(answers, path, coco=True, use_stemmer=True, unk_token='_UNK', verbose=False):
+    """Tokenize answers once and write what the metrics compute from them
+    alone to a file, to be opened with `open_references`.
+
+    With `coco=True` (needs Java for the PTB tokenizer), the file holds the
+    tokenized references as a ReferenceStore: interned token ids, BLEU
+    max-count tables and CIDEr n-gram counts, document frequency and
+    reference vectors, for CocoEvaluator.run_evaluation. It always holds
+    the rouge tokens of every reference (stemmed if `use_stemmer`) for
+    RougeEvaluator. Answers are those the evaluators take: a string, or a
+    list of strings, per sample.
+
+    Sample usage:
+        language_evaluation.compile_references(answers, 'answers.refs')
+        references = language_evaluation.open_references('answers.refs')
+        for predicts in predicts_of_checkpoints:
+            pprint(evaluator.run_evaluation(predicts, references))
+    """
+    metadata = {'num_samples': len(answers), 'coco': None}
+    arrays = {}
+    if coco:
+        evaluator = CocoEvaluator(coco_types=[], verbose=verbose, unk_token=unk_token)
+        with contextlib.redirect_stdout(None):
+            gts, _ = evaluator._make_coco_eval(None, answers).tokenize(refs_only=True)
+        store = ReferenceStore.from_gts(gts)
+        metadata['coco'] = {'n': store.n, 'vocab': store.vocab.tokens[1:], 'unk_token': unk_token}
+        arrays.update(('coco/' + name, array) for name, array in store.to_arrays().items())
+
+    vocab = Vocabulary()
+    rouge_arrays = RougeEvaluator(use_stemmer=use_stemmer)._intern_tokens([], answers, vocab)
+    metadata['rouge'] = {'use_stemmer': use_stemmer, 'vocab': vocab.tokens[1:]}
+    arrays.update(('rouge/' + name, array) for name, array in rouge_arrays.items())
+
+    write_compiled(path, metadata, arrays)
 
 
 class Rouge155Evaluator(Evaluator):
     """Calculate rouges scores two blobs of multi-sentence text by using
     the original ROUGE-1.5.5 perl script.
     It takes multi-sentence text as a string and (by default) split sentences
-    based on the period symbol.
-    For speed up, pass `num_parallel_calls` > 2.
+    based on the period symbol. For Punkt sentence splitting, pass
+    `sentence_splitter=CachedSentenceSplitter()`.
+    For speed up, pass `num_parallel_calls` > 2. Documents are cut into
+    about `chunks_per_call` chunks per process with a similar number of
+    tokens each, and the processes pull chunks (largest first) until none
+    is left, so one chunk of long documents does not hold up the others.
+    Summaries are dumped to a temporary workspace of their own for every
+    call (pass `workspace_dir="/dev/shm"` to keep it in RAM), so one
+    evaluator can serve concurrent calls from several threads. To score a
+    stream of batches, `run_evaluations` dumps the next batch while ROUGE
+    scores the current one.
+
+    ROUGE is run with `-d` and scores are averaged over the per-document
+    scores it prints, so results do not depend on how documents were
+    chunked. Documents with an empty answer are skipped, as ROUGE does.
+
+    With `backend="python"`, documents are scored in-process by
+    `Rouge155Scorer`, a port of the perl script that gives the same
+    per-document scores, without perl, temporary files or (with
+    `num_parallel_calls=1`) worker processes. It raises ValueError for
+    `rouge_args` it does not implement.
+
+    With `num_parallel_calls="auto"`, a few documents are scored in-process
+    first to estimate the cost of the others. Cheap batches are then scored
+    in-process. Otherwise up to one process per available CPU is used.
+
+    With `per_document=True`, `run_evaluation` returns, for every ROUGE
+    type ROUGE reports, an `AggregateScore` whose mid is the mean over
+    documents and whose low/high are bootstrap confidence bounds over all
+    documents, plus the per-document scores under 'per_document' (NaN for
+    skipped documents). Resampling is seeded with `seed`, so intervals are
+    the same from run to run. Scores are 0 when every document is skipped.
 
     Sample usage:
         evaluator = language_evaluation.Rouge155Evaluator(
@@ -199,18 +833,38 @@ class Rouge155Evaluator(Evaluator):
             ['i am a boy . she is a girl'],
             ['i am a boy . she is not a girl'])
     """
+    # Below this, starting a ROUGE process costs more than scoring the chunk
+    MIN_CHUNK_TOKENS = 2000
+
     def __init__(self,
-                 num_parallel_calls: int = 1,
+                 num_parallel_calls: Union[int, str] = 1,
                  sentence_splitter=_period_sentence_splitter,
-                 rouge_args="-a -c 95 -m -n 2 -w 1.2"):
+                 rouge_args="-a -c 95 -m -n 2 -w 1.2",
+                 workspace_dir=None,
+                 per_document=False,
+                 confidence_interval=0.95,
+                 n_samples=1000,
+                 chunks_per_call: int = 8,
+                 backend="perl",
+                 seed=0):
+        if backend not in ("perl", "python"):
+            raise ValueError(f"Unknown Rouge155 backend {backend}")
+        _check_num_parallel_calls(num_parallel_calls)
         self._num_parallel_calls = num_parallel_calls
         self._sentence_splitter = sentence_splitter
         # Rouge arguments with rouge-related data path
+        # (-d prints per-document scores, which are merged across chunks)
         self._pyrouge_path = os.path.join(__PATH__, 'pyrouge', 'RELEASE-1.5.5')
-        self._rouge_args = f"-e {self._pyrouge_path}/data {rouge_args}"
+        self._rouge_args = f"-e {self._pyrouge_path}/data {rouge_args} -d"
+        self._per_document = per_document
+        self._confidence_interval = confidence_interval
+        self._n_samples = n_samples
+        self._seed = seed
+        self._chunks_per_call = chunks_per_call
+        self._scorer = Rouge155Scorer.from_rouge_args(rouge_args) if backend == "python" else None
 
-        # pyrouge takes input as dumpped file
-        self._tmp_path = mkdtemp()
+        # pyrouge takes input as dumpped file, in a new workspace per call
+        self._workspace_dir = workspace_dir
         self._dummy_empty_string = "dummystringforemptyprediction"
 
         # For safe html text
@@ -219,90 +873,307 @@ class Rouge155Evaluator(Evaluator):
         self._right_angled_bracket = "&gt;"
 
     def run_evaluation(self, predicts, answers):
-        ratio_in_split = \
-            self._set_output_path_and_dump_sentences(predicts, answers)
+        num_processes, (skip, probe_results) = self._plan_num_processes(predicts, answers)
+        workspace, chunks = self._prepare_workspace(predicts[skip:], answers[skip:], num_processes)
+
+        p = self._make_pool(num_processes)
+        try:
+            return self._evaluate_workspace(p, workspace, chunks, len(answers), num_processes,
+                                            skip, probe_results)
+        finally:
+            if p is not None:
+                p.close()
+                p.join()
+
+    def run_evaluations(self, batches):
+        """Evaluate an iterable of (predicts, answers) batches and yield the
+        result of `run_evaluation` for each of them, in order.
+
+        The processes are started once, and each batch is dumped in a
+        background thread while ROUGE scores the previous one. With
+        `num_parallel_calls="auto"`, processes are started for the first
+        batch that needs them, and restarted if a later batch needs more
+        (the pool has as many as the largest batch so far). Each batch is
+        cut into chunks for the processes it was planned for, and cheap
+        batches are still scored in-process.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def prepare(batch):
+            predicts, answers = batch
+            num_processes, (skip, probe_results) = self._plan_num_processes(predicts, answers)
+            workspace, chunks = self._prepare_workspace(predicts[skip:], answers[skip:], num_processes)
+            return workspace, chunks, len(answers), num_processes, skip, probe_results
+
+        batches = iter(batches)
+        p = None
+        pool_size = 1
+        if self._num_parallel_calls != "auto":
+            pool_size = self._num_parallel_calls
+            p = self._make_pool(pool_size)
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = None
+        try:
+            batch = next(batches, None)
+            future = executor.submit(prepare, batch) if batch is not None else None
+            while future is not None:
+                workspace, chunks, num_documents, num_processes, skip, probe_results = future.result()
+                future = None
+                batch = next(batches, None)
+                future = executor.submit(prepare, batch) if batch is not None else None
+                if num_processes > pool_size:
+                    if p is not None:
+                        p.close()
+                        p.join()
+                    pool_size = num_processes
+                    p = self._make_pool(pool_size)
+                yield self._evaluate_workspace(p if num_processes > 1 else None, workspace, chunks,
+                                               num_documents, num_processes, skip, probe_results)
+        finally:
+            # Remove the workspace of a batch dumped ahead but never scored
+            if future is not None and future.exception() is None and future.result()[0] is not None:
+                shutil.rmtree(future.result()[0], ignore_errors=True)
+            executor.shutdown()
+            if p is not None:
+                p.close()
+                p.join()
 
+    def _make_pool(self, num_processes):
+        # A single chunk is scored (or perl is run) from this process
+        if num_processes <= 1:
+            return None
         from multiprocessing import Pool
-        p = Pool(self._num_parallel_calls)
+        return Pool(num_processes)
+
+    def _plan_num_processes(self, predicts, answers):
+        """Number of processes, and the number of first documents "auto"
+        scores to decide, with their per-chunk results (none otherwise)."""
+        if self._num_parallel_calls != "auto":
+            return self._num_parallel_calls, (0, [])
+        if len(answers) <= _AUTO_PROBE_SIZE:
+            return 1, (0, [])
+
         import time
         start = time.time()
-        results = p.map(self._run_pyrouge, enumerate(ratio_in_split))
-        p.close()
-        p.join()
+        workspace, chunks = self._prepare_workspace(predicts[:_AUTO_PROBE_SIZE],
+                                                    answers[:_AUTO_PROBE_SIZE], 1)
+        probe_results = self._run_chunks(None, workspace, chunks)
+        num_processes = _auto_num_processes(len(answers), _AUTO_PROBE_SIZE, time.time() - start)
+        return num_processes, (_AUTO_PROBE_SIZE, probe_results)
+
+    def _prepare_workspace(self, predicts, answers, num_processes):
+        # Splitters like CachedSentenceSplitter split a whole batch at once
+        texts = list(predicts) + list(answers)
+        split_all = getattr(self._sentence_splitter, 'split_all', None)
+        if split_all is not None:
+            sentences = split_all(texts)
+        else:
+            sentences = [self._sentence_splitter(text) for text in texts]
+        documents = [self._prepare_document(predict_sentences, answer_sentences)
+                     for predict_sentences, answer_sentences
+                     in zip(sentences[:len(predicts)], sentences[len(predicts):])]
+
+        if self._scorer is not None:
+            return None, self._split_documents(predicts, answers, documents, num_processes)
+
+        workspace = mkdtemp(dir=self._workspace_dir)
+        try:
+            return workspace, self._set_output_path_and_dump_sentences(predicts, answers, documents,
+                                                                       workspace, num_processes)
+        except BaseException:
+            shutil.rmtree(workspace, ignore_errors=True)
+            raise
+
+    def _evaluate_workspace(self, p, workspace, chunks, num_documents, num_processes, skip=0,
+                            probe_results=()):
+        import time
+        start = time.time()
+        results = self._run_chunks(p, workspace, chunks)
         end = time.time()
-        print(f"Takes {end-start} seconds for Rouge155 evaluation with \
-              {self._num_parallel_calls} processes")
+        print(f"Takes {end-start} seconds for Rouge155 evaluation of {len(chunks)} chunks with \
+              {num_processes} processes")
 
-        # Average results form processes
-        averaged_result = {'rouge1': [], 'rouge2': [], 'rougeL': []}
-        for result in results:
-            for key, value in result.items():
-                averaged_result[key].append(value)
-        for key, value in averaged_result.items():
-            averaged_result[key] = sum(value)
+        # Documents were dumped after the skip documents the probe scored
+        results = list(probe_results) + [{rouge_type: (indices + skip, scores)
+                                          for rouge_type, (indices, scores) in result.items()}
+                                         for result in results]
+        per_document = self._merge_per_document(results, num_documents)
+        if self._per_document:
+            return self._aggregate_per_document(per_document)
 
-        # Cleanup
-        shutil.rmtree(self._tmp_path)
+        # Average f-measures over documents (0 if all were skipped)
+        averaged_result = {}
+        for key in ['rouge1', 'rouge2', 'rougeL']:
+            fmeasure = per_document[key][:, 2]
+            fmeasure = fmeasure[~np.isnan(fmeasure)]
+            averaged_result[key] = float(np.mean(fmeasure)) if len(fmeasure) else 0.0
 
         return averaged_result
 
-    def _set_output_path_and_dump_sentences(self, predicts, answers):
-        # Set N output paths
-        if os.path.exists(self._tmp_path):
-            shutil.rmtree(self._tmp_path)
-        os.makedirs(self._tmp_path)
-        for i in range(self._num_parallel_calls):
-            os.makedirs(os.path.join(self._tmp_path, str(i)))
-            os.makedirs(os.path.join(self._tmp_path, str(i), 'pred'))
-            os.makedirs(os.path.join(self._tmp_path, str(i), 'answer'))
-
-        # Divide sentences into N list
-        n_predicts = _split_list(predicts, self._num_parallel_calls)
-        n_answers = _split_list(answers, self._num_parallel_calls)
-        ratio_in_split = [len(n_answer) / len(answers) for n_answer in n_answers]
-
-        # Dump N-divided sentences
-        for n, (n_predict, n_answer) in enumerate(zip(n_predicts, n_answers)):
-            for i, (predict, answer) in enumerate(zip(n_predict, n_answer)):
-                predict_str = self._make_html_safe(
-                    '\n'.join(self._sentence_splitter(predict)))
-                answer_str = self._make_html_safe(
-                    '\n'.join(self._sentence_splitter(answer)))
-
-                if answer_str == '':
+    def _run_chunks(self, p, workspace, chunks):
+        run_chunk = self._run_pyrouge if self._scorer is None else self._run_python_rouge
+        try:
+            if p is None:
+                return [run_chunk(chunk) for chunk in chunks]
+            # Chunks are handed out one at a time to whichever process is free
+            return list(p.imap_unordered(run_chunk, chunks))
+        finally:
+            # Cleanup
+            if workspace is not None:
+                shutil.rmtree(workspace)
+
+    def _merge_per_document(self, results, num_documents):
+        # Scatter the per-document scores of all chunks into one array per
+        # ROUGE type, so means and intervals do not depend on the split
+        # (the default types are there even if no document was scored)
+        per_document = {rouge_type: np.full((num_documents, 3), np.nan)
+                        for rouge_type in ['rouge1', 'rouge2', 'rougeL']}
+        for result in results:
+            for rouge_type, (indices, scores) in result.items():
+                if rouge_type not in per_document:
+                    per_document[rouge_type] = np.full((num_documents, 3), np.nan)
+                per_document[rouge_type][indices] = scores
+        return per_document
+
+    def _aggregate_per_document(self, per_document):
+        aggregator = scoring.BootstrapAggregator(self._confidence_interval, self._n_samples, self._seed)
+        zero = scoring.Score(0.0, 0.0, 0.0)
+        result = {}
+        for rouge_type, scores in per_document.items():
+            scores = scores[~np.isnan(scores).any(axis=1)]
+            if len(scores) == 0:
+                result[rouge_type] = scoring.AggregateScore(low=zero, mid=zero, high=zero)
+            for score in scores:
+                aggregator.add_scores({rouge_type: scoring.Score(*score)})
+
+        for rouge_type, aggregate in aggregator.aggregate().items():
+            scores = per_document[rouge_type]
+            mean = np.mean(scores[~np.isnan(scores).any(axis=1)], axis=0)
+            result[rouge_type] = aggregate._replace(mid=scoring.Score(*mean))
+        result['per_document'] = {rouge_type: scoring.Score(*scores.T)
+                                  for rouge_type, scores in per_document.items()}
+        return result
+
+    def _split_into_chunks(self, predicts, answers, num_processes):
+        """Cut documents into consecutive chunks of about the same number of
+        tokens, about `chunks_per_call` chunks per process."""
+        num_tokens = [len(predict.split()) + len(answer.split())
+                      for predict, answer in zip(predicts, answers)]
+        if num_processes <= 1:
+            return [list(range(len(answers)))]
+        max_tokens = max(sum(num_tokens) / (num_processes * self._chunks_per_call),
+                         self.MIN_CHUNK_TOKENS)
+
+        chunks = [[]]
+        chunk_tokens = 0
+        for i, tokens in enumerate(num_tokens):
+            if chunks[-1] and chunk_tokens + tokens > max_tokens:
+                chunks.append([])
+                chunk_tokens = 0
+            chunks[-1].append(i)
+            chunk_tokens += tokens
+        return chunks
+
+    def _prepare_document(self, predict_sentences, answer_sentences):
+        """Sentences of a document as ROUGE gets them (one per line), or None
+        for an empty answer, which ROUGE cannot score."""
+        predict_str = self._make_html_safe('\n'.join(predict_sentences))
+        answer_str = self._make_html_safe('\n'.join(answer_sentences))
+
+        if answer_str == '':
+            return None
+        if predict_str == '':
+            predict_str = self._dummy_empty_string
+        return predict_str, answer_str
+
+    def _split_documents(self, predicts, answers, documents, num_processes):
+        # Chunks of (predict sentences, [answer sentences]) for Rouge155Scorer
+        chunks = []
+        for indices in self._split_into_chunks(predicts, answers, num_processes):
+            peers = []
+            models_list = []
+            document_indices = []
+            num_tokens = 0
+            for i in indices:
+                document = documents[i]
+                if document is None:
                     continue
-                if predict_str == '':
-                    predict_str = self._dummy_empty_string
-
-                pred_fname = os.path.join(
-                    self._tmp_path, f"{n}/pred/pred{i}.txt")
-                answer_fname = os.path.join(
-                    self._tmp_path, f"{n}/answer/answer{i}.txt")
-                with open(pred_fname, 'w') as fp:
-                    fp.write(predict_str)
-                with open(answer_fname, 'w') as fp:
-                    fp.write(answer_str)
-
-        return ratio_in_split
-
-    def _run_pyrouge(self, idx_and_ratio):
-        process_idx, ratio = idx_and_ratio
+                predict_str, answer_str = document
+                peers.append(predict_str.split('\n'))
+                models_list.append([answer_str.split('\n')])
+                document_indices.append(i)
+                num_tokens += len(predict_str.split()) + len(answer_str.split())
+            if peers:
+                chunks.append((peers, models_list, document_indices, num_tokens))
+
+        chunks.sort(key=lambda chunk: chunk[3], reverse=True)
+        return chunks
+
+    def _set_output_path_and_dump_sentences(self, predicts, answers, documents, workspace,
+                                            num_processes):
+        # Dump each chunk directly in the HTML format ROUGE reads, and keep
+        # the list of written files (and their document indices) for the
+        # config file
+        chunks = []
+        for indices in self._split_into_chunks(predicts, answers, num_processes):
+            n = len(chunks)
+            os.makedirs(os.path.join(workspace, str(n), 'pred'))
+            os.makedirs(os.path.join(workspace, str(n), 'answer'))
+
+            files = []
+            file_indices = []
+            num_tokens = 0
+            for i in indices:
+                document = documents[i]
+                if document is None:
+                    continue
+                predict_str, answer_str = document
+
+                pred_fname = f"pred{i}.html"
+                answer_fname = f"answer{i}.html"
+                with open(os.path.join(workspace, f"{n}/pred", pred_fname), 'w') as fp:
+                    fp.write(Rouge155.convert_text_to_rouge_format(predict_str))
+                with open(os.path.join(workspace, f"{n}/answer", answer_fname), 'w') as fp:
+                    fp.write(Rouge155.convert_text_to_rouge_format(answer_str))
+                files.append((pred_fname, [answer_fname]))
+                file_indices.append(i)
+                num_tokens += len(predict_str.split()) + len(answer_str.split())
+
+            # ROUGE fails on a config without documents
+            if files:
+                chunks.append((os.path.join(workspace, str(n)), files, file_indices, num_tokens))
+
+        # Largest chunks first, so small ones fill the gaps at the end
+        chunks.sort(key=lambda chunk: chunk[3], reverse=True)
+        return chunks
+
+    def _run_pyrouge(self, chunk):
+        chunk_path, files, indices, _ = chunk
         r = Rouge155(rouge_dir=self._pyrouge_path)
-        r.system_dir = os.path.join(self._tmp_path, str(process_idx), 'pred')
-        r.model_dir = os.path.join(self._tmp_path, str(process_idx), 'answer')
-        r.system_filename_pattern = 'pred(\d+).txt'
-        r.model_filename_pattern = 'answer#ID#.txt'
-        rouge_results = r.convert_and_evaluate(rouge_args=self._rouge_args)
-        rouge_results = r.output_to_dict(rouge_results)
-        result_dict = {'rouge1': rouge_results['rouge_1_f_score'] * ratio,
-                       'rouge2': rouge_results['rouge_2_f_score'] * ratio,
-                       'rougeL': rouge_results['rouge_l_f_score'] * ratio}
-
-        # Cleanup
-        shutil.rmtree(r._config_dir)
-        shutil.rmtree(r._output_dir)
-
-        return result_dict
+        r.system_dir = os.path.join(chunk_path, 'pred')
+        r.model_dir = os.path.join(chunk_path, 'answer')
+        rouge_results = r.evaluate_files(
+            files, os.path.join(chunk_path, 'rouge_conf.xml'),
+            rouge_args=self._rouge_args, stream=True)
+        return self._per_document_arrays(r.output_to_per_doc_dict(rouge_results), indices)
+
+    def _run_python_rouge(self, chunk):
+        peers, models_list, indices, _ = chunk
+        return self._per_document_arrays(self._scorer.score_documents(peers, models_list), indices)
+
+    def _per_document_arrays(self, rouge_results, indices):
+        """Turn {rouge_type: {eval_id: (R, P, F)}} into {rougeX: (document
+        indices, (num_documents, 3) array of precision, recall, f-measure)}.
+        Eval ids are the 1-based positions in the config file."""
+        arrays = {}
+        for rouge_type, scores in rouge_results.items():
+            eval_ids = sorted(scores, key=int)
+            recall_precision_f = np.array([scores[eval_id] for eval_id in eval_ids])
+            document_indices = np.array([indices[int(eval_id) - 1] for eval_id in eval_ids], dtype=np.int64)
+            # rouge_1 -> rouge1, rouge_l -> rougeL, rouge_w_1.2 -> rougeW, rouge_su4 -> rougeSU4
+            name = "rouge" + rouge_type.split('_')[1].upper()
+            arrays[name] = (document_indices, recall_precision_f[:, [1, 0, 2]])
+        return arrays
 
     def _make_html_safe(self, sentence):
         """Replace any angled brackets in string to avoid interfering with HTML
@@ -8,7 +8,11 @@
 # Last Modified : Thu 19 Mar 2015 09:13:28 PM PDT
 # Authors : Hao Fang <hfang@uw.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
-from .bleu_scorer import BleuScorer
+import numpy as np
+
+from .bleu_scorer import BleuScorer, single_reflen, bleu_from_counts
+from ..stats import make_stats, check_stats
+from ..reference_store import StoredReferences
 
 
 class Bleu:
@@ -20,6 +24,63 @@ class Bleu:
 
     def compute_score(self, gts, res):
 
+        bleu_scorer = self._cook(gts, res)
+
+        #score, scores = bleu_scorer.compute_score(option='shortest')
+        score, scores = bleu_scorer.compute_score(option='closest', verbose=1)
+        #score, scores = bleu_scorer.compute_score(option='average', verbose=1)
+
+        # return (bleu, bleu_info)
+        return score, scores
+
+    def partial(self, gts, res, per_image=True):
+        """
+        Sufficient statistics of a shard: clipped matches, guesses and lengths.
+        Corpus totals are always kept; per-image counts only with per_image.
+        """
+        ctest = self._cook(gts, res).ctest
+        testlen = np.array([comps['testlen'] for comps in ctest], dtype=np.int64)
+        reflen = np.array([single_reflen(comps['reflen'], 'closest', comps['testlen'])
+                           for comps in ctest], dtype=np.int64)
+        guess = np.array([comps['guess'] for comps in ctest], dtype=np.int64).reshape(-1, self._n)
+        correct = np.array([comps['correct'] for comps in ctest], dtype=np.int64).reshape(-1, self._n)
+        stats = make_stats("BLEU", n=self._n, num_images=len(ctest),
+                           testlen=int(testlen.sum()), reflen=int(reflen.sum()),
+                           guess=guess.sum(axis=0), correct=correct.sum(axis=0))
+        if per_image:
+            stats['images'] = {'testlen': testlen, 'reflen': reflen, 'guess': guess, 'correct': correct}
+        return stats
+
+    def merge(self, *partials):
+        """
+        Corpus and per-image BLEU from the stats of all shards (in shard order).
+        Per-image scores are None unless every shard kept them.
+        """
+        testlen, reflen = 0, 0
+        guess, correct = np.zeros(self._n, dtype=np.int64), np.zeros(self._n, dtype=np.int64)
+        for stats in partials:
+            check_stats(stats, "BLEU")
+            assert stats['n'] == self._n, "incompatible BLEUs."
+            testlen += stats['testlen']
+            reflen += stats['reflen']
+            guess += stats['guess']
+            correct += stats['correct']
+        score = bleu_from_counts(correct.tolist(), guess.tolist(), testlen, reflen, self._n)
+
+        if not all('images' in stats for stats in partials):
+            return score, None
+        scores = [[] for _ in range(self._n)]
+        for stats in partials:
+            images = stats['images']
+            for i in range(stats['num_images']):
+                bleus = bleu_from_counts(images['correct'][i].tolist(), images['guess'][i].tolist(),
+                                         int(images['testlen'][i]), int(images['reflen'][i]), self._n)
+                for k in range(self._n):
+                    scores[k].append(bleus[k])
+        return score, scores
+
+    def _cook(self, gts, res):
+
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
 
@@ -31,17 +92,12 @@ class Bleu:
             # Sanity check.
             assert(type(hypo) is list)
             assert(len(hypo) == 1)
-            assert(type(ref) is list)
+            assert(isinstance(ref, (list, StoredReferences)))
             assert(len(ref) >= 1)
 
             bleu_scorer += (hypo[0], ref)
 
-        #score, scores = bleu_scorer.compute_score(option='shortest')
-        score, scores = bleu_scorer.compute_score(option='closest', verbose=1)
-        #score, scores = bleu_scorer.compute_score(option='average', verbose=1)
-
-        # return (bleu, bleu_info)
-        return score, scores
+        return bleu_scorer
 
     def method(self):
         return "Bleu"
@@ -14,28 +14,33 @@
 '''Provides:
 cook_refs(refs, n=4): Transform a list of reference sentences as strings into a form usable by cook_test().
 cook_test(test, refs, n=4): Transform a test sentence as a string (together with the cooked reference sentences) into a form usable by score_cooked().
+BleuAccumulator: Fold cooked sentences into running corpus totals for streaming BLEU.
 '''
 
 import copy
 import sys, math, re
-from collections import defaultdict
+
+from ..ngrams import count_ngrams, PreparedReferences
+from ..reference_store import StoredReferences
 
 def precook(s, n=4, out=False):
     """Takes a string as input and returns an object that can be given to
     either cook_refs or cook_test. This is optional: cook_refs and cook_test
-    can take string arguments as well."""
-    words = s.split()
-    counts = defaultdict(int)
-    for k in range(1, n+1):
-        for i in range(len(words)-k+1):
-            ngram = tuple(words[i:i+k])
-            counts[ngram] += 1
-    return (len(words), counts)
+    can take string arguments as well.
+    Counts of a CookedCaption are reused, not recounted."""
+    return count_ngrams(s, n)
 
 def cook_refs(refs, eff=None, n=4): ## lhuang: oracle will call with "average"
     '''Takes a list of reference sentences for a single segment
     and returns an object that encapsulates everything that BLEU
-    needs to know about them.'''
+    needs to know about them.
+    References already held in a ReferenceStore are returned as is, and
+    those of PreparedReferences are cooked already.'''
+
+    if isinstance(refs, StoredReferences):
+        return refs
+    if isinstance(refs, PreparedReferences) and refs.bleu is not None and eff is None and n == refs.n:
+        return refs.bleu
 
     reflen = []
     maxcounts = {}
@@ -61,6 +66,9 @@ def cook_test(test, refs, eff=None, n=4):
     '''Takes a test sentence and returns an object that
     encapsulates everything that BLEU needs to know about it.'''
 
+    if isinstance(refs, StoredReferences):
+        return refs.cook_bleu_test(test, eff, n)
+
     reflen, refmaxcounts = refs
     testlen, counts = precook(test, n, True)
 
@@ -83,6 +91,108 @@ def cook_test(test, refs, eff=None, n=4):
 
     return result
 
+def single_reflen(reflens, option=None, testlen=None):
+    '''Effective reference length of one segment under the given option.'''
+
+    if option == "shortest":
+        reflen = min(reflens)
+    elif option == "average":
+        reflen = float(sum(reflens))/len(reflens)
+    elif option == "closest":
+        reflen = min((abs(l-testlen), l) for l in reflens)[1]
+    else:
+        assert False, "unsupported reflen option %s" % option
+
+    return reflen
+
+def bleu_from_counts(correct, guess, testlen, reflen, n=4):
+    '''BLEU-1..n from clipped matches, guesses and lengths, as in BleuScorer.compute_score.'''
+
+    small = 1e-9
+    tiny = 1e-15 ## so that if guess is 0 still return 0
+
+    bleus = []
+    bleu = 1.
+    for k in range(n):
+        bleu *= float(correct[k] + tiny) \
+                / (guess[k] + small)
+        bleus.append(bleu ** (1./(k+1)))
+    ratio = (testlen + tiny) / (reflen + small) ## N.B.: avoid zero division
+    if ratio < 1:
+        for k in range(n):
+            bleus[k] *= math.exp(1 - 1/ratio)
+    return bleus
+
+class BleuAccumulator(object):
+    """Streaming corpus BLEU.
+
+    Each added sentence is cooked against its references and folded into
+    running totals (clipped matches and guesses per order, test length and
+    effective reference length), then dropped. `score()` reports the corpus
+    BLEU-1..n of everything added so far without rescoring. Per-sentence
+    scores can optionally be written to `sentence_file`, one line each.
+
+    Sample usage:
+        accumulator = BleuAccumulator(n=4)
+        for hypos, refs in batches:
+            accumulator.add_batch(hypos, refs)
+            print(accumulator.score())
+    """
+
+    def __init__(self, n=4, option="closest", sentence_file=None):
+        self.n = n
+        self.option = option
+        self.count = 0
+        self.testlen = 0
+        self.reflen = 0
+        self.guess = [0]*n
+        self.correct = [0]*n
+        self._sentence_file = open(sentence_file, 'w') if sentence_file else None
+
+    def add(self, test, refs):
+        '''Fold one test sentence and its reference sentences into the totals.'''
+
+        comps = cook_test(test, cook_refs(refs, n=self.n), n=self.n)
+        testlen = comps['testlen']
+        reflen = single_reflen(comps['reflen'], self.option, testlen)
+
+        self.count += 1
+        self.testlen += testlen
+        self.reflen += reflen
+        for k in range(self.n):
+            self.guess[k] += comps['guess'][k]
+            self.correct[k] += comps['correct'][k]
+
+        if self._sentence_file is not None:
+            bleus = bleu_from_counts(comps['correct'], comps['guess'], testlen, reflen, self.n)
+            self._sentence_file.write(' '.join(repr(b) for b in bleus) + '\n')
+
+        return self
+
+    def add_batch(self, tests, refs_list):
+        for test, refs in zip(tests, refs_list):
+            self.add(test, refs)
+        return self
+
+    def __iadd__(self, other):
+        '''add a (test, refs) pair.'''
+        return self.add(other[0], other[1])
+
+    def score(self):
+        '''Corpus BLEU-1..n over all sentences added so far.'''
+        return bleu_from_counts(self.correct, self.guess, self.testlen, self.reflen, self.n)
+
+    def close(self):
+        if self._sentence_file is not None:
+            self._sentence_file.close()
+            self._sentence_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 class BleuScorer(object):
     """Bleu scorer.
     """
@@ -180,17 +290,7 @@ class BleuScorer(object):
         return self._single_reflen(self.crefs[0][0], option)
 
     def _single_reflen(self, reflens, option=None, testlen=None):
-
-        if option == "shortest":
-            reflen = min(reflens)
-        elif option == "average":
-            reflen = float(sum(reflens))/len(reflens)
-        elif option == "closest":
-            reflen = min((abs(l-testlen), l) for l in reflens)[1]
-        else:
-            assert False, "unsupported reflen option %s" % option
-
-        return reflen
+        return single_reflen(reflens, option, testlen)
 
     def recompute_score(self, option=None, verbose=0):
         self._score = None
@@ -198,8 +298,6 @@ class BleuScorer(object):
 
     def compute_score(self, option=None, verbose=0):
         n = self.n
-        small = 1e-9
-        tiny = 1e-15 ## so that if guess is 0 still return 0
         bleu_list = [[] for _ in range(n)]
 
         if self._score is not None:
@@ -229,15 +327,8 @@ class BleuScorer(object):
                     totalcomps[key][k] += comps[key][k]
 
             # append per image bleu score
-            bleu = 1.
-            for k in range(n):
-                bleu *= (float(comps['correct'][k]) + tiny) \
-                        /(float(comps['guess'][k]) + small)
-                bleu_list[k].append(bleu ** (1./(k+1)))
-            ratio = (testlen + tiny) / (reflen + small) ## N.B.: avoid zero division
-            if ratio < 1:
-                for k in range(n):
-                    bleu_list[k][-1] *= math.exp(1 - 1/ratio)
+            for k, bleu in enumerate(bleu_from_counts(comps['correct'], comps['guess'], testlen, reflen, n)):
+                bleu_list[k].append(bleu)
 
             if verbose > 1:
                 print(comps, reflen)
@@ -245,20 +336,11 @@ class BleuScorer(object):
         totalcomps['reflen'] = self._reflen
         totalcomps['testlen'] = self._testlen
 
-        bleus = []
-        bleu = 1.
-        for k in range(n):
-            bleu *= float(totalcomps['correct'][k] + tiny) \
-                    / (totalcomps['guess'][k] + small)
-            bleus.append(bleu ** (1./(k+1)))
-        ratio = (self._testlen + tiny) / (self._reflen + small) ## N.B.: avoid zero division
-        if ratio < 1:
-            for k in range(n):
-                bleus[k] *= math.exp(1 - 1/ratio)
+        bleus = bleu_from_counts(totalcomps['correct'], totalcomps['guess'], self._testlen, self._reflen, n)
 
         if verbose > 0:
             print(totalcomps)
-            print("ratio:", ratio)
+            print("ratio:", (self._testlen + 1e-15) / (self._reflen + 1e-9))
 
         self._score = bleus
         return self._score, bleu_list
@@ -7,7 +7,11 @@
 #
 # Authors: Ramakrishna Vedantam <vrama91@vt.edu> and Tsung-Yi Lin <tl483@cornell.edu>
 
-from .cider_scorer import CiderScorer
+from collections import defaultdict
+import numpy as np
+from .cider_scorer import CiderScorer, cook_refs
+from ..reference_store import StoredReferences
+from ..stats import make_stats, check_stats
 import pdb
 
 class Cider:
@@ -29,6 +33,68 @@ class Cider:
         :return: cider (float) : computed CIDEr score for the corpus
         """
 
+        (score, scores) = self._cook(gts, res).compute_score()
+
+        return score, scores
+
+    def partial_doc_freq(self, gts):
+        """
+        First phase of sharded CIDEr: document frequency of a shard of references
+        :param gts (dict) : dictionary with key <image> and value <tokenized reference sentence>
+        :return: stats (dict) : n-gram (space-joined tokens or token ids) -> number of images in the shard that contain it
+        """
+        cider_scorer = CiderScorer(n=self._n, sigma=self._sigma)
+        for ref in gts.values():
+            cider_scorer.crefs.append(cook_refs(ref, self._n))
+        cider_scorer.compute_doc_freq()
+        document_frequency = {' '.join(map(str, ngram)): count
+                              for ngram, count in cider_scorer.document_frequency.items()}
+        # n-grams of captions given as token ids are tuples of int
+        first_ngram = next(iter(cider_scorer.document_frequency), ('',))
+        token_ids = not isinstance(first_ngram[0], str)
+        return make_stats("CIDEr-df", n=self._n, num_images=len(gts),
+                          document_frequency=document_frequency, token_ids=token_ids)
+
+    def merge_doc_freq(self, *partials):
+        """
+        Sum the document frequencies of all shards
+        :return: stats (dict) : document frequency of the whole corpus, to be passed to partial
+        """
+        num_images = 0
+        token_ids = False
+        document_frequency = defaultdict(float)
+        for stats in partials:
+            check_stats(stats, "CIDEr-df")
+            num_images += stats['num_images']
+            token_ids = token_ids or stats.get('token_ids', False)
+            for ngram, count in stats['document_frequency'].items():
+                document_frequency[ngram] += count
+        return make_stats("CIDEr-df", n=self._n, num_images=num_images,
+                          document_frequency=dict(document_frequency), token_ids=token_ids)
+
+    def partial(self, gts, res, doc_freq):
+        """
+        Second phase of sharded CIDEr: per-image scores of a shard against the corpus document frequency
+        :param doc_freq (dict) : stats returned by merge_doc_freq
+        :return: stats (dict)
+        """
+        check_stats(doc_freq, "CIDEr-df")
+        to_token = int if doc_freq.get('token_ids', False) else str
+        document_frequency = {tuple(map(to_token, ngram.split(' '))): count
+                              for ngram, count in doc_freq['document_frequency'].items()}
+        (_, scores) = self._cook(gts, res).compute_score(
+            document_frequency=document_frequency, num_images=doc_freq['num_images'])
+        return make_stats("CIDEr", n=self._n, sigma=self._sigma, scores=scores)
+
+    def merge(self, *partials):
+        """
+        Concatenate per-image scores of all shards (in shard order)
+        :return: cider (float), scores (np.array)
+        """
+        scores = np.concatenate([check_stats(stats, "CIDEr")['scores'] for stats in partials])
+        return np.mean(scores), scores
+
+    def _cook(self, gts, res):
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
 
@@ -41,14 +107,12 @@ class Cider:
             # Sanity check.
             assert(type(hypo) is list)
             assert(len(hypo) == 1)
-            assert(type(ref) is list)
+            assert(isinstance(ref, (list, StoredReferences)))
             assert(len(ref) > 0)
 
             cider_scorer += (hypo[0], ref)
 
-        (score, scores) = cider_scorer.compute_score()
-
-        return score, scores
+        return cider_scorer
 
     def method(self):
         return "CIDEr"
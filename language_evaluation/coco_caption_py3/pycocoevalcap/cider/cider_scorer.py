@@ -8,6 +8,9 @@ import numpy as np
 import pdb
 import math
 
+from ..ngrams import count_ngrams, PreparedReferences, CiderReferences
+from ..reference_store import StoredReferences
+
 def precook(s, n=4, out=False):
     """
     Takes a string as input and returns an object that can be given to
@@ -15,15 +18,9 @@ def precook(s, n=4, out=False):
     can take string arguments as well.
     :param s: string : sentence to be converted into ngrams
     :param n: int    : number of ngrams for which representation is calculated
-    :return: term frequency vector for occuring ngrams
+    :return: term frequency vector for occuring ngrams (shared with BLEU for a CookedCaption)
     """
-    words = s.split()
-    counts = defaultdict(int)
-    for k in range(1,n+1):
-        for i in range(len(words)-k+1):
-            ngram = tuple(words[i:i+k])
-            counts[ngram] += 1
-    return counts
+    return count_ngrams(s, n)[1]
 
 def cook_refs(refs, n=4): ## lhuang: oracle will call with "average"
     '''Takes a list of reference sentences for a single segment
@@ -31,8 +28,12 @@ def cook_refs(refs, n=4): ## lhuang: oracle will call with "average"
     needs to know about them.
     :param refs: list of string : reference sentences for some image
     :param n: int : number of ngrams for which (ngram) representation is calculated
-    :return: result (list of dict)
+    :return: result (list of dict), or refs itself if it is held in a ReferenceStore
     '''
+    if isinstance(refs, StoredReferences):
+        return refs
+    if isinstance(refs, PreparedReferences) and refs.cider is not None and n == refs.n:
+        return refs.cider
     return [precook(ref, n) for ref in refs]
 
 def cook_test(test, n=4):
@@ -90,6 +91,18 @@ class CiderScorer(object):
             self.crefs.extend(other.crefs)
 
         return self
+    def _prepared_doc_freq(self):
+        # document frequency shared by the CiderReferences of every image, when they are all the images it counts
+        if not self.crefs or not isinstance(self.crefs[0], CiderReferences):
+            return None
+        document_frequency = self.crefs[0].document_frequency
+        if self.crefs[0].num_images != len(self.crefs):
+            return None
+        if any(not isinstance(refs, CiderReferences) or refs.document_frequency is not document_frequency
+               for refs in self.crefs):
+            return None
+        return document_frequency
+
     def compute_doc_freq(self):
         '''
         Compute term frequency for reference data.
@@ -103,32 +116,35 @@ class CiderScorer(object):
                 self.document_frequency[ngram] += 1
             # maxcounts[ngram] = max(maxcounts.get(ngram,0), count)
 
-    def compute_cider(self):
-        def counts2vec(cnts):
-            """
-            Function maps counts of ngram to vector of tfidf weights.
-            The function returns vec, an array of dictionary that store mapping of n-gram and tf-idf weights.
-            The n-th entry of array denotes length of n-grams.
-            :param cnts:
-            :return: vec (array of dict), norm (array of float), length (int)
-            """
-            vec = [defaultdict(float) for _ in range(self.n)]
-            length = 0
-            norm = [0.0 for _ in range(self.n)]
-            for (ngram,term_freq) in cnts.items():
-                # give word count 1 if it doesn't appear in reference corpus
-                df = np.log(max(1.0, self.document_frequency[ngram]))
-                # ngram index
-                n = len(ngram)-1
-                # tf (term_freq) * idf (precomputed idf) for n-grams
-                vec[n][ngram] = float(term_freq)*(self.ref_len - df)
-                # compute norm for the vector.  the norm will be used for computing similarity
-                norm[n] += pow(vec[n][ngram], 2)
+    def counts2vec(self, cnts):
+        """
+        Function maps counts of ngram to vector of tfidf weights.
+        The function returns vec, an array of dictionary that store mapping of n-gram and tf-idf weights.
+        The n-th entry of array denotes length of n-grams.
+        :param cnts:
+        :return: vec (array of dict), norm (array of float), length (int)
+        """
+        vec = [defaultdict(float) for _ in range(self.n)]
+        length = 0
+        norm = [0.0 for _ in range(self.n)]
+        for (ngram,term_freq) in cnts.items():
+            # give word count 1 if it doesn't appear in reference corpus
+            # (get, so that a document frequency shared by PreparedReferences is not modified)
+            df = np.log(max(1.0, self.document_frequency.get(ngram, 0.0)))
+            # ngram index
+            n = len(ngram)-1
+            # tf (term_freq) * idf (precomputed idf) for n-grams
+            vec[n][ngram] = float(term_freq)*(self.ref_len - df)
+            # compute norm for the vector.  the norm will be used for computing similarity
+            norm[n] += pow(vec[n][ngram], 2)
 
-                if n == 1:
-                    length += term_freq
-            norm = [np.sqrt(n) for n in norm]
-            return vec, norm, length
+            if n == 1:
+                length += term_freq
+        norm = [np.sqrt(n) for n in norm]
+        return vec, norm, length
+
+    def compute_cider(self, num_images=None):
+        counts2vec = self.counts2vec
 
         def sim(vec_hyp, vec_ref, norm_hyp, norm_ref, length_hyp, length_ref):
             '''
@@ -159,7 +175,10 @@ class CiderScorer(object):
             return val
 
         # compute log reference length
-        self.ref_len = np.log(float(len(self.crefs)))
+        # (num_images is the corpus size when this scorer only holds a shard of it)
+        if num_images is None:
+            num_images = len(self.crefs)
+        self.ref_len = np.log(float(num_images))
 
         scores = []
         for test, refs in zip(self.ctest, self.crefs):
@@ -167,8 +186,11 @@ class CiderScorer(object):
             vec, norm, length = counts2vec(test)
             # compute vector for ref captions
             score = np.array([0.0 for _ in range(self.n)])
-            for ref in refs:
-                vec_ref, norm_ref, length_ref = counts2vec(ref)
+            if isinstance(refs, CiderReferences) and refs.document_frequency is self.document_frequency:
+                ref_vectors = refs.vectors
+            else:
+                ref_vectors = [counts2vec(ref) for ref in refs]
+            for vec_ref, norm_ref, length_ref in ref_vectors:
                 score += sim(vec, vec_ref, norm, norm_ref, length, length_ref)
             # change by vrama91 - mean of ngram scores, instead of sum
             score_avg = np.mean(score)
@@ -180,13 +202,84 @@ class CiderScorer(object):
             scores.append(score_avg)
         return scores
 
-    def compute_score(self, option=None, verbose=0):
-        # compute idf
-        self.compute_doc_freq()
-        # assert to check document frequency
-        assert(len(self.ctest) >= max(self.document_frequency.values()))
+    def compute_cider_stored(self):
+        '''
+        Same as compute_cider, for references held in a ReferenceStore.
+        Reference vectors are built from the store's packed arrays and
+        matched against the test n-grams by n-gram id.
+        :return: scores (list of float)
+        '''
+        store = self.crefs[0].store
+        assert all(refs.store is store for refs in self.crefs), "references come from different stores"
+        df = store.document_frequency([refs.row for refs in self.crefs])
+        self.ref_len = np.log(float(len(self.crefs)))
+
+        scores = []
+        for test, refs in zip(self.ctest, self.crefs):
+            # compute vector for test captions, keeping only n-grams the store knows for matching
+            ids, weights, orders = [], [], []
+            norm = np.zeros(self.n)
+            length = 0
+            for (ngram,term_freq), ngram_id in zip(test.items(), store.ngram_ids(list(test))):
+                n = len(ngram)-1
+                df_ngram = df[ngram_id] if ngram_id is not None else 0.0
+                weight = float(term_freq)*(self.ref_len - np.log(max(1.0, df_ngram)))
+                norm[n] += pow(weight, 2)
+                if n == 1:
+                    length += term_freq
+                if ngram_id is not None:
+                    ids.append(ngram_id)
+                    weights.append(weight)
+                    orders.append(n)
+            norm = np.sqrt(norm)
+            ids = np.array(ids, dtype=np.int32)
+
+            score = np.zeros(self.n)
+            for vec_ref, weights_ref, _, norm_ref, length_ref in store.ref_vectors(refs.row, df, self.ref_len, self.n):
+                _, hyp_idx, ref_idx = np.intersect1d(ids, vec_ref, assume_unique=True, return_indices=True)
+                # add the products of matching n-grams in the order of the test n-grams, and divide
+                # order by order, as sim in compute_cider does (the other n-grams would add 0.0)
+                matches = np.argsort(hyp_idx)
+                val = np.array([0.0 for _ in range(self.n)])
+                for h, weight_ref in zip(hyp_idx[matches].tolist(), weights_ref[ref_idx[matches]].tolist()):
+                    # vrama91 : added clipping
+                    val[orders[h]] += min(weights[h], weight_ref) * weight_ref
+                delta = float(length - length_ref)
+                for n in range(self.n):
+                    if (norm[n] != 0) and (norm_ref[n] != 0):
+                        val[n] /= (norm[n]*norm_ref[n])
+                    # vrama91: added a length based gaussian penalty
+                    val[n] *= np.e**(-(delta**2)/(2*self.sigma**2))
+                score += val
+            score_avg = np.mean(score)
+            score_avg /= len(refs)
+            score_avg *= 10.0
+            scores.append(score_avg)
+        return scores
+
+    def compute_score(self, option=None, verbose=0, document_frequency=None, num_images=None):
+        '''
+        Compute CIDEr for the cooked sentences.
+        :param document_frequency: dict : precomputed document frequency of the whole corpus,
+                                          used when this scorer holds only a shard of it
+        :param num_images: int : number of images in the whole corpus
+        :return: score (float), scores (np.array)
+        '''
+        if self.crefs and isinstance(self.crefs[0], StoredReferences):
+            score = self.compute_cider_stored()
+            return np.mean(np.array(score)), np.array(score)
+        if document_frequency is None and self._prepared_doc_freq() is not None:
+            # references prepared for this whole corpus, with their vectors
+            self.document_frequency = self._prepared_doc_freq()
+        elif document_frequency is None:
+            # compute idf
+            self.compute_doc_freq()
+            # assert to check document frequency
+            assert(len(self.ctest) >= max(self.document_frequency.values()))
+        else:
+            self.document_frequency = defaultdict(float, document_frequency)
         # compute cider score
-        score = self.compute_cider()
+        score = self.compute_cider(num_images)
         # debug
         # print score
         return np.mean(np.array(score)), np.array(score)
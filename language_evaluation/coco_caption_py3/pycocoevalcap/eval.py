@@ -1,10 +1,18 @@
 __author__ = 'tylin'
+from multiprocessing import Pool
+
+import numpy as np
+
 from .tokenizer.ptbtokenizer import PTBTokenizer
 from .bleu.bleu import Bleu
 from .meteor.meteor import Meteor
-from .rouge.rouge import Rouge
+from .rouge.rouge import Rouge, _split
 from .cider.cider import Cider
 from .spice.spice import Spice
+from .ngrams import cook_captions, PreparedReferences, CiderReferences
+from .bleu.bleu_scorer import cook_refs as bleu_cook_refs
+from .cider.cider_scorer import CiderScorer, cook_refs as cider_cook_refs
+from .reference_store import ReferenceStore
 
 _COCO_TYPE_TO_METRIC = {
     "BLEU": (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
@@ -14,8 +22,71 @@ _COCO_TYPE_TO_METRIC = {
     "SPICE": (Spice(), "SPICE"),
 }
 
+def _split_keys(keys, num_shards):
+    # contiguous shards, so concatenating shard results keeps the image order
+    keys = list(keys)
+    size, rest = divmod(len(keys), num_shards)
+    shards, start = [], 0
+    for i in range(num_shards):
+        end = start + size + (1 if i < rest else 0)
+        shards.append(keys[start:end])
+        start = end
+    return shards
+
+def _bucket_by_cost(costs, num_buckets):
+    # indices sorted by decreasing cost, cut into about num_buckets buckets of
+    # similar total cost, so the most expensive items are dispatched first
+    order = sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+    max_cost = sum(costs) / max(num_buckets, 1)
+    buckets, bucket_cost = [], 0
+    for i in order:
+        if not buckets or bucket_cost + costs[i] > max_cost:
+            buckets.append([])
+            bucket_cost = 0
+        buckets[-1].append(i)
+        bucket_cost += costs[i]
+    return buckets
+
+def _lcs_cost(candidate_length, reference_lengths):
+    # dynamic programming LCS fills (len(candidate) + 1) * (len(reference) + 1) cells
+    return sum((candidate_length + 1) * (length + 1) for length in reference_lengths)
+
+def _call_scorer(args):
+    scorer, method, method_args = args
+    return getattr(scorer, method)(*method_args)
+
+# metrics that expose partial()/merge() over sufficient statistics
+_MERGEABLE_COCO_TYPES = ("BLEU", "METEOR", "ROUGE_L", "CIDEr")
+# metrics whose partial() is pure python, so it can run in a process pool
+_SHARDED_COCO_TYPES = ("BLEU", "ROUGE_L", "CIDEr")
+# metrics that count the same 1..4-grams of every caption (see ngrams.CookedCaption)
+_NGRAM_COCO_TYPES = ("BLEU", "CIDEr")
+# metrics that only score strings, so captions given as token ids are decoded for them
+_STRING_COCO_TYPES = ("METEOR", "SPICE")
+# metrics whose cost is quadratic in the lengths, so images are bucketed by
+# cost rather than sharded contiguously (their merge() concatenates scores)
+_BUCKETED_COCO_TYPES = ("ROUGE_L",)
+_BUCKETS_PER_WORKER = 4
+
+def merge_stats(cocoTypes, partials):
+    """
+    Merge the stats returned by COCOEvalCap.partial for every shard (in shard order)
+    :return: eval (dict) : same as COCOEvalCap.eval after evaluate() on the whole corpus
+    """
+    result = {}
+    for coco_type in cocoTypes:
+        scorer, method = _COCO_TYPE_TO_METRIC[coco_type]
+        score, _ = scorer.merge(*[partial[coco_type] for partial in partials])
+        if type(method) == list:
+            for sc, m in zip(score, method):
+                result[m] = sc
+        else:
+            result[method] = score
+    return result
+
 class COCOEvalCap:
-    def __init__(self, coco, cocoRes, cocoTypes, tokenization_fn=None, verbose=True):
+    def __init__(self, coco, cocoRes, cocoTypes, tokenization_fn=None, verbose=True, num_workers=1,
+                 rouge_max_band=None, vocab=None, references=None):
         self.evalImgs = []
         self.eval = {}
         self.imgToEval = {}
@@ -25,47 +96,210 @@ class COCOEvalCap:
         self.cocoTypes = cocoTypes
         self.tokenization_fn = tokenization_fn
         self.verbose = verbose
+        # BLEU, ROUGE_L and CIDEr are sharded over this many processes
+        self.num_workers = num_workers
+        # see Rouge(max_band)
+        self.rouge_max_band = rouge_max_band
+        # with a vocab, captions are sequences of token ids: they are not PTB tokenized, and
+        # vocab[id] (the token of an id) is only used to decode them for METEOR and SPICE
+        self.vocab = vocab
+        # references of coco returned by prepareReferences (or a ReferenceStore of them, with
+        # image ids 0..n-1), used instead of tokenizing them again
+        self.references = references
 
-    def evaluate(self):
+    def tokenize(self, refs_only=False):
         imgIds = self.params['image_id']
         # imgIds = self.coco.getImgIds()
-        gts = {}
+        if self.references is not None:
+            gts = self.references
+        else:
+            gts = self.tokenizeCaptions({imgId: self.coco.imgToAnns[imgId] for imgId in imgIds})
         res = {}
-        for imgId in imgIds:
-            gts[imgId] = self.coco.imgToAnns[imgId]
-            res[imgId] = self.cocoRes.imgToAnns[imgId]
+        if not refs_only:
+            res = self.tokenizeCaptions({imgId: self.cocoRes.imgToAnns[imgId] for imgId in imgIds})
+        return gts, res
+
+    def tokenizeCaptions(self, anns_for_image):
+        if self.vocab is not None:
+            captions = self.captionIds(anns_for_image)
+        else:
+            print('tokenization...')
+            tokenizer = PTBTokenizer(self.tokenization_fn, verbose=self.verbose)
+            captions = tokenizer.tokenize(anns_for_image)
+        if all(coco_type in self.cocoTypes for coco_type in _NGRAM_COCO_TYPES):
+            # count n-grams once for both BLEU and CIDEr
+            captions = cook_captions(captions)
+        return captions
+
+    def prepareReferences(self):
+        """
+        Tokenized references of every image, with the work BLEU and CIDEr do on references alone
+        (BLEU max counts, CIDEr n-gram counts, document frequency and tf-idf vectors) done once
+        :return: references (dict) : image id -> PreparedReferences, to be passed as `references`
+                 when scoring results against the same coco
+        """
+        gts, _ = self.tokenize(refs_only=True)
+        ciders = {}
+        if "CIDEr" in self.cocoTypes:
+            cider_scorer = CiderScorer()
+            for refs in gts.values():
+                cider_scorer.crefs.append(cider_cook_refs(refs))
+            cider_scorer.compute_doc_freq()
+            cider_scorer.ref_len = np.log(float(len(gts)))
+            for imgId, counts in zip(gts.keys(), cider_scorer.crefs):
+                ciders[imgId] = CiderReferences(counts, cider_scorer.document_frequency, len(gts),
+                                                [cider_scorer.counts2vec(ref) for ref in counts])
+        return {imgId: PreparedReferences(refs,
+                                          bleu=bleu_cook_refs(refs) if "BLEU" in self.cocoTypes else None,
+                                          cider=ciders.get(imgId))
+                for imgId, refs in gts.items()}
+
+    def captionIds(self, anns_for_image):
+        # ints, so that n-grams hash as tuples of python ints whatever the input arrays were
+        return {imgId: [tuple(map(int, ann['caption'])) for ann in anns]
+                for imgId, anns in anns_for_image.items()}
 
+    def metricCaptions(self, coco_type, gts, res):
+        # the captions a metric scores: prepared references are plain lists except for BLEU and
+        # CIDEr, and token ids are decoded for the string-only metrics
+        if coco_type in _NGRAM_COCO_TYPES:
+            return gts, res
+        if isinstance(gts, ReferenceStore):
+            return self.storedCaptions(coco_type, gts, res)
+        if self.references is not None:
+            gts = {imgId: list(refs) for imgId, refs in gts.items()}
+        if self.vocab is None or coco_type not in _STRING_COCO_TYPES:
+            return gts, res
+        decode = lambda captions_for_image: {
+            imgId: [' '.join([self.vocab[i] for i in caption]) for caption in captions]
+            for imgId, captions in captions_for_image.items()}
+        return decode(gts), decode(res)
+
+    def storedCaptions(self, coco_type, store, res):
+        # a ReferenceStore keeps the references as ids of store.vocab: ROUGE-L compares them to the
+        # results encoded the same way (0 for tokens no reference has), the others get them decoded
+        gts = {imgId: refs.tokens() for imgId, refs in store.items()}
+        if coco_type == "ROUGE_L":
+            return gts, {imgId: [tuple(store.vocab.get(w, 0) for w in caption.split()) for caption in captions]
+                         for imgId, captions in res.items()}
+        tokens = store.vocab.tokens
+        return {imgId: [' '.join([tokens[i] for i in ref]) for ref in refs]
+                for imgId, refs in gts.items()}, res
+
+    def evaluate(self):
         # =================================================
         # Set up scorers
         # =================================================
-        print('tokenization...')
-        tokenizer = PTBTokenizer(self.tokenization_fn, verbose=self.verbose)
-        gts = tokenizer.tokenize(gts)
-        res = tokenizer.tokenize(res)
+        gts, res = self.tokenize()
 
         # =================================================
         # Set up scorers
         # =================================================
         print('setting up scorers...')
-        scorers = [_COCO_TYPE_TO_METRIC[coco_type] for coco_type in self.cocoTypes]
+        scorers = [self.getScorer(coco_type) for coco_type in self.cocoTypes]
+        sharded = [coco_type in _SHARDED_COCO_TYPES for coco_type in self.cocoTypes]
+
+        pool = None
+        if self.num_workers > 1 and any(sharded):
+            num_shards = max(1, min(self.num_workers, len(gts)))
+            shards = [({imgId: gts[imgId] for imgId in keys}, {imgId: res[imgId] for imgId in keys})
+                      for keys in _split_keys(gts.keys(), num_shards)]
+            pool = Pool(self.num_workers)
 
         # =================================================
         # Compute scores
         # =================================================
-        for scorer, method in scorers:
-            print('computing {} score...'.format(scorer.method()))
-            score, scores = scorer.compute_score(gts, res)
-            if type(method) == list:
-                for sc, scs, m in zip(score, scores, method):
-                    self.setEval(sc, m)
-                    self.setImgToEvalImgs(scs, gts.keys(), m)
-                    print("{}: {:3}".format(m, sc))
-            else:
-                self.setEval(score, method)
-                self.setImgToEvalImgs(scores, gts.keys(), method)
-                print("{}: {:3}".format(method, score))
+        try:
+            for coco_type, (scorer, method), is_sharded in zip(self.cocoTypes, scorers, sharded):
+                print('computing {} score...'.format(scorer.method()))
+                metric_gts, metric_res = self.metricCaptions(coco_type, gts, res)
+                # CIDEr reads the document frequency of all images from a ReferenceStore, so it is not sharded
+                stored_cider = coco_type == "CIDEr" and isinstance(gts, ReferenceStore)
+                if pool is not None and coco_type in _BUCKETED_COCO_TYPES:
+                    score, scores = self.computeBucketedScore(scorer, metric_gts, metric_res, pool)
+                elif pool is not None and is_sharded and not stored_cider:
+                    score, scores = self.computeShardedScore(scorer, shards, pool)
+                else:
+                    score, scores = scorer.compute_score(metric_gts, metric_res)
+                if type(method) == list:
+                    for sc, scs, m in zip(score, scores, method):
+                        self.setEval(sc, m)
+                        self.setImgToEvalImgs(scs, gts.keys(), m)
+                        print("{}: {:3}".format(m, sc))
+                else:
+                    self.setEval(score, method)
+                    self.setImgToEvalImgs(scores, gts.keys(), method)
+                    print("{}: {:3}".format(method, score))
+        finally:
+            # workers are stopped even if a scorer (e.g. METEOR or SPICE in Java) fails
+            if pool is not None:
+                pool.close()
+                pool.join()
         self.setEvalImgs()
 
+    def computeShardedScore(self, scorer, shards, pool):
+        if hasattr(scorer, 'partial_doc_freq'):
+            # CIDEr needs the document frequency of the whole corpus before scoring any shard
+            doc_freqs = pool.map(_call_scorer, [(scorer, 'partial_doc_freq', (gts,)) for gts, _ in shards])
+            doc_freq = scorer.merge_doc_freq(*doc_freqs)
+            tasks = [(scorer, 'partial', (gts, res, doc_freq)) for gts, res in shards]
+        else:
+            tasks = [(scorer, 'partial', (gts, res)) for gts, res in shards]
+        partials = pool.map(_call_scorer, tasks)
+        return scorer.merge(*partials)
+
+    def computeBucketedScore(self, scorer, gts, res, pool):
+        # ROUGE-L costs about len(candidate) * len(reference) per pair, so one
+        # long caption would hold up a contiguous shard; buckets of similar
+        # cost are scored most expensive first, then put back in image order
+        imgIds = list(gts.keys())
+        costs = [_lcs_cost(len(_split(res[imgId][0])), [len(_split(ref)) for ref in gts[imgId]])
+                 for imgId in imgIds]
+        buckets = _bucket_by_cost(costs, self.num_workers * _BUCKETS_PER_WORKER)
+        tasks = [(scorer, 'partial', ({imgIds[i]: gts[imgIds[i]] for i in bucket},
+                                      {imgIds[i]: res[imgIds[i]] for i in bucket}))
+                 for bucket in buckets]
+        scores = np.zeros(len(imgIds))
+        for bucket, stats in zip(buckets, pool.imap(_call_scorer, tasks)):
+            _, scores[bucket] = scorer.merge(stats)
+        return np.mean(scores), scores
+
+    def partial_doc_freq(self):
+        """
+        First phase of a multi-node evaluation with CIDEr: document frequency of this shard's references.
+        Merge the results of all shards with Cider.merge_doc_freq and pass it to partial().
+        """
+        gts, _ = self.tokenize(refs_only=True)
+        return _COCO_TYPE_TO_METRIC["CIDEr"][0].partial_doc_freq(gts)
+
+    def partial(self, doc_freq=None):
+        """
+        Sufficient statistics of this shard for every metric in cocoTypes (see merge_stats)
+        :param doc_freq : merged CIDEr document frequency of the whole corpus, required for CIDEr
+        :return: stats (dict) : coco type -> stats
+        """
+        for coco_type in self.cocoTypes:
+            if coco_type not in _MERGEABLE_COCO_TYPES:
+                raise ValueError("{} does not support partial/merge".format(coco_type))
+        if "CIDEr" in self.cocoTypes and doc_freq is None:
+            raise ValueError("CIDEr needs the merged document frequency of the corpus (see partial_doc_freq)")
+
+        gts, res = self.tokenize()
+        stats = {}
+        for coco_type in self.cocoTypes:
+            scorer, _ = self.getScorer(coco_type)
+            if coco_type == "CIDEr":
+                stats[coco_type] = scorer.partial(gts, res, doc_freq)
+            else:
+                stats[coco_type] = scorer.partial(*self.metricCaptions(coco_type, gts, res))
+        return stats
+
+    def getScorer(self, coco_type):
+        scorer, method = _COCO_TYPE_TO_METRIC[coco_type]
+        if coco_type == "ROUGE_L" and self.rouge_max_band is not None:
+            scorer = Rouge(max_band=self.rouge_max_band)
+        return scorer, method
+
     def setEval(self, score, method):
         self.eval[method] = score
 
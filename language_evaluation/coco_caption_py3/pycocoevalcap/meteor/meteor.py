@@ -8,6 +8,8 @@ import sys
 import subprocess
 import threading
 
+from ..stats import make_stats, check_stats
+
 # Assumes meteor-1.5.jar is in the same directory as meteor.py.  Change as needed.
 METEOR_JAR = 'meteor-1.5.jar'
 # print METEOR_JAR
@@ -26,20 +28,35 @@ class Meteor:
         self.lock = threading.Lock()
 
     def compute_score(self, gts, res):
+        return self.merge(self.partial(gts, res))
+
+    def partial(self, gts, res):
+        # METEOR sufficient statistics of a shard, one stats line per image
         assert(gts.keys() == res.keys())
         imgIds = gts.keys()
-        scores = []
+        stats = []
 
-        eval_line = 'EVAL'
         self.lock.acquire()
         for i in imgIds:
             assert(len(res[i]) == 1)
-            stat = self._stat(res[i][0], gts[i])
+            stats.append(self._stat(res[i][0], gts[i]))
+        self.lock.release()
+
+        return make_stats("METEOR", stats=stats)
+
+    def merge(self, *partials):
+        # per-image and corpus METEOR from the stats lines of all shards (in shard order)
+        stats = [stat for partial in partials for stat in check_stats(partial, "METEOR")['stats']]
+        scores = []
+
+        eval_line = 'EVAL'
+        self.lock.acquire()
+        for stat in stats:
             eval_line += ' ||| {}'.format(stat)
 
         self.meteor_p.stdin.write('{}\n'.format(eval_line).encode())
         self.meteor_p.stdin.flush()
-        for i in range(0,len(imgIds)):
+        for i in range(0,len(stats)):
             scores.append(float(self.meteor_p.stdout.readline().strip()))
         score = float(self.meteor_p.stdout.readline().strip())
         self.lock.release()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# File Name : ngrams.py
+#
+# Description : N-gram counts of tokenized captions, computed once and shared
+#               by BLEU and CIDEr.
+
+from collections import Counter, defaultdict
+
+
+def count_ngrams(s, n=4):
+    '''
+    Length and 1..n-gram counts of a whitespace tokenized sentence
+    :param s: string : sentence to be converted into ngrams, or a sequence of Vocabulary ids
+    :param n: int    : max order of the n-grams
+    :returns: length (int), counts (dict) : ngram (tuple of str, or of int for ids) -> count
+
+    N-grams are counted (and ordered) exactly as the original precook loops did,
+    order by order and by first occurrence, so metrics sum them in the same order.
+    '''
+    if isinstance(s, (CookedCaption, CookedIds)) and s.n == n:
+        return s.length, s.counts
+    words = s.split() if isinstance(s, str) else s
+    counts = defaultdict(int)
+    for k in range(1, n+1):
+        counts.update(Counter(zip(*[words[i:] for i in range(k)])))
+    return len(words), counts
+
+
+class CookedCaption(str):
+    '''
+    A tokenized caption that carries its n-gram counts.
+
+    It is still a str, so every metric can use it as a caption, and BLEU and
+    CIDEr take its counts from count_ngrams instead of counting them again.
+    The counts must not be modified.
+    '''
+
+    def __new__(cls, s, n=4, length=None, counts=None):
+        caption = str.__new__(cls, s)
+        caption.n = n
+        if counts is None:
+            length, counts = count_ngrams(str(caption), n)
+        caption.length, caption.counts = length, counts
+        return caption
+
+    def __reduce__(self):
+        return CookedCaption, (str(self), self.n, self.length, self.counts)
+
+
+class CookedIds(tuple):
+    '''
+    Same as CookedCaption, for a caption given as a tuple of token ids.
+    '''
+
+    def __new__(cls, ids, n=4, length=None, counts=None):
+        caption = tuple.__new__(cls, ids)
+        caption.n = n
+        if counts is None:
+            length, counts = count_ngrams(tuple(caption), n)
+        caption.length, caption.counts = length, counts
+        return caption
+
+    def __reduce__(self):
+        return CookedIds, (tuple(self), self.n, self.length, self.counts)
+
+
+def cook_captions(captions_for_image, n=4):
+    '''
+    Wrap every caption of {image id: [caption]} (as returned by PTBTokenizer, or token ids)
+    in a CookedCaption (or CookedIds)
+    '''
+    return {image_id: [CookedCaption(caption, n) if isinstance(caption, str) else CookedIds(caption, n)
+                       for caption in captions]
+            for image_id, captions in captions_for_image.items()}
+
+
+class PreparedReferences(list):
+    '''
+    The tokenized references of one image, with what BLEU and CIDEr compute from them alone.
+
+    It is still the list of reference captions. BLEU takes `bleu` (as cook_refs would return it)
+    and CIDEr takes `cider` (a CiderReferences) instead of cooking the captions again. Built by
+    COCOEvalCap.prepareReferences for every image of a corpus, so that several results can be
+    scored against it. Pickled as a plain list, since the caches can be rebuilt.
+    '''
+
+    def __init__(self, refs, n=4, bleu=None, cider=None):
+        list.__init__(self, refs)
+        self.n = n
+        self.bleu = bleu
+        self.cider = cider
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+class CiderReferences(list):
+    '''
+    N-gram counts of the references of one image (as CIDEr cook_refs returns them), with their
+    tf-idf vectors (vec, norm, length) for the document frequency of the whole corpus.
+
+    The vectors are only used when CIDEr scores against that same document frequency object,
+    i.e. against all the num_images images it was computed from.
+    '''
+
+    def __init__(self, counts, document_frequency, num_images, vectors):
+        list.__init__(self, counts)
+        self.document_frequency = document_frequency
+        self.num_images = num_images
+        self.vectors = vectors
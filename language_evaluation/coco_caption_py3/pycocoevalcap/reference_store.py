@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+#
+# File Name : reference_store.py
+#
+# Description : Compact per-image reference n-gram store shared by BLEU and CIDEr.
+
+from array import array
+from collections import defaultdict
+from collections.abc import KeysView
+import numpy as np
+
+from .vocabulary import Vocabulary
+
+# Token ids are packed into a single python int with this many bits per token.
+# Ids start at 1, so n-grams of different orders never share a packed key.
+_TOKEN_BITS = 32
+
+
+def _pack(ids):
+    key = 0
+    for i in ids:
+        key = (key << _TOKEN_BITS) | i
+    return key
+
+
+class StoredReferences(object):
+    """Handle to the references of one image inside a ReferenceStore.
+
+    Handles are what `store[image_id]` returns. They are accepted by
+    BleuScorer and CiderScorer wherever a list of reference strings is.
+    """
+
+    __slots__ = "store", "row"
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __len__(self):
+        return self.store.num_refs(self.row)
+
+    def cook_bleu_test(self, test, eff=None, n=4):
+        return self.store.cook_bleu_test(self.row, test, eff, n)
+
+    def tokens(self):
+        return self.store.ref_tokens(self.row)
+
+
+class ReferenceStore(object):
+    """Compact n-gram store for the references of many images.
+
+    Tokens are interned into integer ids and n-grams into n-gram ids once per
+    store. Each reference keeps its n-gram ids and counts in contiguous
+    arrays, and each image keeps its BLEU max-count table the same way, with
+    per-image offsets into them. This replaces one dict of string tuples per
+    reference (CIDEr) and per image (BLEU).
+
+    The store behaves as a read-only mapping from image id to
+    StoredReferences, so it can be passed as `gts` to Bleu and Cider:
+
+        store = ReferenceStore.from_gts(gts)
+        score, scores = Cider().compute_score(store, res)
+
+    Tokens are interned with `vocab`, a Vocabulary that can be shared with
+    other stores and metrics; captions it encoded can then be added and
+    scored as ids.
+
+    `to_arrays` and `from_arrays` turn a store into numpy arrays and back
+    into a read-only store that uses them in place, e.g. memory-mapped from
+    a file (see language_evaluation.compile_references).
+    """
+
+    def __init__(self, n=4, vocab=None):
+        self.n = n
+        self.vocab = Vocabulary() if vocab is None else vocab
+        self._ngram_ids = {}
+        self._ngram_order = array('b')
+
+        self._image_index = {}
+        self._image_ref_offsets = array('q', [0])
+        self._maxcount_offsets = array('q', [0])
+        self._maxcount_ngrams = array('i')
+        self._maxcount_counts = array('i')
+
+        self._ref_lengths = array('i')
+        self._ref_offsets = array('q', [0])
+        self._ref_ngrams = array('i')
+        self._ref_counts = array('i')
+        self._ref_tokens = array('i')
+        self._ref_token_offsets = array('q', [0])
+
+        # see compute_cider_vectors
+        self._cider = None
+        self._arrays = None
+
+    @classmethod
+    def from_gts(cls, gts, n=4, vocab=None):
+        '''Build a store from a dict of image id -> list of tokenized references.'''
+        store = cls(n=n, vocab=vocab)
+        for image_id, refs in gts.items():
+            store.add(image_id, refs)
+        return store
+
+    # =================================================
+    # Building
+    # =================================================
+    def token_id(self, token):
+        return self.vocab.intern(token)
+
+    def _intern_ngram(self, key, order):
+        ngram_id = self._ngram_ids.get(key)
+        if ngram_id is None:
+            ngram_id = len(self._ngram_order)
+            self._ngram_ids[key] = ngram_id
+            self._ngram_order.append(order)
+        return ngram_id
+
+    def add(self, image_id, refs):
+        '''Add the tokenized reference sentences of one image.'''
+        assert self._ngram_ids is not None, "store is read-only"
+        assert image_id not in self._image_index, "duplicate image id %s" % image_id
+        assert len(refs) > 0
+
+        maxcounts = {}
+        for ref in refs:
+            ids = self.vocab.encode(ref) if isinstance(ref, str) else ref
+            counts = defaultdict(int)
+            for k in range(1, self.n+1):
+                for i in range(len(ids)-k+1):
+                    counts[self._intern_ngram(_pack(ids[i:i+k]), k)] += 1
+            # n-grams are kept in order of first occurrence, as CIDEr adds up their weights
+            for ngram_id, count in counts.items():
+                self._ref_ngrams.append(ngram_id)
+                self._ref_counts.append(count)
+                maxcounts[ngram_id] = max(maxcounts.get(ngram_id, 0), count)
+            self._ref_lengths.append(len(ids))
+            self._ref_offsets.append(len(self._ref_ngrams))
+            self._ref_tokens.extend(ids)
+            self._ref_token_offsets.append(len(self._ref_tokens))
+
+        for ngram_id in sorted(maxcounts):
+            self._maxcount_ngrams.append(ngram_id)
+            self._maxcount_counts.append(maxcounts[ngram_id])
+        self._maxcount_offsets.append(len(self._maxcount_ngrams))
+        self._image_ref_offsets.append(len(self._ref_lengths))
+
+        self._image_index[image_id] = len(self._image_index)
+        self._cider = None
+        self._arrays = None
+
+    # =================================================
+    # Mapping interface
+    # =================================================
+    def keys(self):
+        return self._image_index.keys()
+
+    def __len__(self):
+        return len(self._image_index)
+
+    def __contains__(self, image_id):
+        return image_id in self._image_index
+
+    def __iter__(self):
+        return iter(self._image_index)
+
+    def __getitem__(self, image_id):
+        return StoredReferences(self, self._image_index[image_id])
+
+    def items(self):
+        return [(image_id, StoredReferences(self, row))
+                for image_id, row in self._image_index.items()]
+
+    # =================================================
+    # Lookups
+    # =================================================
+    def num_refs(self, row):
+        return int(self._image_ref_offsets[row+1] - self._image_ref_offsets[row])
+
+    def ref_lengths(self, row):
+        return self._ref_lengths[self._image_ref_offsets[row]:self._image_ref_offsets[row+1]].tolist()
+
+    def ref_tokens(self, row):
+        '''Token ids of each reference of an image, as tuples.'''
+        offsets = self._ref_token_offsets[self._image_ref_offsets[row]:self._image_ref_offsets[row+1]+1].tolist()
+        return [tuple(self._ref_tokens[lo:hi].tolist()) for lo, hi in zip(offsets[:-1], offsets[1:])]
+
+    def ngram_id(self, ngram):
+        '''Return the n-gram id of a tuple of tokens (or of their ids), or None if no reference has it.'''
+        return self.ngram_ids([ngram])[0]
+
+    def ngram_ids(self, ngrams):
+        '''ngram_id of every n-gram of a list, looked up at once.'''
+        result = [None] * len(ngrams)
+        positions, id_ngrams = [], []
+        for i, ngram in enumerate(ngrams):
+            # 0 never matches a reference token
+            ids = tuple(w if isinstance(w, int) else self.vocab.get(w, 0) for w in ngram)
+            if 0 not in ids:
+                positions.append(i)
+                id_ngrams.append(ids)
+        for i, ngram_id in zip(positions, self._find_ngrams(id_ngrams)):
+            result[i] = ngram_id
+        return result
+
+    def _find_ngrams(self, id_ngrams):
+        if self._ngram_ids is not None:
+            return [self._ngram_ids.get(_pack(ids)) for ids in id_ngrams]
+        # stores read from arrays have no dict of the n-grams, only a sorted table of their tokens
+        keys, key_ids = self._ngram_index
+        if not id_ngrams or len(keys) == 0:
+            return [None] * len(id_ngrams)
+        queries = _ngram_keys(np.array([ids + (0,) * (self.n - len(ids)) for ids in id_ngrams], dtype='>u4'))
+        positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+        found = keys[positions] == queries
+        return [ngram_id if hit else None
+                for ngram_id, hit in zip(key_ids[positions].tolist(), found.tolist())]
+
+    def arrays(self):
+        '''Numpy views of the packed tables (rebuilt after every `add`).'''
+        if self._arrays is None:
+            self._arrays = {
+                'ngram_order': np.array(self._ngram_order, dtype=np.int8),
+                'image_ref_offsets': np.array(self._image_ref_offsets, dtype=np.int64),
+                'maxcount_offsets': np.array(self._maxcount_offsets, dtype=np.int64),
+                'maxcount_ngrams': np.array(self._maxcount_ngrams, dtype=np.int32),
+                'maxcount_counts': np.array(self._maxcount_counts, dtype=np.int32),
+                'ref_lengths': np.array(self._ref_lengths, dtype=np.int32),
+                'ref_offsets': np.array(self._ref_offsets, dtype=np.int64),
+                'ref_ngrams': np.array(self._ref_ngrams, dtype=np.int32),
+                'ref_counts': np.array(self._ref_counts, dtype=np.int32),
+                'ref_tokens': np.array(self._ref_tokens, dtype=np.int32),
+                'ref_token_offsets': np.array(self._ref_token_offsets, dtype=np.int64),
+            }
+        return self._arrays
+
+    def nbytes(self):
+        '''Bytes held by the packed per-image and per-reference tables.'''
+        return sum(a.itemsize * len(a) for a in (
+            self._ngram_order, self._image_ref_offsets, self._maxcount_offsets,
+            self._maxcount_ngrams, self._maxcount_counts, self._ref_lengths,
+            self._ref_offsets, self._ref_ngrams, self._ref_counts,
+            self._ref_tokens, self._ref_token_offsets))
+
+    # =================================================
+    # Arrays
+    # =================================================
+    def to_arrays(self):
+        '''
+        Everything from_arrays needs besides n and the vocabulary: the packed tables, a sorted
+        table of the tokens of every n-gram to look them up without a dict, and the CIDEr
+        vectors of compute_cider_vectors. Rows stand for the image ids, so the store must have
+        been filled with image ids 0, 1, ... in order.
+        '''
+        assert all(image_id == row for image_id, row in self._image_index.items()), \
+            "image ids must be 0..%d in order" % (len(self) - 1)
+        mask = (1 << _TOKEN_BITS) - 1
+        tokens = [None] * len(self._ngram_order)
+        for key, ngram_id in self._ngram_ids.items():
+            order = self._ngram_order[ngram_id]
+            tokens[ngram_id] = tuple((key >> (_TOKEN_BITS * (order - 1 - i))) & mask for i in range(order)) + \
+                (0,) * (self.n - order)
+        tokens = np.array(tokens, dtype='>u4').reshape(len(tokens), self.n)
+        key_ids = np.argsort(_ngram_keys(tokens), kind='stable').astype(np.int32)
+
+        if self._cider is None:
+            self.compute_cider_vectors()
+        arrays = dict(self.arrays(), ngram_keys=tokens[key_ids], ngram_key_ids=key_ids)
+        arrays.update(self._cider)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, vocab, n=4):
+        '''
+        Read-only store over the arrays of to_arrays, e.g. numpy memmaps of a file, which are
+        used in place. Image ids are the rows. `vocab` must be the Vocabulary of the store the
+        arrays come from, as captions are looked up by the ids it gives their tokens.
+        '''
+        if not isinstance(vocab, Vocabulary):
+            raise TypeError("from_arrays needs the Vocabulary of the store, not {!r}".format(vocab))
+        store = cls(n=n, vocab=vocab)
+        store._ngram_ids = None
+        store._ngram_index = (_ngram_keys(arrays['ngram_keys']), arrays['ngram_key_ids'])
+        store._image_index = _RowIndex(len(arrays['image_ref_offsets']) - 1)
+        for name in _PACKED_ARRAYS:
+            setattr(store, '_' + name, arrays[name])
+        store._cider = {name: arrays[name] for name in _CIDER_ARRAYS}
+        store._arrays = {name: arrays[name] for name in _PACKED_ARRAYS}
+        return store
+
+    # =================================================
+    # BLEU
+    # =================================================
+    def cook_bleu_test(self, row, test, eff=None, n=4):
+        '''Same result as bleu_scorer.cook_test, read from the packed tables.'''
+        assert n <= self.n, "store was built with n=%d" % self.n
+        if isinstance(test, str):
+            # 0 never matches a reference token
+            ids = [self.vocab.get(w, 0) for w in test.split()]
+        else:
+            ids = test
+        testlen = len(ids)
+
+        lo, hi = self._maxcount_offsets[row], self._maxcount_offsets[row+1]
+        maxcounts = dict(zip(self._maxcount_ngrams[lo:hi].tolist(), self._maxcount_counts[lo:hi].tolist()))
+
+        result = {}
+        reflen = self.ref_lengths(row)
+        if eff == "closest":
+            result["reflen"] = min((abs(l-testlen), l) for l in reflen)[1]
+        else:
+            result["reflen"] = reflen
+
+        result["testlen"] = testlen
+        result["guess"] = [max(0,testlen-k+1) for k in range(1, n+1)]
+        result['correct'] = [0]*n
+        counts = defaultdict(int)
+        for k in range(1, n+1):
+            for i in range(testlen-k+1):
+                ngram = tuple(ids[i:i+k])
+                if 0 not in ngram:
+                    counts[ngram] += 1
+        for ngram, ngram_id in zip(list(counts), self._find_ngrams(list(counts))):
+            if ngram_id is not None:
+                result['correct'][len(ngram)-1] += min(maxcounts.get(ngram_id, 0), counts[ngram])
+
+        return result
+
+    # =================================================
+    # CIDEr
+    # =================================================
+    def document_frequency(self, rows):
+        '''Number of images among `rows` whose references contain each n-gram.
+
+        The BLEU max-count table of an image is exactly the set of n-grams
+        in its references, so df is a bincount over those tables.
+        '''
+        arrs = self.arrays()
+        offsets = arrs['maxcount_offsets']
+        ngrams = arrs['maxcount_ngrams']
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == len(self) and np.array_equal(rows, np.arange(len(self))):
+            if self._cider is not None:
+                return self._cider['cider_df']
+            selected = ngrams
+        else:
+            selected = np.concatenate([ngrams[offsets[r]:offsets[r+1]] for r in rows])
+        return np.bincount(selected, minlength=len(self._ngram_order)).astype(np.float64)
+
+    def ref_vectors(self, row, df, ref_len, n):
+        '''
+        Yield (ngram_ids, tf-idf weights, order index, norm per order, bigram count) per reference.
+        Weights and norms are computed term by term in the order of the reference's n-grams, as
+        CiderScorer.counts2vec does, so that CIDEr scores are exactly the same.
+        '''
+        arrs = self.arrays()
+        order = arrs['ngram_order']
+        ref_offsets = arrs['ref_offsets']
+        cached = self._cider is not None and df is self._cider['cider_df'] and n == self.n
+        for r in range(self._image_ref_offsets[row], self._image_ref_offsets[row+1]):
+            lo, hi = ref_offsets[r], ref_offsets[r+1]
+            ngram_ids = arrs['ref_ngrams'][lo:hi]
+            orders = order[ngram_ids].astype(np.int64) - 1
+            if cached:
+                yield (ngram_ids, self._cider['cider_weights'][lo:hi], orders,
+                       self._cider['cider_norms'][r], int(self._cider['cider_lengths'][r]))
+                continue
+            counts = arrs['ref_counts'][lo:hi]
+            keep = orders < n
+            ngram_ids, counts, orders = ngram_ids[keep], counts[keep], orders[keep]
+            weights, norm = [], [0.0] * n
+            for count, df_ngram, k in zip(counts.tolist(), df[ngram_ids].tolist(), orders.tolist()):
+                weight = float(count)*(ref_len - np.log(max(1.0, df_ngram)))
+                weights.append(weight)
+                norm[k] += pow(weight, 2)
+            length = int(counts[orders == 1].sum())
+            yield ngram_ids, np.array(weights, dtype=np.float64), orders, np.sqrt(norm), length
+
+    def compute_cider_vectors(self):
+        '''
+        Compute the document frequency over all images and the CIDEr vectors of every
+        reference for it once; CIDEr then reads them when it scores against all images.
+        '''
+        self._cider = None
+        df = self.document_frequency(np.arange(len(self)))
+        ref_len = np.log(float(len(self)))
+        weights, norms, lengths = [], [], []
+        for row in range(len(self)):
+            for _, weights_ref, _, norm, length in self.ref_vectors(row, df, ref_len, self.n):
+                weights.append(weights_ref)
+                norms.append(norm)
+                lengths.append(length)
+        self._cider = {
+            'cider_df': df,
+            'cider_weights': np.concatenate(weights) if weights else np.zeros(0),
+            'cider_norms': np.array(norms, dtype=np.float64).reshape(len(norms), self.n),
+            'cider_lengths': np.array(lengths, dtype=np.int64),
+        }
+
+
+_PACKED_ARRAYS = ('ngram_order', 'image_ref_offsets', 'maxcount_offsets', 'maxcount_ngrams',
+                  'maxcount_counts', 'ref_lengths', 'ref_offsets', 'ref_ngrams', 'ref_counts',
+                  'ref_tokens', 'ref_token_offsets')
+_CIDER_ARRAYS = ('cider_df', 'cider_weights', 'cider_norms', 'cider_lengths')
+
+
+def _ngram_keys(tokens):
+    # rows of big-endian token ids compare as bytes in the order of the ids
+    tokens = np.ascontiguousarray(tokens)
+    return tokens.view('V%d' % (tokens.itemsize * tokens.shape[1])).reshape(len(tokens))
+
+
+class _RowIndex(object):
+    """Image index of a store whose image ids are its rows, without a dict of them."""
+
+    def __init__(self, num_rows):
+        self._num_rows = num_rows
+
+    def __len__(self):
+        return self._num_rows
+
+    def __contains__(self, image_id):
+        return isinstance(image_id, int) and 0 <= image_id < self._num_rows
+
+    def __iter__(self):
+        return iter(range(self._num_rows))
+
+    def __getitem__(self, image_id):
+        if image_id not in self:
+            raise KeyError(image_id)
+        return image_id
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        return zip(range(self._num_rows), range(self._num_rows))
@@ -7,9 +7,21 @@
 # Creation Date : 2015-01-07 06:03
 # Author : Ramakrishna Vedantam <vrama91@vt.edu>
 
+from collections import Counter
+
 import numpy as np
 import pdb
 
+from ..stats import make_stats, check_stats
+from language_evaluation.rouge.rouge_scorer import lcs_length
+
+def _split(caption):
+    # Captions given as token ids are already tokens. Like ''.split(" ") == [''],
+    # an empty one is a single empty token, so that lengths are never zero.
+    if isinstance(caption, str):
+        return caption.split(" ")
+    return caption if len(caption) > 0 else [None]
+
 def my_lcs(string, sub):
     """
     Calculates longest common subsequence for a pair of tokenized strings
@@ -38,14 +50,21 @@ class Rouge():
     Class for computing ROUGE-L score for a set of candidate sentences for the MS COCO test set
 
     '''
-    def __init__(self):
+    def __init__(self, max_band=None, prune=True):
         # vrama91: updated the value below based on discussion with Hovey
         self.beta = 1.2
+        # skip the LCS of references that cannot raise the max precision or recall (same scores)
+        self.prune = prune
+        # with max_band, LCS of captions longer than max_band tokens is computed in a band around
+        # the diagonal (see rouge_scorer.lcs_length); num_inexact counts the pairs whose LCS is
+        # then only a lower bound
+        self.max_band = max_band
+        self.num_inexact = 0
 
     def calc_score(self, candidate, refs):
         """
         Compute ROUGE-L score given one candidate and references for an image
-        :param candidate: str : candidate sentence to be evaluated
+        :param candidate: str : candidate sentence to be evaluated (or its Vocabulary ids)
         :param refs: list of str : COCO reference sentences for the particular image to be evaluated
         :returns score: int (ROUGE-L score for the candidate evaluated against references)
         """
@@ -55,18 +74,21 @@ class Rouge():
         rec = []
 
         # split into tokens
-        token_c = candidate[0].split(" ")
+        token_c = _split(candidate[0])
 
-        for reference in refs:
-            # split into tokens
-            token_r = reference.split(" ")
-            # compute the longest common subsequence
-            lcs = my_lcs(token_r, token_c)
-            prec.append(lcs/float(len(token_c)))
-            rec.append(lcs/float(len(token_r)))
+        if self.prune:
+            prec_max, rec_max = self.calc_pruned_max(token_c, refs)
+        else:
+            for reference in refs:
+                # split into tokens
+                token_r = _split(reference)
+                # compute the longest common subsequence
+                lcs = self.lcs(token_r, token_c)
+                prec.append(lcs/float(len(token_c)))
+                rec.append(lcs/float(len(token_r)))
 
-        prec_max = max(prec)
-        rec_max = max(rec)
+            prec_max = max(prec)
+            rec_max = max(rec)
 
         if(prec_max!=0 and rec_max !=0):
             score = ((1 + self.beta**2)*prec_max*rec_max)/float(rec_max + self.beta**2*prec_max)
@@ -74,6 +96,40 @@ class Rouge():
             score = 0.0
         return score
 
+    def calc_pruned_max(self, token_c, refs):
+        """
+        Same max precision and recall as computing the LCS with every reference, by branch and bound
+        :param token_c : list of str : tokens of the candidate
+        :param refs: list of str : references
+        :returns: prec_max, rec_max (float)
+
+        The clipped unigram overlap with a reference bounds its LCS from above, so references are
+        visited from the largest overlap down, and their LCS is skipped when the bound cannot raise
+        either maximum.
+        """
+        counts_c = Counter(token_c)
+        bounds = []
+        for reference in refs:
+            token_r = _split(reference)
+            bounds.append((sum((counts_c & Counter(token_r)).values()), token_r))
+        bounds.sort(key=lambda bound: bound[0], reverse=True)
+
+        prec_max, rec_max = 0.0, 0.0
+        for overlap, token_r in bounds:
+            if overlap/float(len(token_c)) <= prec_max and overlap/float(len(token_r)) <= rec_max:
+                continue
+            lcs = self.lcs(token_r, token_c)
+            prec_max = max(prec_max, lcs/float(len(token_c)))
+            rec_max = max(rec_max, lcs/float(len(token_r)))
+        return prec_max, rec_max
+
+    def lcs(self, token_r, token_c):
+        if self.max_band is None:
+            return my_lcs(token_r, token_c)
+        lcs, exact = lcs_length(token_r, token_c, self.max_band)
+        self.num_inexact += not exact
+        return lcs
+
     def compute_score(self, gts, res):
         """
         Computes Rouge-L score given a set of reference and candidate sentences for the dataset
@@ -101,5 +157,24 @@ class Rouge():
         average_score = np.mean(np.array(score))
         return average_score, np.array(score)
 
+    def partial(self, gts, res):
+        """
+        Sufficient statistics of a shard: its per-image ROUGE-L scores
+        :returns: stats (dict)
+        """
+        assert(gts.keys() == res.keys())
+        num_inexact = self.num_inexact
+        scores = np.array([self.calc_score(res[id], gts[id]) for id in gts.keys()])
+        return make_stats("ROUGE_L", beta=self.beta, scores=scores,
+                          num_inexact=self.num_inexact - num_inexact)
+
+    def merge(self, *partials):
+        """
+        Concatenate per-image scores of all shards (in shard order)
+        :returns: average_score: float, scores (np.array)
+        """
+        scores = np.concatenate([check_stats(stats, "ROUGE_L")['scores'] for stats in partials])
+        return np.mean(scores), scores
+
     def method(self):
         return "Rouge"
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+# File Name : stats.py
+#
+# Description : Versioned sufficient-statistics format shared by the metrics'
+#               partial()/merge() methods, so that shards of a corpus can be
+#               scored on different processes or nodes and merged exactly.
+
+import base64
+import json
+import zlib
+
+import numpy as np
+
+STATS_FORMAT = 'language_evaluation.stats'
+STATS_VERSION = 1
+
+
+def make_stats(metric, **fields):
+    '''Wrap the sufficient statistics of one metric over one shard.'''
+    stats = {'format': STATS_FORMAT, 'version': STATS_VERSION, 'metric': metric}
+    stats.update(fields)
+    return stats
+
+
+def check_stats(stats, metric):
+    '''Raise ValueError unless stats are in this format and version and belong to metric.'''
+    if not isinstance(stats, dict) or stats.get('format') != STATS_FORMAT:
+        raise ValueError("Not a {} object".format(STATS_FORMAT))
+    if stats['version'] != STATS_VERSION:
+        raise ValueError("Unsupported stats version {} (expected {})".format(
+            stats['version'], STATS_VERSION))
+    if stats['metric'] != metric:
+        raise ValueError("Cannot merge {} stats into {}".format(stats['metric'], metric))
+    return stats
+
+
+def _encode(obj):
+    # numpy arrays are stored as raw little-endian bytes, so floats round-trip exactly
+    if isinstance(obj, np.ndarray):
+        array = np.ascontiguousarray(obj, dtype=obj.dtype.newbyteorder('<'))
+        return {'__ndarray__': base64.b64encode(array.tobytes()).decode('ascii'),
+                'dtype': array.dtype.str,
+                'shape': list(array.shape)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {key: _encode(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(value) for value in obj]
+    return obj
+
+
+def _decode(obj):
+    if isinstance(obj, dict):
+        if '__ndarray__' in obj:
+            data = base64.b64decode(obj['__ndarray__'])
+            return np.frombuffer(data, dtype=np.dtype(obj['dtype'])).reshape(obj['shape']).copy()
+        return {key: _decode(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(value) for value in obj]
+    return obj
+
+
+def dumps(stats):
+    '''Serialize (nested) stats to compressed bytes.'''
+    return zlib.compress(json.dumps(_encode(stats), separators=(',', ':')).encode('utf-8'))
+
+
+def loads(data):
+    '''Inverse of dumps.'''
+    return _decode(json.loads(zlib.decompress(data).decode('utf-8')))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# File Name : vocabulary.py
+#
+# Description : Token interning shared by the n-gram metrics, so they hash and
+#               compare int ids instead of strings.
+
+from array import array
+import json
+
+
+class Vocabulary(object):
+    """Maps tokens to int32 ids.
+
+    Ids are assigned in order of first occurrence and start at 1, so 0 can
+    stand for a token that is not in the vocabulary. A vocabulary only grows,
+    so captions encoded with it keep their ids: keep one per evaluation, or
+    save it with the references it was built from and load it to encode
+    later predictions.
+
+    Encoded captions (sequences of ids) are accepted wherever the metrics take
+    a tokenized caption: BLEU, CIDEr and ROUGE-L compute_score, the
+    ReferenceStore built with the same vocabulary, and RougeScorer.score_tokens.
+    Their n-grams are then tuples of ints.
+
+        vocab = Vocabulary()
+        gts, res = vocab.encode_captions(gts), vocab.encode_captions(res)
+        score, scores = Cider().compute_score(gts, res)
+    """
+
+    def __init__(self, tokens=()):
+        self._ids = {}
+        self._tokens = [None]
+        for token in tokens:
+            self.intern(token)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, token):
+        return token in self._ids
+
+    def intern(self, token):
+        '''Id of a token, assigning the next one if the token is new.'''
+        token_id = self._ids.get(token)
+        if token_id is None:
+            token_id = len(self._tokens)
+            self._ids[token] = token_id
+            self._tokens.append(token)
+        return token_id
+
+    def get(self, token, default=None):
+        '''Id of a token without adding it, as dict.get.'''
+        return self._ids.get(token, default)
+
+    def encode(self, tokens):
+        '''
+        Intern a tokenized caption
+        :param tokens: str (split on whitespace) or iterable of str
+        :returns: array of int32 ids
+        '''
+        if isinstance(tokens, str):
+            tokens = tokens.split()
+        return array('i', map(self.intern, tokens))
+
+    def encode_captions(self, captions_for_image):
+        '''
+        Encode every caption of {image id: [caption]} (as returned by PTBTokenizer)
+        '''
+        return {image_id: [self.encode(caption) for caption in captions]
+                for image_id, captions in captions_for_image.items()}
+
+    @property
+    def tokens(self):
+        '''List of the tokens indexed by id (None at 0), as evaluators take a vocab.'''
+        return self._tokens
+
+    def decode(self, ids):
+        '''Tokens of a sequence of ids.'''
+        return [self._tokens[i] for i in ids]
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self._tokens[1:], f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
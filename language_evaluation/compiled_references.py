@@ -0,0 +1,185 @@
+"""Answers compiled once into a file that evaluators memory-map.
+
+`language_evaluation.compile_references` tokenizes a set of answers and writes
+what the metrics compute from references alone: for CocoEvaluator, the PTB
+tokenized references as a ReferenceStore (interned token ids, BLEU max-count
+tables, CIDEr n-gram counts, document frequency and reference vectors), and
+for RougeEvaluator, the (stemmed) tokens of every reference as int32 ids.
+
+The file is a magic string, a json header, and the raw arrays, each aligned
+to 64 bytes. `open_references` maps it read-only with numpy.memmap, so
+opening it costs no parsing of the arrays, and processes that open the same
+file share its pages in the page cache instead of holding a copy each.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+from language_evaluation.coco_caption_py3.pycocoevalcap.reference_store import ReferenceStore
+from language_evaluation.coco_caption_py3.pycocoevalcap.vocabulary import Vocabulary
+
+COMPILED_FORMAT = 'language_evaluation.compiled_references'
+COMPILED_VERSION = 1
+
+_MAGIC = b'LEVALREF'
+_ALIGNMENT = 64
+
+
+def _align(offset):
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def write_compiled(path, metadata, arrays):
+    '''Write a json-serializable metadata dict and named numpy arrays to path.'''
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout, size = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {'offset': size, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        size = _align(size + array.nbytes)
+    header = dict(metadata, format=COMPILED_FORMAT, version=COMPILED_VERSION, arrays=layout)
+    header = json.dumps(header).encode('utf-8')
+    start = _align(len(_MAGIC) + 8 + len(header))
+
+    # written next to path and renamed, so readers never map a partial file
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(start + layout[name]['offset'])
+            array.tofile(f)
+        f.truncate(start + size)
+    os.replace(tmp_path, path)
+
+
+def read_compiled(path):
+    '''
+    Header and arrays of a file written by write_compiled
+    :returns: header (dict), arrays (dict) : name -> read-only numpy.memmap view
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("Not a {} file: {}".format(COMPILED_FORMAT, path))
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    if header.get('format') != COMPILED_FORMAT:
+        raise ValueError("Not a {} file: {}".format(COMPILED_FORMAT, path))
+    if header['version'] != COMPILED_VERSION:
+        raise ValueError("Unsupported compiled references version {} (expected {})".format(
+            header['version'], COMPILED_VERSION))
+
+    start = _align(len(_MAGIC) + 8 + header_size)
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        offset = start + spec['offset']
+        nbytes = dtype.itemsize * int(np.prod(spec['shape']))
+        arrays[name] = data[offset:offset + nbytes].view(dtype).reshape(spec['shape'])
+    return header, arrays
+
+
+class CompiledAnswer(object):
+    """The answer of one sample of CompiledReferences."""
+
+    __slots__ = "references", "index"
+
+    def __init__(self, references, index):
+        self.references = references
+        self.index = index
+
+
+class CompiledReferences(object):
+    """Answers compiled by compile_references, memory-mapped from their file.
+
+    Pass it as `answers` to CocoEvaluator.run_evaluation (if compiled with
+    coco=True) or to RougeEvaluator, with predicts in the same order. It is
+    a sequence of one CompiledAnswer per sample, so RougeEvaluator can slice
+    and bucket it as usual. It is pickled as its path and reopened by
+    open_references, so worker processes map the same file instead of
+    receiving the references.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        header, arrays = read_compiled(self.path)
+        self.num_samples = header['num_samples']
+
+        self.coco = None
+        if header['coco'] is not None:
+            coco_arrays = {name[len('coco/'):]: array for name, array in arrays.items()
+                           if name.startswith('coco/')}
+            self.coco = _CompiledReferenceStore.from_arrays(
+                coco_arrays, Vocabulary(header['coco']['vocab']), n=header['coco']['n'])
+            self.coco.path = self.path
+            self.unk_token = header['coco']['unk_token']
+
+        self.use_stemmer = header['rouge']['use_stemmer']
+        self.rouge_vocab = Vocabulary(header['rouge']['vocab'])
+        self._rouge_tokens = arrays['rouge/tokens']
+        self._rouge_offsets = arrays['rouge/offsets']
+        self._rouge_ref_offsets = arrays['rouge/ref_offsets']
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [CompiledAnswer(self, i) for i in range(*index.indices(self.num_samples))]
+        if index < 0:
+            index += self.num_samples
+        if not 0 <= index < self.num_samples:
+            raise IndexError(index)
+        return CompiledAnswer(self, index)
+
+    def __iter__(self):
+        return (CompiledAnswer(self, i) for i in range(self.num_samples))
+
+    def __reduce__(self):
+        return open_references, (self.path,)
+
+    def rouge_lengths(self, index):
+        '''Number of rouge tokens of each reference of a sample.'''
+        texts = slice(self._rouge_ref_offsets[index], self._rouge_ref_offsets[index + 1] + 1)
+        return np.diff(self._rouge_offsets[texts]).tolist()
+
+    def rouge_references(self, index):
+        '''Rouge token ids of each reference of a sample, as lists of python ints.'''
+        offsets = self._rouge_offsets[self._rouge_ref_offsets[index]:self._rouge_ref_offsets[index + 1] + 1]
+        return [self._rouge_tokens[lo:hi].tolist() for lo, hi in zip(offsets[:-1], offsets[1:])]
+
+    def rouge_ids(self, tokens):
+        '''Ids of the rouge tokens of a prediction; tokens no reference has get distinct negative ids.'''
+        unknown = {}
+        return [self.rouge_vocab.get(token) or unknown.setdefault(token, -1 - len(unknown))
+                for token in tokens]
+
+
+class _CompiledReferenceStore(ReferenceStore):
+    # pickled as the file it was mapped from, not as copies of the arrays
+    path = None
+
+    def __reduce__(self):
+        return _open_coco_store, (self.path,)
+
+
+def _open_coco_store(path):
+    return open_references(path).coco
+
+
+# path -> (file identity, CompiledReferences) opened in this process
+_opened = {}
+
+
+def open_references(path):
+    '''CompiledReferences of a file, opened once per process (again if the file was replaced).'''
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    opened = _opened.get(path)
+    if opened is None or opened[0] != identity:
+        opened = _opened[path] = (identity, CompiledReferences(path))
+    return opened[1]
@@ -0,0 +1,143 @@
+import collections
+import math
+import time
+
+import numpy as np
+
+from language_evaluation.coco_caption_py3.pycocoevalcap.bleu.bleu_scorer import \
+    cook_refs, cook_test, single_reflen, bleu_from_counts
+from language_evaluation.rouge import rouge_scorer
+
+
+_WindowEntry = collections.namedtuple(
+    "_WindowEntry", ["timestamp", "testlen", "reflen", "guess", "correct", "rouge"])
+
+
+def _add_exact(partials, x):
+    # Add x to a sum kept as non-overlapping partials (Shewchuk's algorithm,
+    # as in math.fsum), so that adding and subtracting samples is exact
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+
+class WindowedMetricMonitor(object):
+    """Corpus BLEU and mean ROUGE F-scores over a sliding window of samples.
+
+    Each sample is scored once when it is added: its BLEU sufficient
+    statistics (clipped matches, guesses and lengths) and its ROUGE
+    f-measures are kept in the window and added to running sums. Samples
+    leave the window when there are more than `max_samples` of them or they
+    are older than `max_seconds`, and are subtracted from the sums, so both
+    `add` and `report` are O(1) in the window size. ROUGE sums are kept
+    exactly, so they do not drift however many samples pass through.
+
+    Ages are measured from the newest `timestamp` given to `add`, so
+    replayed or backfilled logs are windowed by their own timestamps. If
+    samples were added without one, they are timestamped with `clock` and
+    `report` measures ages from the current time.
+
+    BLEU works on whitespace tokens, so pass already tokenized text. With
+    several answers per sample, ROUGE takes the best f-measure among them.
+
+    Sample usage:
+        monitor = language_evaluation.WindowedMetricMonitor(max_samples=1000)
+        for predict, answer in production_log:
+            monitor.add(predict, answer)
+        pprint(monitor.report())
+    """
+    def __init__(self,
+                 max_samples=None,
+                 max_seconds=None,
+                 bleu_n=4,
+                 rouge_types=["rouge1", "rouge2", "rougeL"],
+                 use_stemmer=True,
+                 tokenization_fn=None,
+                 clock=time.time):
+        if max_samples is None and max_seconds is None:
+            raise ValueError("Either max_samples or max_seconds must be given")
+        self.max_samples = max_samples
+        self.max_seconds = max_seconds
+        self.bleu_n = bleu_n
+        self.rouge_types = rouge_types
+        self._scorer = rouge_scorer.RougeScorer(rouge_types, use_stemmer, tokenization_fn)
+        self._clock = clock
+
+        self._window = collections.deque()
+        self._testlen = 0
+        self._reflen = 0
+        self._guess = np.zeros(bleu_n, dtype=np.int64)
+        self._correct = np.zeros(bleu_n, dtype=np.int64)
+        # partials of the exact sum of each rouge type (see _add_exact)
+        self._rouge = [[] for _ in rouge_types]
+        # newest timestamp given to add, None if samples are timestamped by clock
+        self._newest = None
+
+    def __len__(self):
+        return len(self._window)
+
+    def add(self, predict, answers, timestamp=None):
+        if type(answers) == str:
+            answers = [answers]
+        if timestamp is None:
+            timestamp = self._clock()
+        else:
+            self._newest = timestamp if self._newest is None else max(self._newest, timestamp)
+
+        comps = cook_test(predict, cook_refs(answers, n=self.bleu_n), n=self.bleu_n)
+        reflen = single_reflen(comps['reflen'], "closest", comps['testlen'])
+
+        # Best f-measure among the answers
+        rouge = self._scorer.score_multi(answers, predict, "max")[:, 2]
+
+        entry = _WindowEntry(timestamp, comps['testlen'], reflen,
+                             np.array(comps['guess']), np.array(comps['correct']), rouge.tolist())
+        self._window.append(entry)
+        self._testlen += entry.testlen
+        self._reflen += entry.reflen
+        self._guess += entry.guess
+        self._correct += entry.correct
+        for partials, value in zip(self._rouge, entry.rouge):
+            _add_exact(partials, value)
+
+        self.evict(timestamp)
+
+    def evict(self, now=None):
+        """Drop samples older than max_seconds at `now` (by default, the
+        newest timestamp added, or the clock), or beyond max_samples."""
+        if now is None:
+            now = self._newest if self._newest is not None else self._clock()
+        while self._window and (
+                (self.max_samples is not None and len(self._window) > self.max_samples) or
+                (self.max_seconds is not None and now - self._window[0].timestamp > self.max_seconds)):
+            entry = self._window.popleft()
+            self._testlen -= entry.testlen
+            self._reflen -= entry.reflen
+            self._guess -= entry.guess
+            self._correct -= entry.correct
+            for partials, value in zip(self._rouge, entry.rouge):
+                _add_exact(partials, -value)
+        if not self._window:
+            for partials in self._rouge:
+                partials[:] = []
+
+    def report(self, now=None):
+        """Corpus BLEU and mean ROUGE f-measure over the current window
+        (at `now`, see evict)."""
+        if self.max_seconds is not None:
+            self.evict(now)
+        result = {'num_samples': len(self._window)}
+        bleus = bleu_from_counts(self._correct, self._guess, self._testlen, self._reflen, self.bleu_n)
+        for k, bleu in enumerate(bleus):
+            result["Bleu_{}".format(k + 1)] = bleu
+        for key, partials in zip(self.rouge_types, self._rouge):
+            result[key] = math.fsum(partials) / max(len(self._window), 1)
+        return result
@@ -5,8 +5,8 @@ import re
 import codecs
 import platform
 
-from subprocess import check_output
-from tempfile import mkdtemp
+from subprocess import check_output, Popen, PIPE, CalledProcessError
+from tempfile import mkdtemp, mkstemp
 from functools import partial
 
 try:
@@ -17,6 +17,10 @@ except ImportError:
 from language_evaluation.pyrouge.utils.file_utils import DirectoryProcessor
 from language_evaluation.pyrouge.utils.file_utils import verify_dir
 
+# ROUGE home dir last written to or read from each settings file by this
+# process, so that creating many Rouge155 objects does not rewrite it.
+_settings_cache = {}
+
 
 class Rouge155(object):
     """
@@ -89,12 +93,19 @@ class Rouge155(object):
         self._model_filename_pattern = None
 
     def save_home_dir(self):
+        if _settings_cache.get(self._settings_file) == self._home_dir:
+            return
         config = ConfigParser()
         section = 'pyrouge settings'
         config.add_section(section)
         config.set(section, 'home_dir', self._home_dir)
-        with open(self._settings_file, 'w') as f:
+        # Write to a temporary file first, so concurrent readers never see
+        # a partially written settings file
+        fd, tmp_file = mkstemp(dir=os.path.dirname(self._settings_file))
+        with os.fdopen(fd, 'w') as f:
             config.write(f)
+        os.replace(tmp_file, self._settings_file)
+        _settings_cache[self._settings_file] = self._home_dir
 
     @property
     def settings_file(self):
@@ -175,7 +186,7 @@ class Rouge155(object):
         are not already split, this method can be used.
 
         """
-        from pyrouge.utils.sentence_splitter import PunktSentenceSplitter
+        from language_evaluation.pyrouge.utils.sentence_splitter import PunktSentenceSplitter
         ss = PunktSentenceSplitter()
         sent_split_to_string = lambda s: "\n".join(ss.split(s))
         process_func = partial(
@@ -272,6 +283,30 @@ class Rouge155(object):
                 "in the system summaries directory {}.".format(
                     system_filename_pattern.pattern, system_dir))
 
+        Rouge155.write_config_from_filenames(
+            system_dir, model_dir, system_models_tuples,
+            config_file_path, system_id)
+
+    @staticmethod
+    def write_config_from_filenames(system_dir, model_dir,
+                                    system_models_tuples,
+                                    config_file_path, system_id=None):
+        """
+        Write the ROUGE configuration file from a known list of system
+        summary files and their model summary files, without listing
+        the directories or matching filename patterns.
+
+            system_dir:             Path of directory containing
+                                    system summaries.
+            model_dir:              Path of directory containing model
+                                    summaries.
+            system_models_tuples:   List of (system_filename,
+                                    [model_filename, ...]) tuples.
+            config_file_path:       Path of the configuration file.
+            system_id:              Optional system ID string which
+                                    will appear in the ROUGE output.
+
+        """
         with codecs.open(config_file_path, 'w', encoding='utf-8') as f:
             f.write('<ROUGE-EVAL version="1.55">')
             for task_id, (system_filename, model_filenames) in enumerate(
@@ -323,13 +358,37 @@ class Rouge155(object):
 
         """
         self.write_config(system_id=system_id)
-        options = self.__get_options(rouge_args)
-        command = [self._bin_path] + options
-        env = None
-        if hasattr(self, "_home_dir") and self._home_dir:
-            env = {'ROUGE_EVAL_HOME': self._home_dir}
-        rouge_output = check_output(command, env=env).decode("UTF-8")
-        return rouge_output
+        return self.__run_rouge(rouge_args)
+
+    def evaluate_files(self, system_models_tuples, config_file_path,
+                       system_id=1, rouge_args=None, stream=False):
+        """
+        Run ROUGE on an explicit list of system summary files in
+        system_dir and their model summary files in model_dir. The
+        summaries must already be in the HTML format ROUGE understands
+        (cf. convert_text_to_rouge_format), so no files are read,
+        converted or copied before ROUGE starts.
+
+            system_models_tuples:   List of (system_filename,
+                                    [model_filename, ...]) tuples.
+            config_file_path:       Where to write the configuration
+                                    file.
+            system_id:              Optional system ID which will be
+                                    printed in ROUGE's output.
+            stream:                 If True, return an iterator over
+                                    the output lines while ROUGE is
+                                    still running.
+
+        Returns: ROUGE output as string, or an iterator over its lines.
+
+        """
+        Rouge155.write_config_from_filenames(
+            self._system_dir, self._model_dir, system_models_tuples,
+            config_file_path, system_id)
+        self._config_file = config_file_path
+        if stream:
+            return self.__stream_rouge(rouge_args)
+        return self.__run_rouge(rouge_args)
 
     def convert_and_evaluate(self, system_id=1,
                              split_sentences=False, rouge_args=None):
@@ -384,9 +443,59 @@ class Rouge155(object):
                 results["{}_ce".format(key)] = float(conf_end)
         return results
 
+    def output_to_per_doc_dict(self, output):
+        """
+        Convert the per-evaluation scores ROUGE prints with the -d
+        option into python dictionary mapping each ROUGE type to
+        {eval_id: (recall, precision, f_score)}. The output can be
+        given as string or as an iterable of lines, e.g. from
+        evaluate_files(..., stream=True).
+
+        """
+        #1 ROUGE-1 Eval 1.1 R:0.88889 P:1.00000 F:0.94118
+        pattern = re.compile(
+            r"\S+ (ROUGE-\S+) Eval (\S+)\.\S+ "
+            r"R:(\d.\d+) P:(\d.\d+) F:(\d.\d+)")
+        if isinstance(output, str):
+            output = output.split("\n")
+        results = {}
+        for line in output:
+            match = pattern.match(line)
+            if match:
+                rouge_type, eval_id, recall, precision, f_score = \
+                    match.groups()
+                rouge_type = rouge_type.lower().replace("-", '_')
+                results.setdefault(rouge_type, {})[eval_id] = (
+                    float(recall), float(precision), float(f_score))
+        return results
+
     ###################################################################
     # Private methods
 
+    def __run_rouge(self, rouge_args=None):
+        command = [self._bin_path] + self.__get_options(rouge_args)
+        rouge_output = check_output(
+            command, env=self.__get_env()).decode("UTF-8")
+        return rouge_output
+
+    def __stream_rouge(self, rouge_args=None):
+        # Start ROUGE right away; the returned generator reads its output
+        command = [self._bin_path] + self.__get_options(rouge_args)
+        process = Popen(command, stdout=PIPE, env=self.__get_env())
+
+        def lines():
+            with process.stdout:
+                for line in process.stdout:
+                    yield line.decode("UTF-8")
+            if process.wait():
+                raise CalledProcessError(process.returncode, command)
+        return lines()
+
+    def __get_env(self):
+        if hasattr(self, "_home_dir") and self._home_dir:
+            return {'ROUGE_EVAL_HOME': self._home_dir}
+        return None
+
     def __set_rouge_dir(self, home_dir=None):
         """
         Verfify presence of ROUGE-1.5.5.pl and data folder, and set
@@ -407,6 +516,8 @@ class Rouge155(object):
                 "/path/to/rouge/home.".format(self._bin_path))
 
     def __get_rouge_home_dir_from_settings(self):
+        if self._settings_file in _settings_cache:
+            return _settings_cache[self._settings_file]
         config = ConfigParser()
         with open(self._settings_file) as f:
             if hasattr(config, "read_file"):
@@ -415,6 +526,7 @@ class Rouge155(object):
                 # use deprecated python 2.x method
                 config.readfp(f)
         rouge_home_dir = config.get('pyrouge settings', 'home_dir')
+        _settings_cache[self._settings_file] = rouge_home_dir
         return rouge_home_dir
 
     @staticmethod
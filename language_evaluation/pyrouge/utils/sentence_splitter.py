@@ -1,9 +1,35 @@
 from __future__ import print_function, unicode_literals, division
 
+import collections
+import hashlib
+
 from language_evaluation.pyrouge.utils import log
 from language_evaluation.pyrouge.utils.string_utils import cleanup
 from language_evaluation.pyrouge.utils.file_utils import DirectoryProcessor
 
+LANG2DATAPATH = {"en": "tokenizers/punkt/english.pickle"}
+
+# Punkt models loaded in this process, by data path
+_sent_detectors = {}
+
+
+def load_sent_detector(punkt_data_path):
+    """Load a Punkt model once per process."""
+    if punkt_data_path not in _sent_detectors:
+        import nltk.data
+        _sent_detectors[punkt_data_path] = nltk.data.load(punkt_data_path)
+    return _sent_detectors[punkt_data_path]
+
+
+def _punkt_split(sent_detector, text):
+    return sent_detector.tokenize(cleanup(text).strip())
+
+
+def _split_texts(punkt_data_path, texts):
+    # Runs in the worker processes of CachedSentenceSplitter.split_all
+    sent_detector = load_sent_detector(punkt_data_path)
+    return [_punkt_split(sent_detector, text) for text in texts]
+
 
 class PunktSentenceSplitter:
     """
@@ -14,7 +40,7 @@ class PunktSentenceSplitter:
     """
 
     def __init__(self, language="en", punkt_data_path=None):
-        self.lang2datapath = {"en": "tokenizers/punkt/english.pickle"}
+        self.lang2datapath = LANG2DATAPATH
         self.log = log.get_global_console_logger()
         try:
             import nltk.data
@@ -25,25 +51,109 @@ class PunktSentenceSplitter:
         try:
             if not punkt_data_path:
                 punkt_data_path = self.lang2datapath[language]
-            self.sent_detector = nltk.data.load(punkt_data_path)
+            self.sent_detector = load_sent_detector(punkt_data_path)
         except KeyError:
             self.log.error(
                 "No sentence splitter data for language {}.".format(language))
         except:
             self.log.error(
                 "Could not load sentence splitter data: {}".format(
-                    self.lang2datapath[language]))
+                    punkt_data_path))
 
     def split(self, text):
         """Splits text and returns a list of the resulting sentences."""
-        text = cleanup(text)
-        return self.sent_detector.tokenize(text.strip())
+        return _punkt_split(self.sent_detector, text)
 
     @staticmethod
     def split_files(input_dir, output_dir, lang="en", punkt_data_path=None):
         ss = PunktSentenceSplitter(lang, punkt_data_path)
         DirectoryProcessor.process(input_dir, output_dir, ss.split)
 
+class CachedSentenceSplitter:
+    """
+    Punkt sentence splitting as a function of text, for the
+    `sentence_splitter` argument of Rouge155Evaluator (or any other
+    summary-level scorer).
+
+    The Punkt model is loaded once per process, and splits are cached by
+    the hash of the text (up to `cache_size` texts), so texts that are
+    evaluated again are not split again. `split_all` splits many texts at
+    once over `num_parallel_calls` processes; Rouge155Evaluator calls it on
+    all predictions and answers of a batch before dumping them.
+
+    Sample usage:
+        splitter = CachedSentenceSplitter(num_parallel_calls=8)
+        evaluator = language_evaluation.Rouge155Evaluator(
+            sentence_splitter=splitter)
+
+    """
+
+    def __init__(self, language="en", punkt_data_path=None,
+                 num_parallel_calls=1, cache_size=1000000):
+        self.punkt_data_path = punkt_data_path or LANG2DATAPATH[language]
+        self.num_parallel_calls = num_parallel_calls
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def __getstate__(self):
+        # Processes that receive the splitter start with an empty cache
+        state = self.__dict__.copy()
+        state['_cache'] = collections.OrderedDict()
+        return state
+
+    @staticmethod
+    def _key(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def _cache_put(self, key, sentences):
+        self._cache[key] = sentences
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def __call__(self, text):
+        key = self._key(text)
+        sentences = self._cache.get(key)
+        if sentences is None:
+            sentences = _punkt_split(load_sent_detector(self.punkt_data_path), text)
+            self._cache_put(key, sentences)
+        else:
+            self._cache.move_to_end(key)
+        return list(sentences)
+
+    def split_all(self, texts, chunksize=256):
+        """Split each of texts, and return the lists of sentences."""
+        keys = [self._key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self._cache and key not in missing:
+                missing[key] = text
+
+        # Loaded before the processes start, so forked processes share it
+        load_sent_detector(self.punkt_data_path)
+        if self.num_parallel_calls > 1 and len(missing) > chunksize:
+            from multiprocessing import Pool
+            texts_chunks = [list(chunk) for chunk in _chunks(list(missing.values()), chunksize)]
+            with Pool(self.num_parallel_calls) as p:
+                splits = [sentences
+                          for chunk in p.starmap(_split_texts, [(self.punkt_data_path, chunk)
+                                                                for chunk in texts_chunks])
+                          for sentences in chunk]
+        else:
+            splits = _split_texts(self.punkt_data_path, list(missing.values()))
+        # Splits of this call are returned even if they do not fit in the cache
+        found = dict(zip(missing, splits))
+        for key, sentences in found.items():
+            self._cache_put(key, sentences)
+
+        return [list(found[key]) if key in found else self(text)
+                for key, text in zip(keys, texts)]
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 if __name__ == '__main__':
     text = "Punkt knows that the periods in Mr. Smith and Johann S. Bach do "
     "not mark sentence boundaries.  And sometimes sentences can start with "
@@ -27,6 +27,8 @@ ROUGE-1.5.5.pl -e data -n 2 -a settings.xml
 Or with use_stemmer=True:
 ROUGE-1.5.5.pl -m -e data -n 2 -a settings.xml
 
+rougeW, rougeS4 and rougeSU4 correspond to the -w 1.2, -2 4 and -2 4 -u options.
+
 In these examples settings.xml lists input files and formats.
 """
 
@@ -34,6 +36,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bisect
 import collections
 import re
 
@@ -56,25 +59,51 @@ class RougeScorer(scoring.BaseScorer):
                           'The quick brown dog jumps on the log.')
   """
 
-  def __init__(self, rouge_types, use_stemmer=False, tokenization_fn=None):
+  def __init__(self, rouge_types, use_stemmer=False, tokenization_fn=None,
+               weight=1.2, lcs_max_band=None):
     """Initializes a new RougeScorer.
 
     Valid rouge types that can be computed are:
       rougen (e.g. rouge1, rouge2): n-gram based scoring.
       rougeL: Longest common subsequence based scoring.
+      rougeW: Weighted longest common subsequence based scoring.
+      rougeSd, rougeSUd (e.g. rougeS4, rougeSU4, rougeS*): Skip-bigram based
+        scoring with at most d tokens skipped (any number for *), and with
+        unigrams for rougeSUd.
 
     Args:
       rouge_types: A list of rouge types to calculate.
       use_stemmer: Bool indicating whether Porter stemmer should be used to
         strip word suffixes to improve matching. (Only available with default tokenizer)
       tokenization_fn: Function that take string as input, and list of tokens as return
-    Returns:
-      A dict mapping rouge types to Score tuples.
+      weight: Weight of consecutive matches for rougeW (must be > 1).
+      lcs_max_band: If set, rougeL of texts longer than this many tokens is
+        computed by lcs_length with this max_band, which bounds its cost for
+        degenerate (e.g. endlessly repeated) outputs. Such scores may then
+        be lower bounds; num_inexact_lcs counts them.
+    Raises:
+      ValueError: If an invalid rouge type is encountered.
     """
 
     self.rouge_types = rouge_types
-    self._stemmer = porter.PorterStemmer() if use_stemmer else None
+    self._stemmer = _CachedStemmer() if use_stemmer else None
     self._tokenization_fn = tokenization_fn
+    self.weight = weight
+    self.lcs_max_band = lcs_max_band
+    self.num_inexact_lcs = 0
+    # tokenize_ids: tokens of every vocab id, as ids of the tokens they give
+    self._id_tokens = {}
+    self._token_ids = {}
+
+    # Parsed once; score_array() runs this plan for every pair.
+    self._plan = [_parse_rouge_type(rouge_type) for rouge_type in rouge_types]
+    self._ngram_orders = sorted(
+        set(arg for kind, arg in self._plan if kind == _NGRAM))
+    self._skip_distances = sorted(
+        set(arg[0] for kind, arg in self._plan if kind == _SKIP_BIGRAM))
+    self._use_unigrams_but_last = any(
+        kind == _SKIP_BIGRAM and arg[1] for kind, arg in self._plan)
+    self._use_lcs = any(kind == _LCS for kind, _ in self._plan)
 
   def score(self, target, prediction):
     """Calculates rouge scores between the target and prediction.
@@ -84,35 +113,225 @@ class RougeScorer(scoring.BaseScorer):
       prediction: Text containing the predicted text.
     Returns:
       A dict mapping each rouge type to a Score object.
+    """
+
+    scores = self.score_array(target, prediction).tolist()
+    return {rouge_type: scoring.Score(*row)
+            for rouge_type, row in zip(self.rouge_types, scores)}
+
+  def score_array(self, target, prediction, out=None):
+    """Calculates rouge scores between the target and prediction.
+
+    Args:
+      target: Text containing the target (ground truth) text.
+      prediction: Text containing the predicted text.
+      out: Optional float array of shape (len(rouge_types), 3) to write to.
+    Returns:
+      An array with the precision, recall and f-measure of each rouge type
+      in rouge_types, one row per type.
+    """
+
+    return self.score_tokens(self.tokenize(target), self.tokenize(prediction), out)
+
+  def score_tokens(self, target_tokens, prediction_tokens, out=None):
+    """Same as score_array, for already tokenized (and stemmed) texts.
+
+    Tokens may be of any hashable type, e.g. interned integer ids.
+    """
+
+    if out is None:
+      out = np.zeros((len(self._plan), 3))
+    self._score_prepared(self._prepare(target_tokens),
+                         self._prepare(prediction_tokens), out)
+    return out
+
+  def score_multi(self, targets, prediction, aggregation="max", out=None):
+    """Calculates rouge scores between several targets and the prediction.
+
+    The prediction is tokenized, and its n-grams and LCS index are built,
+    once for all targets.
+
+    Args:
+      targets: A list of texts containing the target (ground truth) texts.
+      prediction: Text containing the predicted text.
+      aggregation: How scores against the targets are combined, per rouge
+        type: "max" takes the scores of the target with the best f-measure,
+        "mean" averages them, and "jackknife" averages the "max" scores of
+        the len(targets) subsets that leave one target out (as described in
+        the ROUGE paper).
+      out: Optional float array of shape (len(rouge_types), 3) to write to.
+    Returns:
+      An array with the precision, recall and f-measure of each rouge type
+      in rouge_types, one row per type.
     Raises:
-      ValueError: If an invalid rouge type is encountered.
+      ValueError: If targets is empty or aggregation is unknown.
     """
 
+    return self.score_multi_tokens([self.tokenize(target) for target in targets],
+                                   self.tokenize(prediction), aggregation, out)
+
+  def score_multi_tokens(self, targets_tokens, prediction_tokens,
+                         aggregation="max", out=None):
+    """Same as score_multi, for already tokenized (and stemmed) texts."""
+
+    if aggregation not in _AGGREGATIONS:
+      raise ValueError("Invalid aggregation: %s" % aggregation)
+    if not targets_tokens:
+      raise ValueError("score_multi requires at least one target")
+    if out is None:
+      out = np.zeros((len(self._plan), 3))
+
+    prediction = self._prepare(prediction_tokens)
+    scores = np.zeros((len(targets_tokens), len(self._plan), 3))
+    for k, target_tokens in enumerate(targets_tokens):
+      self._score_prepared(self._prepare(target_tokens), prediction, scores[k])
+    out[:] = _AGGREGATIONS[aggregation](scores)
+    return out
+
+  def tokenize(self, text):
+    """Tokens of text, as the scorer compares them."""
     if self._tokenization_fn:
-        target_tokens = self._tokenization_fn(target)
-        prediction_tokens = self._tokenization_fn(prediction)
-    else:
-        target_tokens = tokenize.tokenize(target, self._stemmer)
-        prediction_tokens = tokenize.tokenize(prediction, self._stemmer)
-    result = {}
+      return self._tokenization_fn(text)
+    return tokenize.tokenize(text, self._stemmer)
 
-    for rouge_type in self.rouge_types:
-      if rouge_type == "rougeL":
-        # Rouge from longest common subsequences.
-        scores = _score_lcs(target_tokens, prediction_tokens)
-      elif re.match(r"rouge[0-9]$", rouge_type):
+  def tokenize_ids(self, ids, vocab):
+    """Tokens of a text given as token ids, where vocab[id] is the token.
+
+    Each id is tokenized once, as tokenize() tokenizes its token, and the
+    tokens it gives are interned as ints, so the text becomes the tokens of
+    tokenize(" ".join(vocab[i] for i in ids)) without building any string.
+    The scorer keeps that mapping, so it must always be given the same vocab.
+    """
+
+    if isinstance(ids, np.ndarray):
+      ids = ids.tolist()
+    tokens = []
+    for token_id in ids:
+      id_tokens = self._id_tokens.get(token_id)
+      if id_tokens is None:
+        id_tokens = self._id_tokens[token_id] = [
+            self._token_ids.setdefault(token, len(self._token_ids))
+            for token in self.tokenize(vocab[token_id])]
+      tokens.extend(id_tokens)
+    return tokens
+
+  def _prepare(self, tokens):
+    """Counts the n-grams and skip-bigrams of one text for all rouge types."""
+
+    return _Prepared(
+        tokens=tokens,
+        ngrams=_create_ngrams_by_order(tokens, self._ngram_orders),
+        skip_bigrams={skip_distance: _create_skip_bigrams(tokens, skip_distance)
+                      for skip_distance in self._skip_distances},
+        unigrams_but_last=(_create_ngrams(tokens[:-1], 1)
+                           if self._use_unigrams_but_last else None),
+        positions=_token_positions(tokens) if self._use_lcs else None)
+
+  def _score_prepared(self, target, prediction, out):
+    for k, (kind, arg) in enumerate(self._plan):
+      if kind == _NGRAM:
         # Rouge from n-grams.
-        n = int(rouge_type[5:])
-        if n <= 0:
-          raise ValueError("rougen requires positive n: %s" % rouge_type)
-        target_ngrams = _create_ngrams(target_tokens, n)
-        prediction_ngrams = _create_ngrams(prediction_tokens, n)
-        scores = _score_ngrams(target_ngrams, prediction_ngrams)
+        hits = _count_overlap(target.ngrams[arg], prediction.ngrams[arg])
+        out[k] = _precision_recall_fmeasure(
+            hits, len(target.tokens) - arg + 1, len(prediction.tokens) - arg + 1)
+      elif kind == _SKIP_BIGRAM:
+        # Rouge from skip-bigrams (and unigrams).
+        skip_distance, use_unigrams = arg
+        target_grams = target.skip_bigrams[skip_distance]
+        prediction_grams = prediction.skip_bigrams[skip_distance]
+        hits = _count_overlap(target_grams, prediction_grams)
+        target_count = sum(six.itervalues(target_grams))
+        prediction_count = sum(six.itervalues(prediction_grams))
+        if use_unigrams:
+          # As ROUGE-1.5.5.pl, the last token is not counted as a unigram.
+          hits += _count_overlap(target.unigrams_but_last,
+                                 prediction.unigrams_but_last)
+          target_count += max(len(target.tokens) - 1, 0)
+          prediction_count += max(len(prediction.tokens) - 1, 0)
+        out[k] = _precision_recall_fmeasure(hits, target_count, prediction_count)
+      elif kind == _LCS:
+        # Rouge from longest common subsequences.
+        if not target.tokens or not prediction.tokens:
+          out[k] = 0
+          continue
+        if (self.lcs_max_band is None or
+            max(len(target.tokens), len(prediction.tokens)) <= self.lcs_max_band):
+          lcs_length = _lcs_length(target.tokens, prediction.positions)
+        else:
+          lcs_length, exact = _banded_lcs_length(
+              target.tokens, prediction.tokens, self.lcs_max_band)
+          if not exact:
+            self.num_inexact_lcs += 1
+        precision = lcs_length / len(prediction.tokens)
+        recall = lcs_length / len(target.tokens)
+        out[k] = precision, recall, scoring.fmeasure(precision, recall)
       else:
-        raise ValueError("Invalid rouge type: %s" % rouge_type)
-      result[rouge_type] = scores
+        # Rouge from weighted longest common subsequences.
+        out[k] = _score_wlcs(target.tokens, prediction.tokens, self.weight)
+
+
+class _CachedStemmer(object):
+  """Porter stemmer that remembers the stem of every word it has seen."""
+
+  def __init__(self):
+    self._stemmer = porter.PorterStemmer()
+    self._stems = {}
+
+  def stem(self, word):
+    stem = self._stems.get(word)
+    if stem is None:
+      stem = self._stems[word] = self._stemmer.stem(word)
+    return stem
+
+
+_NGRAM, _LCS, _WLCS, _SKIP_BIGRAM = range(4)
+
+_Prepared = collections.namedtuple(
+    "_Prepared",
+    ["tokens", "ngrams", "skip_bigrams", "unigrams_but_last", "positions"])
+
+
+def _max_by_fmeasure(scores):
+  best = np.argmax(scores[:, :, 2], axis=0)
+  return scores[best, np.arange(scores.shape[1])]
+
+
+def _jackknife(scores):
+  if len(scores) == 1:
+    return scores[0]
+  return np.mean([_max_by_fmeasure(np.delete(scores, k, axis=0))
+                  for k in xrange(len(scores))], axis=0)
 
-    return result
+
+# Combine scores of shape (num_targets, num_rouge_types, 3) over targets
+_AGGREGATIONS = {
+    "max": _max_by_fmeasure,
+    "mean": lambda scores: np.mean(scores, axis=0),
+    "jackknife": _jackknife,
+}
+
+
+def _parse_rouge_type(rouge_type):
+  """Returns the kind of a rouge type and its argument.
+
+  Raises:
+    ValueError: If an invalid rouge type is encountered.
+  """
+
+  if rouge_type == "rougeL":
+    return _LCS, None
+  if rouge_type == "rougeW":
+    return _WLCS, None
+  match = re.match(r"rougeS(U)?([0-9]+|\*)$", rouge_type)
+  if match:
+    skip_distance = -1 if match.group(2) == "*" else int(match.group(2))
+    return _SKIP_BIGRAM, (skip_distance, bool(match.group(1)))
+  if re.match(r"rouge[0-9]$", rouge_type):
+    n = int(rouge_type[5:])
+    if n <= 0:
+      raise ValueError("rougen requires positive n: %s" % rouge_type)
+    return _NGRAM, n
+  raise ValueError("Invalid rouge type: %s" % rouge_type)
 
 
 def _create_ngrams(tokens, n):
@@ -131,59 +350,229 @@ def _create_ngrams(tokens, n):
   return ngrams
 
 
-def _score_lcs(target_tokens, prediction_tokens):
-  """Computes LCS (Longest Common Subsequence) rouge scores.
+def _create_ngrams_by_order(tokens, orders):
+  """Creates ngrams of several orders from the given list of tokens.
+
+  Args:
+    tokens: A list of tokens from which ngrams are created.
+    orders: A list of ngram orders, e.g. [1, 2].
+  Returns:
+    A dictionary mapping each order to a Counter of ngrams of that order.
+  """
+
+  # Counting zipped token slices runs in C, much faster than a python loop
+  # over positions.
+  return {n: collections.Counter(zip(*[tokens[i:] for i in xrange(n)]))
+          for n in orders}
+
+
+def _count_overlap(target_ngrams, prediction_ngrams):
+  """Number of clipped matches between two ngram Counters."""
+
+  if len(target_ngrams) > len(prediction_ngrams):
+    target_ngrams, prediction_ngrams = prediction_ngrams, target_ngrams
+  hits = 0
+  for ngram, count in six.iteritems(target_ngrams):
+    other = prediction_ngrams.get(ngram)
+    if other:
+      hits += min(count, other)
+  return hits
+
+
+def _precision_recall_fmeasure(hits, target_count, prediction_count):
+  precision = hits / max(prediction_count, 1)
+  recall = hits / max(target_count, 1)
+  return precision, recall, scoring.fmeasure(precision, recall)
+
+
+def _create_skip_bigrams(tokens, skip_distance):
+  """Creates skip-bigrams from the given list of tokens in one pass.
+
+  Args:
+    tokens: A list of tokens from which skip-bigrams are created.
+    skip_distance: Maximum number of tokens between the two tokens of a
+      skip-bigram, or a negative number for no limit.
+  Returns:
+    A dictionary mapping each skip-bigram to the number of occurrences.
+  """
+
+  skip_bigrams = collections.Counter()
+  for i in xrange(len(tokens) - 1):
+    end = len(tokens) if skip_distance < 0 else min(len(tokens), i + skip_distance + 2)
+    for j in xrange(i + 1, end):
+      skip_bigrams[(tokens[i], tokens[j])] += 1
+  return skip_bigrams
+
+
+def _token_positions(tokens):
+  """Maps each token to its positions in tokens, last position first."""
+
+  positions = collections.defaultdict(list)
+  for i in xrange(len(tokens) - 1, -1, -1):
+    positions[tokens[i]].append(i)
+  return dict(positions)
+
+
+def _lcs_length(target_tokens, prediction_positions):
+  """Computes the LCS length from the positions of the prediction tokens.
+
+  Hunt-Szymanski: only the matching (target, prediction) token pairs are
+  visited, so a prediction indexed once can be matched against many targets.
+
+  Args:
+    target_tokens: Tokens from the target text.
+    prediction_positions: Output of _token_positions for the prediction.
+  Returns:
+    The length of the longest common subsequence.
+  """
+
+  # thresholds[k]: smallest prediction position that ends a common
+  # subsequence of length k + 1 so far
+  thresholds = []
+  for token in target_tokens:
+    for j in prediction_positions.get(token, ()):
+      k = bisect.bisect_left(thresholds, j)
+      if k == len(thresholds):
+        thresholds.append(j)
+      else:
+        thresholds[k] = j
+  return len(thresholds)
+
+
+def lcs_length(target_tokens, prediction_tokens, max_band=None):
+  """Computes the length of the longest common subsequence of two texts.
 
   Args:
     target_tokens: Tokens from the target text.
     prediction_tokens: Tokens from the predicted text.
+    max_band: If set and a text is longer than this, only the cells of the
+      LCS table within this distance of its diagonal are computed (see
+      _banded_lcs_length), in O(max(len) * max_band) time and O(len) memory.
   Returns:
-    A Score object containing computed scores.
+    A (length, exact) tuple. If exact is False, length is a lower bound.
   """
 
-  if not target_tokens or not prediction_tokens:
-    return scoring.Score(precision=0, recall=0, fmeasure=0)
+  if max_band is None or max(len(target_tokens), len(prediction_tokens)) <= max_band:
+    return _lcs_length(target_tokens, _token_positions(prediction_tokens)), True
+  return _banded_lcs_length(target_tokens, prediction_tokens, max_band)
 
-  # Compute length of LCS from the bottom up in a table (DP appproach).
-  cols = len(prediction_tokens) + 1
-  rows = len(target_tokens) + 1
-  lcs_table = np.zeros((rows, cols))
-  for i in xrange(1, rows):
-    for j in xrange(1, cols):
-      if target_tokens[i - 1] == prediction_tokens[j - 1]:
-        lcs_table[i, j] = lcs_table[i - 1, j - 1] + 1
-      else:
-        lcs_table[i, j] = max(lcs_table[i - 1, j], lcs_table[i, j - 1])
-  lcs_length = lcs_table[-1, -1]
 
-  precision = lcs_length / len(prediction_tokens)
-  recall = lcs_length / len(target_tokens)
-  fmeasure = scoring.fmeasure(precision, recall)
+def _banded_lcs_length(target_tokens, prediction_tokens, max_band):
+  """Computes the LCS length in a band around the diagonal, as Ukkonen.
+
+  The band is doubled, up to max_band, until it provably contains every
+  longest common subsequence: one of length L never strays more than
+  max(len) - L cells from the diagonal.
+
+  Returns:
+    A (length, exact) tuple. If exact is False, length is a lower bound.
+  """
+
+  longest = max(len(target_tokens), len(prediction_tokens))
+  band = min(max(abs(len(target_tokens) - len(prediction_tokens)), 16), max_band)
+  while True:
+    length = _lcs_length_in_band(target_tokens, prediction_tokens, band)
+    if longest - length <= band:
+      return length, True
+    if band >= max_band:
+      return length, False
+    band = min(2 * band, max_band)
+
+
+def _lcs_length_in_band(target_tokens, prediction_tokens, band):
+  """LCS table restricted to |i - j| <= band, as a lower bound of the LCS.
+
+  Only two rows are kept. Cells just outside the band hold stale values of
+  earlier rows, which are still lengths of common subsequences of the
+  prefixes, so every cell stays a lower bound.
+  """
+
+  previous_row = [0] * (len(prediction_tokens) + 1)
+  row = [0] * (len(prediction_tokens) + 1)
+  best = 0
+  for i, target_token in enumerate(target_tokens, 1):
+    low = max(1, i - band)
+    high = min(len(prediction_tokens), i + band)
+    if low > high:
+      break
+    for j in xrange(low, high + 1):
+      if target_token == prediction_tokens[j - 1]:
+        row[j] = previous_row[j - 1] + 1
+      else:
+        row[j] = max(previous_row[j], row[j - 1])
+    best = max(best, row[high])
+    previous_row, row = row, previous_row
+  return best
 
-  return scoring.Score(precision=precision, recall=recall, fmeasure=fmeasure)
 
+def _score_wlcs(target_tokens, prediction_tokens, weight):
+  """Computes WLCS (Weighted Longest Common Subsequence) rouge scores.
 
-def _score_ngrams(target_ngrams, prediction_ngrams):
-  """Compute n-gram based rouge scores.
+  As in ROUGE-1.5.5.pl, each run of consecutive target tokens on the
+  weighted LCS counts len(run)**weight, and the recall denominator
+  len(target_tokens)**weight is weighted once more.
 
   Args:
-    target_ngrams: A Counter object mapping each ngram to number of
-      occurrences for the target text.
-    prediction_ngrams: A Counter object mapping each ngram to number of
-      occurrences for the prediction text.
+    target_tokens: Tokens from the target text.
+    prediction_tokens: Tokens from the predicted text.
+    weight: Weight of consecutive matches.
   Returns:
     A Score object containing computed scores.
   """
 
-  intersection_ngrams_count = 0
-  for ngram in six.iterkeys(target_ngrams):
-    intersection_ngrams_count += min(target_ngrams[ngram],
-                                     prediction_ngrams[ngram])
-  target_ngrams_count = sum(target_ngrams.values())
-  prediction_ngrams_count = sum(prediction_ngrams.values())
+  if not target_tokens or not prediction_tokens:
+    return scoring.Score(precision=0, recall=0, fmeasure=0)
 
-  precision = intersection_ngrams_count / max(prediction_ngrams_count, 1)
-  recall = intersection_ngrams_count / max(target_ngrams_count, 1)
+  # Weighted LCS table, with the length of the run of consecutive matches
+  # ending at each cell and the direction taken (0: diagonal, 1: up, 2: left),
+  # as lists of rows (as in rouge155._wlcs_inner), which python indexes much
+  # faster than numpy arrays cell by cell.
+  cols = len(prediction_tokens) + 1
+  rows = len(target_tokens) + 1
+  wlcs_table = [[0.0] * cols for _ in xrange(rows)]
+  run_table = [[0] * cols for _ in xrange(rows)]
+  direction = [[0] * cols for _ in xrange(rows)]
+  for i in xrange(1, rows):
+    token = target_tokens[i - 1]
+    wlcs_prev, wlcs_row = wlcs_table[i - 1], wlcs_table[i]
+    run_prev, run_row = run_table[i - 1], run_table[i]
+    direction_row = direction[i]
+    for j in xrange(1, cols):
+      if token == prediction_tokens[j - 1]:
+        k = run_prev[j - 1]
+        wlcs_row[j] = wlcs_prev[j - 1] + (k + 1) ** weight - k ** weight
+        run_row[j] = k + 1
+      elif wlcs_prev[j] >= wlcs_row[j - 1]:
+        wlcs_row[j] = wlcs_prev[j]
+        direction_row[j] = 1
+      else:
+        wlcs_row[j] = wlcs_row[j - 1]
+        direction_row[j] = 2
+
+  # Mark the target tokens on the weighted LCS
+  hit_mask = [False] * len(target_tokens)
+  i, j = rows - 1, cols - 1
+  while i > 0 and j > 0:
+    if direction[i][j] == 0:
+      i, j = i - 1, j - 1
+      hit_mask[i] = True
+    elif direction[i][j] == 1:
+      i -= 1
+    else:
+      j -= 1
+
+  hit = 0
+  run = 0
+  for marked in hit_mask:
+    if marked:
+      run += 1
+    elif run:
+      hit += run ** weight
+      run = 0
+  hit += run ** weight
+
+  precision = (hit / len(prediction_tokens) ** weight) ** (1 / weight)
+  recall = (hit / len(target_tokens) ** (weight * weight)) ** (1 / weight)
   fmeasure = scoring.fmeasure(precision, recall)
 
   return scoring.Score(precision=precision, recall=recall, fmeasure=fmeasure)
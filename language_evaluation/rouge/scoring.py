@@ -78,13 +78,16 @@ class BootstrapAggregator(object):
 
   def __init__(self,
                confidence_interval=0.95,
-               n_samples=1000):
+               n_samples=1000,
+               seed=None):
     """Initializes a BootstrapAggregator object.
 
     Args:
       confidence_interval: Confidence interval to compute on the mean as a
         decimal.
       n_samples: Number of samples to use for bootstrap resampling.
+      seed: Seed of the resampling, so intervals are reproducible. If None,
+        samples are drawn from the global np.random state.
     Raises:
       ValueError: If invalid argument is given.
     """
@@ -96,6 +99,7 @@ class BootstrapAggregator(object):
 
     self._n_samples = n_samples
     self._confidence_interval = confidence_interval
+    self._random = np.random if seed is None else np.random.RandomState(seed)
     self._scores = collections.defaultdict(list)
 
   def add_scores(self, scores):
@@ -147,7 +151,7 @@ class BootstrapAggregator(object):
     # Matrix of (bootstrap sample, measure).
     sample_mean = np.zeros((self._n_samples, matrix.shape[1]))
     for i in xrange(self._n_samples):
-      sample_idx = np.random.choice(
+      sample_idx = self._random.choice(
           np.arange(matrix.shape[0]), size=matrix.shape[0])
       sample = matrix[sample_idx, :]
       sample_mean[i, :] = np.mean(sample, axis=0)
@@ -0,0 +1,492 @@
+"""In-process port of ROUGE-1.5.5.pl.
+
+`Rouge155Scorer` reproduces, number for number, the per-document scores and
+the bootstrap averages that RELEASE-1.5.5/ROUGE-1.5.5.pl prints for
+`-a -c 95 -m -n 2 -w 1.2` (the arguments Rouge155Evaluator uses), and for
+other values of -c, -n, -p, -r and -w, with or without -m. It follows the
+perl script step by step, including the quirks that show in its numbers:
+
+  - every P/R/F is rounded to 5 decimals before it is used any further,
+  - the ROUGE-W recall and precision denominators are weighted twice,
+  - LCS hits are clipped by unigram counts shared over all sentences,
+  - the reported average is the mean of the bootstrap means, drawn with
+    perl's drand48 seeded by `srand(i)` for the i-th resample.
+
+With several models (references), scores use the model average formula
+(-f A): hits and counts are summed over the models. ROUGE-1.5.5 does not
+jackknife, so neither does this port.
+
+WordNet exception stemming (-m) looks words up in data/WordNet-2.0.exc.db.
+The copy shipped in RELEASE-1.5.5/data is an empty database, so the perl
+script only applies the Porter stemmer, and so does this port by default.
+Pass `use_wordnet_exceptions=True` to match a ROUGE install whose database
+was rebuilt from the WordNet-2.0-Exceptions/*.exc files with
+buildExeptionDB.pl.
+"""
+import os
+import re
+
+import numpy as np
+
+
+__PATH__ = os.path.abspath(os.path.dirname(__file__))
+WORDNET_EXCEPTIONS_DIR = os.path.join(
+    __PATH__, 'pyrouge', 'RELEASE-1.5.5', 'data', 'WordNet-2.0-Exceptions')
+
+# Options of ROUGE-1.5.5.pl this port understands; -a, -d and -e do not change scores
+_SUPPORTED_OPTIONS = {'-a': False, '-d': False, '-e': True, '-m': False,
+                      '-c': True, '-n': True, '-p': True, '-r': True, '-w': True}
+
+
+def load_wordnet_exceptions(exceptions_dir=WORDNET_EXCEPTIONS_DIR,
+                            parts_of_speech=('noun', 'adv', 'verb', 'adj')):
+    """Inflected form -> base form, as buildExeptionDB.pl stores them.
+
+    buildExeptionDB.pl reads the *.exc files in directory order, and a later
+    file wins on the 6 words found in two files (e.g. "better" is "good" in
+    adj.exc and "well" in adv.exc). `parts_of_speech` gives that order."""
+    exceptions = {}
+    for pos in parts_of_speech:
+        with open(os.path.join(exceptions_dir, pos + '.exc')) as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    exceptions[fields[0]] = fields[1]
+    return exceptions
+
+
+def _round(x):
+    # sprintf("%7.5f", x), read back as a number
+    return float("%7.5f" % x)
+
+
+def _fmeasure(precision, recall, alpha):
+    if (1 - alpha) * precision + alpha * recall > 0:
+        return _round((precision * recall) / ((1 - alpha) * precision + alpha * recall))
+    return _round(0)
+
+
+def _ratio(hit, count):
+    return _round(hit / count) if count != 0 else _round(0)
+
+
+# =================================================
+# Porter stemmer, as `sub stem` in ROUGE-1.5.5.pl
+# =================================================
+_STEP2 = {'ational': 'ate', 'tional': 'tion', 'enci': 'ence', 'anci': 'ance', 'izer': 'ize',
+          'bli': 'ble', 'alli': 'al', 'entli': 'ent', 'eli': 'e', 'ousli': 'ous',
+          'ization': 'ize', 'ation': 'ate', 'ator': 'ate', 'alism': 'al', 'iveness': 'ive',
+          'fulness': 'ful', 'ousness': 'ous', 'aliti': 'al', 'iviti': 'ive', 'biliti': 'ble',
+          'logi': 'log'}
+_STEP3 = {'icate': 'ic', 'ative': '', 'alize': 'al', 'iciti': 'ic', 'ical': 'ic',
+          'ful': '', 'ness': ''}
+
+_c = "[^aeiou]"
+_v = "[aeiouy]"
+_C = _c + "[^aeiouy]*"
+_V = _v + "[aeiou]*"
+_MGR0 = re.compile("^(" + _C + ")?" + _V + _C)
+_MEQ1 = re.compile("^(" + _C + ")?" + _V + _C + "(" + _V + ")?$")
+_MGR1 = re.compile("^(" + _C + ")?" + _V + _C + _V + _C)
+_VOWEL_IN_STEM = re.compile("^(" + _C + ")?" + _v)
+_CVC = re.compile("^" + _C + _v + "[^aeiouwxy]$")
+
+_STEP2_SUFFIX = re.compile(
+    "(ational|tional|enci|anci|izer|bli|alli|entli|eli|ousli|ization|ation|ator|"
+    "alism|iveness|fulness|ousness|aliti|iviti|biliti|logi)$")
+_STEP3_SUFFIX = re.compile("(icate|ative|alize|iciti|ical|ful|ness)$")
+_STEP4_SUFFIX = re.compile("(al|ance|ence|er|ic|able|ible|ant|ement|ou|ism|ate|iti|ous|ive|ize)$")
+
+
+def porter_stem(w):
+    if len(w) < 3:
+        return w
+    # map initial y to Y so that the patterns never treat it as vowel
+    firstch = w[0]
+    if firstch == 'y':
+        w = 'Y' + w[1:]
+
+    # Step 1a
+    m = re.search("(ss|i)es$", w)
+    if m:
+        w = w[:m.start()] + m.group(1)
+    else:
+        m = re.search("([^s])s$", w)
+        if m:
+            w = w[:m.start()] + m.group(1)
+    # Step 1b
+    m = re.search("eed$", w)
+    if m:
+        if _MGR0.search(w[:m.start()]):
+            w = w[:-1]
+    else:
+        m = re.search("(ed|ing)$", w)
+        if m:
+            stem = w[:m.start()]
+            if _VOWEL_IN_STEM.search(stem):
+                w = stem
+                if re.search("(at|bl|iz)$", w):
+                    w += "e"
+                elif re.search(r"([^aeiouylsz])\1$", w):
+                    w = w[:-1]
+                elif _CVC.search(w):
+                    w += "e"
+    # Step 1c
+    m = re.search("y$", w)
+    if m:
+        stem = w[:m.start()]
+        if _VOWEL_IN_STEM.search(stem):
+            w = stem + "i"
+    # Step 2
+    m = _STEP2_SUFFIX.search(w)
+    if m:
+        stem = w[:m.start()]
+        if _MGR0.search(stem):
+            w = stem + _STEP2[m.group(1)]
+    # Step 3
+    m = _STEP3_SUFFIX.search(w)
+    if m:
+        stem = w[:m.start()]
+        if _MGR0.search(stem):
+            w = stem + _STEP3[m.group(1)]
+    # Step 4 (-ement words do not try -ment and -ent, as modified in ROUGE)
+    m = _STEP4_SUFFIX.search(w)
+    if m:
+        stem = w[:m.start()]
+        if _MGR1.search(stem):
+            w = stem
+    m = re.search("ment$", w)
+    if m:
+        stem = w[:m.start()]
+        if _MGR1.search(stem):
+            w = stem
+    m = re.search("ent$", w)
+    if m:
+        stem = w[:m.start()]
+        if _MGR1.search(stem):
+            w = stem
+    else:
+        m = re.search("(s|t)(ion)$", w)
+        if m:
+            stem = w[:m.start()] + m.group(1)
+            if _MGR1.search(stem):
+                w = stem
+    # Step 5
+    m = re.search("e$", w)
+    if m:
+        stem = w[:m.start()]
+        if _MGR1.search(stem) or (_MEQ1.search(stem) and not _CVC.search(stem)):
+            w = stem
+    if re.search("ll$", w) and _MGR1.search(w):
+        w = w[:-1]
+
+    # and turn initial Y back to y
+    if firstch == 'y':
+        w = 'y' + w[1:]
+    return w
+
+
+# =================================================
+# LCS, as `sub lcs_inner`, `sub wlcs_inner` and `sub markLCS`
+# =================================================
+def _mark_lcs(hit_mask, b, i, j):
+    while i != 0 and j != 0:
+        move = b[i][j]
+        if move == 0:
+            i -= 1
+            j -= 1
+            hit_mask[i] = 1
+        elif move == 1:
+            i -= 1
+        else:
+            j -= 1
+
+
+def _lcs_inner(model, peer, hit_mask):
+    m, n = len(model), len(peer)
+    if m == 0:
+        return
+    # b: 0 = diagonal, 1 = up, 2 = left
+    c = [[0] * (n + 1) for _ in range(m + 1)]
+    b = [[0] * (n + 1) for _ in range(m + 1)]
+    for i in range(1, m + 1):
+        c_prev, c_cur, b_cur = c[i - 1], c[i], b[i]
+        token = model[i - 1]
+        for j in range(1, n + 1):
+            if token == peer[j - 1]:
+                c_cur[j] = c_prev[j - 1] + 1
+                b_cur[j] = 0
+            elif c_prev[j] >= c_cur[j - 1]:
+                c_cur[j] = c_prev[j]
+                b_cur[j] = 1
+            else:
+                c_cur[j] = c_cur[j - 1]
+                b_cur[j] = 2
+    _mark_lcs(hit_mask, b, m, n)
+
+
+def _wlcs_inner(model, peer, hit_mask, weight):
+    m, n = len(model), len(peer)
+    if m == 0:
+        return
+    c = [[0.0] * (n + 1) for _ in range(m + 1)]
+    b = [[0] * (n + 1) for _ in range(m + 1)]
+    l = [[0] * (n + 1) for _ in range(m + 1)]
+    for i in range(1, m + 1):
+        token = model[i - 1]
+        for j in range(1, n + 1):
+            if token == peer[j - 1]:
+                k = l[i - 1][j - 1]
+                c[i][j] = c[i - 1][j - 1] + (k + 1) ** weight - k ** weight
+                b[i][j] = 0
+                l[i][j] = k + 1
+            elif c[i - 1][j] >= c[i][j - 1]:
+                c[i][j] = c[i - 1][j]
+                b[i][j] = 1
+            else:
+                c[i][j] = c[i][j - 1]
+                b[i][j] = 2
+    _mark_lcs(hit_mask, b, m, n)
+
+
+def _drand48_indices(num_resamples, num_instances):
+    """Yield, for each draw, the instance perl's `int(rand(N))` picks after
+    `srand(i)`, for all resamples i at once."""
+    state = (np.arange(num_resamples, dtype=np.uint64) << np.uint64(16)) | np.uint64(0x330E)
+    a, c, mask = np.uint64(0x5DEECE66D), np.uint64(0xB), np.uint64((1 << 48) - 1)
+    for _ in range(num_instances):
+        # uint64 arithmetic wraps modulo 2**64, a multiple of 2**48
+        state = (state * a + c) & mask
+        yield (num_instances * (state.astype(np.float64) * 2.0 ** -48)).astype(np.int64)
+
+
+class Rouge155Scorer(object):
+    """Pure python ROUGE-1.5.5 for ROUGE-N, ROUGE-L and ROUGE-W.
+
+    A document is a list of sentences (one per line of the summary file) for
+    the peer and a list of such lists, one per model, for the references.
+
+    Sample usage:
+        scorer = Rouge155Scorer.from_rouge_args("-a -c 95 -m -n 2 -w 1.2")
+        per_doc = scorer.score_documents(
+            [['i am a boy', 'she is a girl']],
+            [[['i am a boy', 'she is not a girl']]])
+        results = scorer.aggregate(per_doc)
+    """
+    def __init__(self,
+                 n=2,
+                 weight=1.2,
+                 stem=True,
+                 alpha=0.5,
+                 confidence=95,
+                 num_resamples=1000,
+                 use_wordnet_exceptions=False):
+        self.n = n
+        self.weight = weight
+        self.stem = stem
+        self.alpha = alpha
+        self.confidence = confidence
+        self.num_resamples = num_resamples
+        self._exceptions = load_wordnet_exceptions() if use_wordnet_exceptions else {}
+        self._stems = {}
+
+    @classmethod
+    def from_rouge_args(cls, rouge_args, **kwargs):
+        """Scorer for a ROUGE-1.5.5.pl command line (without the config file).
+
+        Raises ValueError for options this port does not implement
+        (-2, -3, -b, -f B, -l, -s, -t, -u, -U, -x, -z, ...)."""
+        options = rouge_args.split()
+        # perl defaults, and no ROUGE-N / ROUGE-W unless -n / -w are given
+        config = {'n': 0, 'weight': None, 'stem': False, 'alpha': 0.5,
+                  'confidence': 95, 'num_resamples': 1000}
+        i = 0
+        while i < len(options):
+            option = options[i]
+            if option not in _SUPPORTED_OPTIONS and option != '-f':
+                raise ValueError("ROUGE option {} is not supported by the python backend".format(option))
+            value = None
+            if _SUPPORTED_OPTIONS.get(option, True):
+                i += 1
+                value = options[i]
+            if option == '-f' and value != 'A':
+                raise ValueError("Only the model average scoring formula (-f A) is supported")
+            elif option == '-m':
+                config['stem'] = True
+            elif option == '-c':
+                config['confidence'] = float(value)
+            elif option == '-n':
+                config['n'] = int(value)
+            elif option == '-p':
+                config['alpha'] = float(value)
+            elif option == '-r':
+                config['num_resamples'] = int(value)
+            elif option == '-w':
+                config['weight'] = value
+            i += 1
+        config.update(kwargs)
+        return cls(**config)
+
+    @property
+    def rouge_types(self):
+        """Keys of the results, in the order ROUGE prints them."""
+        rouge_types = ["rouge_{}".format(k) for k in range(1, self.n + 1)] + ["rouge_l"]
+        if self.weight is not None:
+            rouge_types.append("rouge_w_{}".format(self.weight))
+        return rouge_types
+
+    # =================================================
+    # Tokenization, as `sub readText_LCS` and `sub tokenizeText_LCS`
+    # =================================================
+    def _stem(self, token):
+        stem = self._stems.get(token)
+        if stem is None:
+            stem = self._exceptions.get(token)
+            if stem is None:
+                stem = porter_stem(token)
+            self._stems[token] = stem
+        return stem
+
+    def tokenize(self, sentence):
+        # keep [A-Za-z0-9-] only, with '-' as a token of its own
+        text = re.sub(r"[^A-Za-z0-9\-]", " ", sentence.replace("-", " - ")).lower()
+        tokens = [token for token in text.split() if token != "-"]
+        if self.stem:
+            tokens = [self._stem(token) if len(token) > 3 else token for token in tokens]
+        return tokens
+
+    def _tokenize_document(self, sentences):
+        # Empty lines do not match ROUGE's SEE format and are dropped
+        return [self.tokenize(sentence) for sentence in sentences if sentence != '']
+
+    # =================================================
+    # Scoring
+    # =================================================
+    @staticmethod
+    def _unigrams(tokens):
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        return counts
+
+    @staticmethod
+    def _ngrams(tokens, n):
+        counts = {}
+        for i in range(len(tokens) - n + 1):
+            gram = tuple(tokens[i:i + n])
+            counts[gram] = counts.get(gram, 0) + 1
+        return counts
+
+    def _lcs_hits(self, model_units, peer_units, model_1grams, peer_1grams, weight=None):
+        hit = 0
+        base = 0
+        for model in model_units:
+            hit_mask = [0] * len(model)
+            base += len(model) if weight is None else len(model) ** weight
+            for peer in peer_units:
+                if weight is None:
+                    _lcs_inner(model, peer, hit_mask)
+                else:
+                    _wlcs_inner(model, peer, hit_mask, weight)
+            hit_len = 0
+            for j, token in enumerate(model):
+                if hit_mask[j] == 1 and model_1grams.get(token, 0) > 0 and peer_1grams.get(token, 0) > 0:
+                    # clip by unigram counts so LCS never beats ROUGE-1
+                    model_1grams[token] -= 1
+                    peer_1grams[token] -= 1
+                    if weight is None:
+                        hit += 1
+                        continue
+                    hit_len += 1
+                    if (j + 1 < len(model) and hit_mask[j + 1] == 0) or j + 1 == len(model):
+                        hit += hit_len ** weight
+                        hit_len = 0
+        return hit, base
+
+    def score(self, peer, models):
+        """{rouge_type: (recall, precision, f_score)} of one document."""
+        peer_units = self._tokenize_document(peer)
+        peer_tokens = [token for unit in peer_units for token in unit]
+        model_units_list = [self._tokenize_document(model) for model in models]
+        model_tokens_list = [[token for unit in units for token in unit] for units in model_units_list]
+
+        results = {}
+        for n in range(1, self.n + 1):
+            peer_grams = self._ngrams(peer_tokens, n)
+            peer_count = max(len(peer_tokens) - n + 1, 0)
+            total_hit = total_count = total_count_p = 0
+            for model_tokens in model_tokens_list:
+                model_grams = self._ngrams(model_tokens, n)
+                total_hit += sum(min(count, peer_grams[gram])
+                                 for gram, count in model_grams.items() if gram in peer_grams)
+                total_count += max(len(model_tokens) - n + 1, 0)
+                total_count_p += peer_count
+            recall = _ratio(total_hit, total_count)
+            precision = _ratio(total_hit, total_count_p)
+            results["rouge_{}".format(n)] = (recall, precision, _fmeasure(precision, recall, self.alpha))
+
+        weights = [None] if self.weight is None else [None, float(self.weight)]
+        peer_1grams = self._unigrams(peer_tokens)
+        for weight in weights:
+            total_hit = total_count = total_count_p = 0
+            for model_units, model_tokens in zip(model_units_list, model_tokens_list):
+                hit, base = self._lcs_hits(model_units, peer_units, self._unigrams(model_tokens),
+                                           dict(peer_1grams), weight)
+                total_hit += hit
+                if weight is None:
+                    total_count += base
+                    total_count_p += len(peer_tokens)
+                else:
+                    total_count += base ** weight
+                    total_count_p += len(peer_tokens) ** weight
+            if weight is None:
+                recall = _ratio(total_hit, total_count)
+                precision = _ratio(total_hit, total_count_p)
+                key = "rouge_l"
+            else:
+                recall = _round((total_hit / total_count) ** (1 / weight)) if total_count != 0 else _round(0)
+                precision = _round((total_hit / total_count_p) ** (1 / weight)) if total_count_p != 0 else _round(0)
+                key = "rouge_w_{}".format(self.weight)
+            results[key] = (recall, precision, _fmeasure(precision, recall, self.alpha))
+        return results
+
+    def score_documents(self, peers, models_list):
+        """Per-document scores in the format of Rouge155.output_to_per_doc_dict,
+        with eval ids "1", "2", ... in document order."""
+        per_doc = {rouge_type: {} for rouge_type in self.rouge_types}
+        for eval_id, (peer, models) in enumerate(zip(peers, models_list), start=1):
+            for rouge_type, scores in self.score(peer, models).items():
+                per_doc[rouge_type][str(eval_id)] = scores
+        return per_doc
+
+    def aggregate(self, per_doc, system_id=1):
+        """Averages and confidence intervals in the format of
+        Rouge155.output_to_dict, as `sub computeAverages` computes them."""
+        results = {}
+        for rouge_type, scores in per_doc.items():
+            if not scores:
+                continue
+            # perl sorts the "<eval id>.<system id>" keys as strings
+            eval_ids = sorted(scores, key=lambda eval_id: "{}.{}".format(eval_id, system_id))
+            matrix = np.array([scores[eval_id] for eval_id in eval_ids], dtype=np.float64)
+
+            sums = np.zeros((self.num_resamples, 3))
+            for indices in _drand48_indices(self.num_resamples, len(eval_ids)):
+                sums += matrix[indices]
+            ranked = np.sort(sums / len(eval_ids), axis=0)
+
+            delta = self.num_resamples * ((100 - self.confidence) / 2.0) / 100.0
+            ci_ua = int(self.num_resamples - delta - 1)
+            ci_la = int(delta)
+            ci_r = self.num_resamples - delta - 1 - ci_ua
+
+            def at(column, i):
+                return ranked[i, column] if i < self.num_resamples else 0.0
+
+            for column, measure in enumerate(['recall', 'precision', 'f_score']):
+                key = "{}_{}".format(rouge_type, measure)
+                # sequential sum, as perl adds them up
+                results[key] = _round(np.cumsum(ranked[:, column])[-1] / self.num_resamples)
+                results[key + "_cb"] = _round(at(column, ci_la) + (at(column, ci_la + 1) - at(column, ci_la)) * ci_r)
+                results[key + "_ce"] = _round(at(column, ci_ua) + (at(column, ci_ua + 1) - at(column, ci_ua)) * ci_r)
+        return results
@@ -4,15 +4,29 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import pickle
+import tempfile
 import unittest
 from pprint import PrettyPrinter
 import sys
 
 import language_evaluation
+from language_evaluation.coco_caption_py3.pycocoevalcap.bleu.bleu import Bleu
+from language_evaluation.coco_caption_py3.pycocoevalcap.bleu.bleu_scorer import BleuAccumulator
+from language_evaluation.coco_caption_py3.pycocoevalcap.cider.cider import Cider
+from language_evaluation.coco_caption_py3.pycocoevalcap.ngrams import cook_captions
+from language_evaluation.coco_caption_py3.pycocoevalcap.reference_store import ReferenceStore
+from language_evaluation.coco_caption_py3.pycocoevalcap.rouge.rouge import Rouge
+from language_evaluation.pyrouge.utils.sentence_splitter import PunktSentenceSplitter
+from language_evaluation.rouge import rouge_scorer
+from language_evaluation.rouge155 import Rouge155Scorer
 
 pprint = PrettyPrinter().pprint
 SAMPLE_PREDICTIONS = ['i am a boy', 'she is a girl']
 SAMPLE_ANSWERS = ['am i a boy ?', 'is she a girl ?']
+SAMPLE_GTS = {0: ['am i a boy', 'i am a young boy'], 1: ['is she a girl', 'she is a tall girl']}
+SAMPLE_RES = {0: ['i am a boy'], 1: ['she is a girl']}
 
 class TestExample(unittest.TestCase):
     """ Basic uint test.  """
@@ -27,6 +41,78 @@ class TestExample(unittest.TestCase):
         results = evaluator.run_evaluation(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS)
         pprint(results)
 
+    def test_coco_num_workers(self):
+        coco_types = ["BLEU", "ROUGE_L", "CIDEr"]
+        sample_predictions = SAMPLE_PREDICTIONS * 50
+        sample_answers = SAMPLE_ANSWERS * 50
+        evaluator = language_evaluation.CocoEvaluator(coco_types=coco_types)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.CocoEvaluator(coco_types=coco_types, num_workers=3)
+        parallel_results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        self.assertEqual(results, parallel_results)
+
+    def test_coco_partial_merge(self):
+        coco_types = ["BLEU", "ROUGE_L", "CIDEr"]
+        evaluator = language_evaluation.CocoEvaluator(coco_types=coco_types)
+        results = evaluator.run_evaluation(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS)
+        shards = [(SAMPLE_PREDICTIONS[:1], SAMPLE_ANSWERS[:1]),
+                  (SAMPLE_PREDICTIONS[1:], SAMPLE_ANSWERS[1:])]
+        doc_freq = evaluator.merge_doc_freq(
+            *[evaluator.partial_doc_freq(answers) for _, answers in shards])
+        partials = [language_evaluation.stats.loads(language_evaluation.stats.dumps(
+            evaluator.partial(predicts, answers, doc_freq))) for predicts, answers in shards]
+        self.assertEqual(results, evaluator.merge(*partials))
+
+    def test_evaluation_session(self):
+        coco_types = ["BLEU", "ROUGE_L", "CIDEr"]
+        evaluator = language_evaluation.CocoEvaluator(coco_types=coco_types)
+        session = language_evaluation.EvaluationSession(SAMPLE_ANSWERS, coco_types=coco_types)
+        for predicts in [SAMPLE_PREDICTIONS, SAMPLE_PREDICTIONS[::-1], SAMPLE_PREDICTIONS]:
+            self.assertEqual(evaluator.run_evaluation(predicts, SAMPLE_ANSWERS), session.evaluate(predicts))
+        with self.assertRaises(ValueError):
+            session.evaluate(SAMPLE_PREDICTIONS[:1])
+
+    def test_compiled_references(self):
+        coco_types = ["BLEU", "ROUGE_L", "CIDEr"]
+        answers = ['am i a boy', 'is she a girl', ['a boy', 'he is a boy'], 'girls']
+        predicts = SAMPLE_PREDICTIONS + ['he is a boy', 'an unseen word']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'answers.refs')
+            language_evaluation.compile_references(answers, path)
+            references = language_evaluation.open_references(path)
+            self.assertIs(pickle.loads(pickle.dumps(references)), references)
+            for evaluator in [language_evaluation.CocoEvaluator(coco_types=coco_types),
+                              language_evaluation.RougeEvaluator(),
+                              language_evaluation.RougeEvaluator(num_parallel_calls=2,
+                                                                 reference_aggregation="mean")]:
+                self.assertEqual(evaluator.run_evaluation(predicts, answers),
+                                 evaluator.run_evaluation(predicts, references))
+            with self.assertRaises(ValueError):
+                language_evaluation.RougeEvaluator(use_stemmer=False).run_evaluation(predicts, references)
+
+            # repeated n-grams, whose CIDEr weights must be summed as Cider sums them
+            answers = [['c c a', 'b c', 'a a b a b b'], ['c a c', 'c b', 'c a']]
+            predicts = ['b b a a a b a', 'b c']
+            language_evaluation.compile_references(answers, path)
+            evaluator = language_evaluation.CocoEvaluator(coco_types=["CIDEr"])
+            self.assertEqual(evaluator.run_evaluation(predicts, answers),
+                             evaluator.run_evaluation(predicts, language_evaluation.open_references(path)))
+
+    def test_coco_rouge_pruning(self):
+        gts = {i: refs + ['a girl', 'a young boy is a boy', 'unrelated words'] for i, refs in SAMPLE_GTS.items()}
+        self.assertEqual(Rouge(prune=False).compute_score(gts, SAMPLE_RES)[1].tolist(),
+                         Rouge().compute_score(gts, SAMPLE_RES)[1].tolist())
+
+        # many references, repeated tokens and empty captions
+        refs = ['a a a b', 'b a b a b a', 'a b', '', 'c c c c c c c c', 'a c a c a',
+                'b b b b b b b b b b a', 'a', 'c b a c b a c b a', 'd']
+        for candidate in ['a a b b', 'a a a a a a a a a a', 'c a b', '', 'b a c a b a', 'd d d', 'e']:
+            for num_refs in range(1, len(refs) + 1):
+                self.assertEqual(Rouge(prune=False).calc_score([candidate], refs[:num_refs]),
+                                 Rouge(prune=True).calc_score([candidate], refs[:num_refs]))
+                self.assertEqual(Rouge(prune=False).calc_score([candidate], refs[-num_refs:]),
+                                 Rouge(prune=True).calc_score([candidate], refs[-num_refs:]))
+
     def test_rouge(self):
         evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=5)
         sample_predictions = SAMPLE_PREDICTIONS * 5000
@@ -35,6 +121,132 @@ class TestExample(unittest.TestCase):
         #results = evaluator.run_evaluation(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS)
         pprint(results)
 
+    def test_rouge_scorer_perl_parity(self):
+        # (recall, precision, f) printed by ROUGE-1.5.5.pl -n 1 -w 1.2 -U -2 4 -d and -2 -1 -u -d
+        perl_scores = [
+            {'rougeW': (0.41508, 0.61256, 0.49485), 'rougeS4': (0.55, 0.55, 0.55),
+             'rougeSU4': (0.61538, 0.61538, 0.61538), 'rougeSU*': (0.62963, 0.62963, 0.62963)},
+            {'rougeW': (0.19352, 0.45046, 0.27073), 'rougeS4': (0.1, 0.2, 0.13333),
+             'rougeSU4': (0.15789, 0.3, 0.20689), 'rougeSU*': (0.13636, 0.3, 0.1875)}]
+        scorer = rouge_scorer.RougeScorer(["rougeW", "rougeS4", "rougeSU4", "rougeSU*"])
+        predictions = ['the cat sat on the big mat', 'a dog ran on the mat']
+        answers = ['the big cat sat on a mat', 'the dog ran fast in the big dog run']
+        for prediction, answer, expected in zip(predictions, answers, perl_scores):
+            scores = scorer.score(answer, prediction)
+            for rouge_type, (recall, precision, fmeasure) in expected.items():
+                self.assertAlmostEqual(scores[rouge_type].recall, recall, delta=1e-5)
+                self.assertAlmostEqual(scores[rouge_type].precision, precision, delta=1e-5)
+                self.assertAlmostEqual(scores[rouge_type].fmeasure, fmeasure, delta=2e-5)
+
+    def test_rouge_scorer_score_array(self):
+        rouge_types = ["rouge1", "rouge2", "rouge3", "rougeL", "rougeSU4"]
+        scorer = rouge_scorer.RougeScorer(rouge_types, use_stemmer=True)
+        for predict, answer in zip(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS):
+            scores = scorer.score(answer, predict)
+            self.assertEqual(scorer.score_array(answer, predict).tolist(),
+                             [list(scores[rouge_type]) for rouge_type in rouge_types])
+        self.assertAlmostEqual(scores["rouge2"].fmeasure, 1 / 3)
+        with self.assertRaises(ValueError):
+            rouge_scorer.RougeScorer(["rouge1", "rougeX"])
+
+    def test_rouge_lcs_max_band(self):
+        tokens = ' '.join(SAMPLE_ANSWERS * 50).split()
+        shifted = ['so'] * 10 + tokens
+        self.assertEqual(rouge_scorer.lcs_length(tokens, shifted, max_band=16), (len(tokens), True))
+        degenerate = ' '.join(['a'] * 2000)
+        sample_predictions = SAMPLE_PREDICTIONS + [degenerate]
+        sample_answers = SAMPLE_ANSWERS + [' '.join(SAMPLE_ANSWERS * 100)]
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1, lcs_max_band=32)
+        banded_results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        self.assertEqual(banded_results['num_inexact_lcs'], 1)
+        self.assertEqual(results['rouge1'], banded_results['rouge1'])
+        self.assertLessEqual(banded_results['rougeL'], results['rougeL'])
+
+    def test_rouge_multi_reference(self):
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1)
+        results = evaluator.run_evaluation(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS)
+        multi_answers = [[answer, 'an unrelated reference'] for answer in SAMPLE_ANSWERS]
+        self.assertEqual(results, evaluator.run_evaluation(SAMPLE_PREDICTIONS, multi_answers))
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1, reference_aggregation="jackknife")
+        twice_answers = [[answer, answer] for answer in SAMPLE_ANSWERS]
+        self.assertEqual(results, evaluator.run_evaluation(SAMPLE_PREDICTIONS, twice_answers))
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1, reference_aggregation="mean")
+        mean_results = evaluator.run_evaluation(SAMPLE_PREDICTIONS, multi_answers)
+        self.assertLess(mean_results['rouge1'], results['rouge1'])
+
+    def test_rouge_shared_memory(self):
+        sample_predictions = SAMPLE_PREDICTIONS * 100
+        sample_answers = [SAMPLE_ANSWERS, [[answer, 'another reference'] for answer in SAMPLE_ANSWERS]] * 50
+        sample_answers = [answer for answers in sample_answers for answer in answers]
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=3, average=False)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=3, average=False,
+                                                       use_shared_memory=True)
+        shared_results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        for key in shared_results:
+            self.assertEqual([score for scores in results[key] for score in scores],
+                             list(shared_results[key]))
+
+    def test_rouge_streaming(self):
+        sample_predictions = SAMPLE_PREDICTIONS * 100
+        sample_answers = SAMPLE_ANSWERS * 100
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=2)
+        streaming_results = evaluator.run_streaming_evaluation(
+            iter(sample_predictions), (answer for answer in sample_answers), chunk_size=70)
+        for key in results:
+            self.assertAlmostEqual(results[key], streaming_results[key])
+        with self.assertRaises(ValueError):
+            evaluator.run_streaming_evaluation(sample_predictions, sample_answers[:-1])
+
+    def test_rouge_cost_buckets(self):
+        # One long pair among short ones, which is scored first but must be
+        # put back in place
+        sample_predictions = SAMPLE_PREDICTIONS * 20 + [' '.join(SAMPLE_PREDICTIONS * 50)]
+        sample_answers = SAMPLE_ANSWERS * 20 + [' '.join(SAMPLE_ANSWERS * 50)]
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1, average=False)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=3, average=False)
+        parallel_results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        for key in results:
+            self.assertEqual(list(results[key][0]),
+                             [score for scores in parallel_results[key] for score in scores])
+
+    def test_rouge_auto_parallelism(self):
+        sample_predictions = SAMPLE_PREDICTIONS * 100
+        sample_answers = SAMPLE_ANSWERS * 100
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls="auto")
+        auto_results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        for key in results:
+            self.assertEqual(results[key], auto_results[key])
+        # Samples scored to estimate the cost are kept in place
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls="auto", average=False,
+                                                       use_shared_memory=True)
+        auto_results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1, average=False)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        for key in results:
+            self.assertEqual(list(results[key][0]), list(auto_results[key]))
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=1, backend="python")
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls="auto", backend="python")
+        self.assertEqual(results, evaluator.run_evaluation(sample_predictions, sample_answers))
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=1, backend="python",
+                                                          per_document=True)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)['per_document']
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls="auto", backend="python",
+                                                          per_document=True)
+        auto_results = evaluator.run_evaluation(sample_predictions, sample_answers)['per_document']
+        for key in results:
+            self.assertEqual(results[key].fmeasure.tolist(), auto_results[key].fmeasure.tolist())
+        with self.assertRaises(ValueError):
+            language_evaluation.RougeEvaluator(num_parallel_calls="many")
+
     def test_rouge155(self):
         evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=5)
         sample_predictions = SAMPLE_PREDICTIONS * 5000
@@ -42,6 +254,181 @@ class TestExample(unittest.TestCase):
         results = evaluator.run_evaluation(sample_predictions, sample_answers)
         pprint(results)
 
+    def test_rouge155_chunks(self):
+        sample_predictions = SAMPLE_PREDICTIONS * 500
+        sample_answers = SAMPLE_ANSWERS * 499 + ['', '']
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=1)
+        results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=4)
+        parallel_results = evaluator.run_evaluation(sample_predictions, sample_answers)
+        self.assertEqual(results, parallel_results)
+
+    def test_rouge155_run_evaluations(self):
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=2)
+        batches = [(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS), (SAMPLE_PREDICTIONS[::-1], SAMPLE_ANSWERS)]
+        results = [evaluator.run_evaluation(predicts, answers) for predicts, answers in batches]
+        self.assertEqual(results, list(evaluator.run_evaluations(batches)))
+
+    def test_rouge155_per_document(self):
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=1, per_document=True)
+        results = evaluator.run_evaluation(SAMPLE_PREDICTIONS * 5, SAMPLE_ANSWERS * 5)
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=3, per_document=True)
+        parallel_results = evaluator.run_evaluation(SAMPLE_PREDICTIONS * 5, SAMPLE_ANSWERS * 5)
+        for rouge_type in ["rouge1", "rouge2", "rougeL"]:
+            self.assertEqual(results[rouge_type].mid, parallel_results[rouge_type].mid)
+            self.assertEqual(len(results['per_document'][rouge_type].fmeasure), 10)
+            self.assertEqual(list(results['per_document'][rouge_type].fmeasure),
+                             list(parallel_results['per_document'][rouge_type].fmeasure))
+
+    def test_rouge155_bootstrap(self):
+        evaluator = language_evaluation.Rouge155Evaluator(per_document=True, backend="python", seed=1)
+        results = [evaluator.run_evaluation(SAMPLE_PREDICTIONS * 5, SAMPLE_ANSWERS * 5) for _ in range(2)]
+        for rouge_type in ["rouge1", "rouge2", "rougeL"]:
+            self.assertEqual(results[0][rouge_type], results[1][rouge_type])
+        # every document is skipped when all answers are empty
+        evaluator = language_evaluation.Rouge155Evaluator(backend="python")
+        self.assertEqual(evaluator.run_evaluation(SAMPLE_PREDICTIONS, ['', '']),
+                         {'rouge1': 0.0, 'rouge2': 0.0, 'rougeL': 0.0})
+        evaluator = language_evaluation.Rouge155Evaluator(per_document=True, backend="python")
+        self.assertEqual(evaluator.run_evaluation(SAMPLE_PREDICTIONS, ['', ''])['rouge1'].high.fmeasure, 0.0)
+
+    def test_rouge155_python_backend(self):
+        # Scores printed by ROUGE-1.5.5.pl -a -c 95 -m -n 2 -w 1.2 -d
+        scorer = Rouge155Scorer.from_rouge_args("-a -c 95 -m -n 2 -w 1.2")
+        per_doc = scorer.score_documents(
+            [['the cats were sitting on the mat', 'a dog ran happily'],
+             ['state-of-the-art models generalize better']],
+            [[['the cat sat on the mat', 'dogs are running happily'], ['a cat is sitting on a mat']],
+             [['the best models generalize well', 'new models are state of the art']]])
+        self.assertEqual(per_doc['rouge_2'], {'1': (0.26667, 0.2, 0.22857), '2': (0.36364, 0.66667, 0.47059)})
+        self.assertEqual(per_doc['rouge_w_1.2'], {'1': (0.40825, 0.44993, 0.42808), '2': (0.29497, 0.726, 0.4195)})
+        results = scorer.aggregate(per_doc)
+        self.assertEqual(results['rouge_l_precision'], 0.70129)
+        self.assertEqual(results['rouge_l_f_score_cb'], 0.61538)
+
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=1)
+        perl_results = evaluator.run_evaluation(SAMPLE_PREDICTIONS * 5, SAMPLE_ANSWERS * 5)
+        evaluator = language_evaluation.Rouge155Evaluator(num_parallel_calls=1, backend="python")
+        self.assertEqual(perl_results, evaluator.run_evaluation(SAMPLE_PREDICTIONS * 5, SAMPLE_ANSWERS * 5))
+
+    def test_cached_sentence_splitter(self):
+        text = 'Mr. Smith went to Washington. He met Dr. Jones there! Did they talk?'
+        splitter = language_evaluation.CachedSentenceSplitter(num_parallel_calls=2)
+        self.assertEqual(splitter(text), PunktSentenceSplitter().split(text))
+        texts = [text + ' Item {}.'.format(i % 100) for i in range(1000)]
+        self.assertEqual(splitter.split_all(texts), [splitter(text) for text in texts])
+
+    def test_reference_store(self):
+        store = ReferenceStore.from_gts(SAMPLE_GTS)
+        bleu, _ = Bleu(4).compute_score(SAMPLE_GTS, SAMPLE_RES)
+        stored_bleu, _ = Bleu(4).compute_score(store, SAMPLE_RES)
+        self.assertEqual(bleu, stored_bleu)
+        # repeated n-grams, whose weights are summed in the order CIDEr sums them
+        gts = {0: ['c c a', 'b c', 'a a b a b b'], 1: ['c a c', 'c b', 'c a']}
+        res = {0: ['b b a a a b a'], 1: ['b c']}
+        for gts, res in [(SAMPLE_GTS, SAMPLE_RES), (gts, res)]:
+            cider, cider_scores = Cider().compute_score(gts, res)
+            stored_cider, stored_scores = Cider().compute_score(ReferenceStore.from_gts(gts), res)
+            self.assertEqual(cider, stored_cider)
+            self.assertEqual(cider_scores.tolist(), stored_scores.tolist())
+
+    def test_cooked_captions(self):
+        gts, res = cook_captions(SAMPLE_GTS), cook_captions(SAMPLE_RES)
+        self.assertEqual(Bleu(4).compute_score(SAMPLE_GTS, SAMPLE_RES), Bleu(4).compute_score(gts, res))
+        self.assertEqual(Cider().compute_score(SAMPLE_GTS, SAMPLE_RES)[1].tolist(),
+                         Cider().compute_score(gts, res)[1].tolist())
+        caption = pickle.loads(pickle.dumps(gts[0][1]))
+        self.assertEqual((caption, caption.length, caption.counts),
+                         (gts[0][1], gts[0][1].length, gts[0][1].counts))
+
+    def test_vocabulary(self):
+        vocab = language_evaluation.Vocabulary()
+        gts, res = vocab.encode_captions(SAMPLE_GTS), vocab.encode_captions(SAMPLE_RES)
+        self.assertEqual(vocab.decode(res[1][0]), SAMPLE_RES[1][0].split())
+        self.assertEqual(Bleu(4).compute_score(SAMPLE_GTS, SAMPLE_RES), Bleu(4).compute_score(gts, res))
+        for scorer in [Rouge(), Cider()]:
+            self.assertEqual(scorer.compute_score(SAMPLE_GTS, SAMPLE_RES)[1].tolist(),
+                             scorer.compute_score(gts, res)[1].tolist())
+        store = ReferenceStore.from_gts(gts, vocab=vocab)
+        self.assertEqual(Cider().compute_score(SAMPLE_GTS, SAMPLE_RES)[1].tolist(),
+                         Cider().compute_score(store, res)[1].tolist())
+        self.assertEqual(Bleu(4).compute_score(SAMPLE_GTS, SAMPLE_RES), Bleu(4).compute_score(store, res))
+
+    def test_token_ids(self):
+        vocab = language_evaluation.Vocabulary()
+        predicts = [vocab.encode(predict) for predict in SAMPLE_PREDICTIONS]
+        answers = [[vocab.encode(answer), vocab.encode('a boy')] for answer in SAMPLE_ANSWERS]
+        string_answers = [[answer, 'a boy'] for answer in SAMPLE_ANSWERS]
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1)
+        results = evaluator.run_evaluation(SAMPLE_PREDICTIONS, string_answers)
+        evaluator = language_evaluation.RougeEvaluator(num_parallel_calls=1, vocab=vocab.tokens)
+        self.assertEqual(results, evaluator.run_evaluation(predicts, answers))
+        coco_types = ["BLEU", "ROUGE_L", "CIDEr"]
+        predicts = [vocab.encode(res[0]) for res in SAMPLE_RES.values()]
+        answers = [[vocab.encode(ref) for ref in refs] for refs in SAMPLE_GTS.values()]
+        evaluator = language_evaluation.CocoEvaluator(coco_types=coco_types)
+        results = evaluator.run_evaluation([res[0] for res in SAMPLE_RES.values()], list(SAMPLE_GTS.values()))
+        evaluator = language_evaluation.CocoEvaluator(coco_types=coco_types, vocab=vocab.tokens)
+        self.assertEqual(results, evaluator.run_evaluation(predicts, answers))
+
+    def test_bleu_accumulator(self):
+        bleu, _ = Bleu(4).compute_score(SAMPLE_GTS, SAMPLE_RES)
+        accumulator = BleuAccumulator(n=4)
+        for image_id in SAMPLE_GTS:
+            accumulator.add(SAMPLE_RES[image_id][0], SAMPLE_GTS[image_id])
+        self.assertEqual(bleu, accumulator.score())
+
+    def test_windowed_monitor(self):
+        monitor = language_evaluation.WindowedMetricMonitor(max_samples=2)
+        monitor.add('a b c', 'x y z')
+        for predict, answer in zip(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS):
+            monitor.add(predict, answer)
+        results = monitor.report()
+        accumulator = BleuAccumulator(n=4)
+        accumulator.add_batch(SAMPLE_PREDICTIONS, [[answer] for answer in SAMPLE_ANSWERS])
+        self.assertEqual(results['num_samples'], 2)
+        self.assertEqual(results['Bleu_4'], accumulator.score()[3])
+        self.assertAlmostEqual(results['rouge1'], 1.0)
+
+    def test_windowed_monitor_timestamps(self):
+        # A replayed log is windowed by its own timestamps, not the clock
+        monitor = language_evaluation.WindowedMetricMonitor(max_seconds=60)
+        monitor.add('a b c d', 'a b d c', timestamp=1000.0)
+        monitor.add('i am a boy', 'am i a boy ?', timestamp=1010.0)
+        self.assertEqual(monitor.report()['num_samples'], 2)
+        monitor.add('she is a girl', 'is she a girl ?', timestamp=1065.0)
+        results = monitor.report()
+        self.assertEqual(results['num_samples'], 2)
+        scorer = rouge_scorer.RougeScorer(["rouge1", "rouge2", "rougeL"], use_stemmer=True)
+        expected = [scorer.score(answer, predict)['rouge2'].fmeasure for predict, answer in
+                    [('i am a boy', 'am i a boy ?'), ('she is a girl', 'is she a girl ?')]]
+        self.assertEqual(results['rouge2'], sum(expected) / 2)
+        self.assertEqual(monitor.report(now=2000.0)['num_samples'], 0)
+
+        # Sums do not drift as samples pass through the window
+        for i in range(200):
+            monitor.add(SAMPLE_PREDICTIONS[i % 2], 'a girl is a boy', timestamp=1100.0 + i)
+        results = monitor.report(now=5000.0)
+        self.assertEqual(results['num_samples'], 0)
+        self.assertEqual([results[key] for key in ["rouge1", "rouge2", "rougeL"]], [0.0, 0.0, 0.0])
+        self.assertEqual(results['Bleu_1'], 0.0)
+
+    def test_rouge_partial_merge(self):
+        evaluator = language_evaluation.RougeEvaluator()
+        results = evaluator.run_evaluation(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS)
+        partials = [evaluator.partial(SAMPLE_PREDICTIONS[i:i + 1], SAMPLE_ANSWERS[i:i + 1])
+                    for i in range(len(SAMPLE_PREDICTIONS))]
+        self.assertEqual(results, evaluator.merge(*partials))
+
+        evaluator = language_evaluation.RougeEvaluator(average=False)
+        results = evaluator.run_evaluation(SAMPLE_PREDICTIONS, SAMPLE_ANSWERS)
+        merged = evaluator.merge(*[evaluator.partial(SAMPLE_PREDICTIONS[i:i + 1], SAMPLE_ANSWERS[i:i + 1])
+                                   for i in range(len(SAMPLE_PREDICTIONS))])
+        for key in results:
+            self.assertEqual(type(results[key]), type(merged[key]))
+            self.assertEqual([scores.tolist() for scores in results[key]],
+                             [scores.tolist() for scores in merged[key]])
+
 
 if __name__ == '__main__':
     unittest.main()